@@ -1,7 +1,13 @@
 import argparse
+from functools import partial
 from sys import platform
 
 from models import *  # set ONNX_EXPORT in models.py
+from utils.compiled import CompiledDarknet
+from utils.flat_weights import load_flat_weights
+from utils.onnx_backend import ONNXDarknet
+from utils.quantize import load_quantized
+from utils.tta import parse_tta, tta_detect, tta_name
 from utils.datasets import *
 from utils.utils import *
 
@@ -9,6 +15,8 @@ from utils.utils import *
 def detect(save_img=False):
     img_size = (320, 192) if ONNX_EXPORT else opt.img_size  # (320, 192) or (416, 256) or (608, 352) for (height, width)
     out, source, weights, half, view_img, save_txt = opt.output, opt.source, opt.weights, opt.half, opt.view_img, opt.save_txt
+    ort = weights.endswith('.onnx') and not ONNX_EXPORT  # export.py model run by onnxruntime (CPU)
+    compiled = opt.compile and not ONNX_EXPORT and not ort
     webcam = source == '0' or source.startswith('rtsp') or source.startswith('http') or source.endswith('.txt')
 
     # Initialize
@@ -18,14 +26,28 @@ def detect(save_img=False):
     os.makedirs(out)  # make new output folder
 
     # Initialize model
-    model = Darknet(opt.cfg, img_size)
-
-    # Load weights
-    attempt_download(weights)
-    if weights.endswith('.pt'):  # pytorch format
-        model.load_state_dict(torch.load(weights, map_location=device)['model'])
-    else:  # darknet format
-        load_darknet_weights(model, weights)
+    def build():
+        model = Darknet(opt.cfg, img_size)
+        if opt.int8:  # quantize.py INT8 model, CPU only
+            return load_quantized(model, weights, 'models')
+
+        # Load weights
+        if weights.endswith('.pt'):  # pytorch format
+            model.load_state_dict(torch.load(weights, map_location=device)['model'])
+        elif weights.endswith('.flat'):  # flat format, mmap, no copy
+            load_flat_weights(model, weights)
+        else:  # darknet format
+            load_darknet_weights(model, weights)
+        return model
+
+    attempt_download(weights) if not ort else None
+    assert not opt.int8 or (device.type == 'cpu' and not compiled), '--int8 runs eager on CPU (--device cpu)'
+    if ort:  # dynamic batch and image size graph, same pre/post-processing
+        model = ONNXDarknet(weights)
+    elif compiled:  # fused TorchScript graphs per input shape, cached in weights/compiled
+        model = CompiledDarknet(opt.cfg, weights, device, build)
+    else:
+        model = build()
 
     # Second-stage classifier
     classify = False
@@ -35,7 +57,7 @@ def detect(save_img=False):
         modelc.to(device).eval()
 
     # Eval mode
-    model.to(device).eval()
+    model.to(device).eval() if not (compiled or ort) else None
 
     # Fuse Conv2d + BatchNorm2d layers
     # model.fuse()
@@ -56,10 +78,15 @@ def detect(save_img=False):
         return
 
     # Half precision
-    half = half and device.type != 'cpu'  # half precision only supported on CUDA
+    half = half and device.type != 'cpu' and not (compiled or ort)  # half precision only supported on CUDA, eager only
     if half:
         model.half()
 
+    # bfloat16 autocast and channels_last
+    bf16 = opt.bf16 and device.type == 'cpu' and not (compiled or ort or opt.int8)  # CPU only, eager float only
+    if bf16:
+        model = torch_utils.channels_last(model)
+
     # Set Dataloader
     vid_path, vid_writer = None, None
     if webcam:
@@ -75,7 +102,14 @@ def detect(save_img=False):
     colors = [[random.randint(0, 255) for _ in range(3)] for _ in range(len(names))]
 
     # Run inference
-    t0 = time.time()
+    tta = parse_tta(opt.tta) if opt.augment else None  # (scale, flip) augmentations
+    nms = partial(non_max_suppression, multi_label=False, classes=opt.classes, agnostic=opt.agnostic_nms)
+
+    def forward(x):  # plain model forward for tta_detect()
+        with torch_utils.cpu_autocast(bf16):
+            return model(x)
+
+    t0, dt = time.time(), []
     img = torch.zeros((1, 3, img_size, img_size), device=device)  # init img
     _ = model(img.half() if half else img.float()) if device.type != 'cpu' else None  # run once
     for path, img, im0s, vid_cap in dataset:
@@ -84,19 +118,21 @@ def detect(save_img=False):
         img /= 255.0  # 0 - 255 to 0.0 - 1.0
         if img.ndimension() == 3:
             img = img.unsqueeze(0)
+        if bf16:
+            img = torch_utils.channels_last(img)
 
-        # Inference
+        # Inference and NMS
         t1 = torch_utils.time_synchronized()
-        pred = model(img, augment=opt.augment)[0]
+        if tta:  # one batch of all augmentations, NMS per augmentation, then weighted box fusion
+            pred = tta_detect(forward, img, tta, nms, opt.conf_thres, opt.iou_thres)
+        else:
+            with torch_utils.cpu_autocast(bf16):  # fp32 outputs, NMS below in fp32
+                pred = model(img, conf_thres=opt.conf_thres)[0]
+            if half:  # to float
+                pred = [x.float() for x in pred]
+            pred = nms(pred, opt.conf_thres, opt.iou_thres)
         t2 = torch_utils.time_synchronized()
-
-        # to float
-        if half:
-            pred = pred.float()
-
-        # Apply NMS
-        pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres,
-                                   multi_label=False, classes=opt.classes, agnostic=opt.agnostic_nms)
+        dt.append((t2 - t1) / img.shape[0])
 
         # Apply Classifier
         if classify:
@@ -160,6 +196,7 @@ def detect(save_img=False):
         if platform == 'darwin':  # MacOS
             os.system('open ' + save_path)
 
+    print('Speed: %.1f ms per image inference + NMS, TTA %s' % (np.mean(dt) * 1E3, tta_name(tta)))
     print('Done. (%.3fs)' % (time.time() - t0))
 
 
@@ -167,7 +204,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cfg', type=str, default='cfg/yolov3-spp.cfg', help='*.cfg path')
     parser.add_argument('--names', type=str, default='data/coco.names', help='*.names path')
-    parser.add_argument('--weights', type=str, default='weights/yolov3-spp-ultralytics.pt', help='weights path')
+    parser.add_argument('--weights', type=str, default='weights/yolov3-spp-ultralytics.pt', help='weights path (*.onnx: onnxruntime)')
     parser.add_argument('--source', type=str, default='data/samples', help='source')  # input file/folder, 0 for webcam
     parser.add_argument('--output', type=str, default='output', help='output folder')  # output folder
     parser.add_argument('--img-size', type=int, default=512, help='inference size (pixels)')
@@ -175,12 +212,16 @@ if __name__ == '__main__':
     parser.add_argument('--iou-thres', type=float, default=0.6, help='IOU threshold for NMS')
     parser.add_argument('--fourcc', type=str, default='mp4v', help='output video codec (verify ffmpeg support)')
     parser.add_argument('--half', action='store_true', help='half precision FP16 inference')
+    parser.add_argument('--bf16', action='store_true', help='bfloat16 autocast, channels_last inference (CPU)')
     parser.add_argument('--device', default='', help='device id (i.e. 0 or 0,1) or cpu')
     parser.add_argument('--view-img', action='store_true', help='display results')
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt')
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class')
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
+    parser.add_argument('--tta', type=str, default='1,0.83lr,0.67', help='--augment scales and flips (lr, ud, lrud)')
+    parser.add_argument('--compile', action='store_true', help='compiled (TorchScript) inference, cached on disk')
+    parser.add_argument('--int8', action='store_true', help='weights is a quantize.py INT8 model (CPU)')
     opt = parser.parse_args()
     print(opt)
 
@@ -2,6 +2,7 @@ import argparse
 from sys import platform
 
 from models_xview import *  # set ONNX_EXPORT in models.py
+from utils.flat_weights import load_flat_weights
 from utils.datasets_xview import *
 from utils.utils_xview import *
 from utils.torch_utils import *
@@ -35,6 +36,8 @@ def detect(save_img=False):
     # attempt_download(weights)
     if weights.endswith('.pt'):  # pytorch format
         model.load_state_dict(torch.load(weights, map_location=device)['model'])
+    elif weights.endswith('.flat'):  # flat format, mmap, no copy
+        load_flat_weights(model, weights)
     else:  # darknet format
         _ = load_darknet_weights(model, weights)
 
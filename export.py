@@ -0,0 +1,35 @@
+import argparse
+import importlib
+from pathlib import Path
+
+from quantize import load_model
+from utils.onnx_backend import check, export_onnx
+
+
+def export(opt):
+    # Dynamic batch and image size ONNX export of opt.weights for ONNXDarknet (detect.py, test_xview.py --weights *.onnx)
+    mod = importlib.import_module('models_xview' if opt.xview else 'models')
+    model = load_model(mod, opt.cfg, opt.weights, opt.img_size)
+    f = opt.output or str(Path(opt.weights).with_suffix('.onnx'))
+    export_onnx(model, f, opt.img_size, opt.opset)
+    print('ONNX model (opset %g) saved to %s' % (opt.opset, f))
+
+    if opt.check:  # torch vs onnxruntime parity and latency over batch sizes and image shapes
+        s = opt.img_size
+        check(model, f, shapes=((1, s, s), (opt.batch_size, s, s), (1, s - 96, s), (opt.batch_size, s, s + 64)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='export.py')
+    parser.add_argument('--cfg', type=str, default='cfg/yolov3-spp-1cls.cfg', help='*.cfg path')
+    parser.add_argument('--weights', type=str, default='weights/best.pt', help='weights path (*.pt, *.flat, *.weights)')
+    parser.add_argument('--output', type=str, default='', help='*.onnx path, default next to weights')
+    parser.add_argument('--xview', action='store_true', help='models_xview.py model (test_xview.py), else models.py')
+    parser.add_argument('--img-size', type=int, default=608, help='trace size (pixels), any 32-multiple runs')
+    parser.add_argument('--opset', type=int, default=12, help='ONNX opset version')
+    parser.add_argument('--check', action='store_true', help='check parity and latency against the torch model')
+    parser.add_argument('--batch-size', type=int, default=4, help='check batch size')
+    opt = parser.parse_args()
+    print(opt)
+
+    export(opt)
@@ -1,8 +1,12 @@
 from utils.google_utils import *
 from utils.layers import *
 from utils.parse_config import *
+from utils.tta import TTA, deaugment, tta_batch
+from torch.utils.checkpoint import checkpoint
 
 ONNX_EXPORT = False
+LAYER, FUSION, YOLO = 0, 1, 2  # forward_once() layer kinds: module(x), module(x, out) sum/concat, YOLOLayer
+GRIDS = {}  # YOLOLayer xy offsets by (nx, ny, device), shared by all layers and image sizes (multi-scale)
 
 
 def create_modules(module_defs, img_size):
@@ -124,6 +128,42 @@ def create_modules(module_defs, img_size):
     return module_list, routs_binary
 
 
+def execution_plan(module_list):
+    # Per layer (kind, keep, free) for Darknet.forward_once(): layer kind, keep the output for a later layer, and the
+    # kept outputs whose last consumer is this layer (freed right after it). Routed outputs no layer reads are not kept
+    kinds, last = [], {}
+    for i, m in enumerate(module_list):
+        kinds.append(FUSION if isinstance(m, (WeightedFeatureFusion, FeatureConcat)) else
+                     YOLO if isinstance(m, YOLOLayer) else LAYER)
+        for l in (m.layers if kinds[-1] != LAYER else []):  # YOLOLayer only reads layers with ASFF
+            last[i + l if l < 0 else l] = i
+    free = [[] for _ in module_list]
+    for j, i in last.items():
+        free[i].append(j)
+    return [(k, i in last, f) for i, (k, f) in enumerate(zip(kinds, free))]
+
+
+def checkpoint_segments(module_list, plan, n=4, cost=None):
+    """
+    Activation checkpointing segments of an execution_plan(), (a, b, ins, outs, free) per run of layers a to b - 1:
+    the earlier outputs the run reads (ins), its outputs read later (outs) and the ins last read in it (free). Runs are
+    cut after route/shortcut layers, n - 1 cuts spread evenly over the per-layer cost (i.e. output size, default 1),
+    and around each YOLO layer, which runs outside of the checkpoints (a single-layer segment)
+    """
+    reads = [[i + l if l < 0 else l for l in m.layers] if k == FUSION else [] for i, (m, (k, _, _)) in
+             enumerate(zip(module_list, plan))]
+    yolo = [i for i, (k, _, _) in enumerate(plan) if k == YOLO]
+    fusion = [i + 1 for i, (k, _, _) in enumerate(plan) if k == FUSION]  # cut after route/shortcut
+    cuts = {0, len(plan)} | set(yolo) | {i + 1 for i in yolo}
+    c = np.cumsum([0] + list(cost or [1] * len(plan)))  # cost of layers before each cut
+    cuts |= {min(fusion, key=lambda i: abs(c[i] - c[-1] * j / n)) for j in range(1, n)} if fusion else set()
+    cuts = sorted(cuts)
+    return [(a, b,
+             sorted({j for i in range(a, b) for j in reads[i] if j < a}),
+             sorted({j for i in range(b, len(plan)) for j in reads[i] if a <= j < b}),
+             [j for i in range(a, b) for j in plan[i][2] if j < a]) for a, b in zip(cuts[:-1], cuts[1:])]
+
+
 class YOLOLayer(nn.Module):
     def __init__(self, anchors, nc, img_size, yolo_index, layers, stride):
         super(YOLOLayer, self).__init__()
@@ -149,14 +189,32 @@ class YOLOLayer(nn.Module):
 
         # build xy offsets
         if not self.training:
-            yv, xv = torch.meshgrid([torch.arange(self.ny, device=device), torch.arange(self.nx, device=device)])
-            self.grid = torch.stack((xv, yv), 2).view((1, 1, self.ny, self.nx, 2)).float()
+            k = (self.nx, self.ny, str(device))
+            if k not in GRIDS:
+                yv, xv = torch.meshgrid([torch.arange(self.ny, device=device), torch.arange(self.nx, device=device)])
+                GRIDS[k] = torch.stack((xv, yv), 2).view((1, 1, self.ny, self.nx, 2)).float()
+            self.grid = GRIDS[k]
 
         if self.anchor_vec.device != device:
             self.anchor_vec = self.anchor_vec.to(device)
             self.anchor_wh = self.anchor_wh.to(device)
 
-    def forward(self, p, out):
+    def export_decode(self, p):
+        # Inference decode of p (bs, 255, ny, nx) with the grid made in the graph from its traced shape, for dynamic
+        # batch and image size ONNX export (utils/onnx_backend.py)
+        bs, _, ny, nx = p.shape
+        p = p.view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2)
+        yv, xv = torch.meshgrid([torch.arange(ny, device=p.device), torch.arange(nx, device=p.device)])
+        grid = torch.stack((xv, yv), 2).view(1, 1, ny, nx, 2).to(p.dtype)
+        xy = (torch.sigmoid(p[..., :2]) + grid) * self.stride
+        wh = torch.exp(p[..., 2:4]) * self.anchors.view(1, self.na, 1, 1, 2).to(p.device)
+        return torch.cat((xy, wh, torch.sigmoid(p[..., 4:])), 4).view(bs, -1, self.no), p
+
+    def forward(self, p, out, raw=False):
+        # raw: return the (bs, na, ny, nx, no) prediction only, as in training, for fused_decode()
+        if torch.onnx.is_in_onnx_export() and not (ONNX_EXPORT or self.training or raw):
+            return self.export_decode(p)
+
         ASFF = False  # https://arxiv.org/abs/1911.09516
         if ASFF:
             i, n = self.index, self.nl  # index in layers, number of layers
@@ -187,7 +245,7 @@ class YOLOLayer(nn.Module):
         # p.view(bs, 255, 13, 13) -- > (bs, 3, 13, 13, 85)  # (bs, anchors, grid, grid, classes + xywh)
         p = p.view(bs, self.na, self.no, self.ny, self.nx).permute(0, 1, 3, 4, 2).contiguous()  # prediction
 
-        if self.training:
+        if self.training or raw:
             return p
 
         elif ONNX_EXPORT:
@@ -213,6 +271,39 @@ class YOLOLayer(nn.Module):
             return io.view(bs, -1, self.no), p  # view [1, 3, 13, 13, 85] as [1, 507, 85]
 
 
+def fused_decode(ps, yolo_layers, conf_thres=0.001, max_det=3000):
+    """
+    Decodes raw YOLOLayer predictions ps [(bs, na, ny, nx, no), ...] of all layers in one pass. Objectness is read
+    first: only cells with sigmoid(obj) > conf_thres, at most max_det per image (highest objectness), are decoded
+    (xywh pixels, obj and class sigmoid) into one preallocated output. Returns a list of (n, no) detections per image,
+    rows as YOLOLayer inference output, sorted by objectness, i.e. for non_max_suppression()
+    """
+    bs, no = ps[0].shape[0], ps[0].shape[-1]
+    t = torch.tensor(conf_thres).logit().item()  # objectness logit threshold, sigmoid(obj) > conf_thres
+    n = [p[0, ..., 0].numel() for p in ps]  # cells per layer
+    obj = torch.cat([p[..., 4].reshape(bs, -1) for p in ps], 1)  # (bs, cells) objectness logits, all layers
+    k = min(max_det, obj.shape[1])
+    v, j = obj.topk(k, 1) if k < obj.shape[1] else obj.sort(1, descending=True)  # top-k cells per image
+    keep = v > t
+    nk = keep.sum(1).tolist()  # detections per image
+    b, j = keep.nonzero().t()[0], j[keep]  # image, cell (in layer order), image-major
+
+    out = torch.empty((len(j), no), dtype=ps[0].dtype, device=ps[0].device)  # preallocated output
+    i0 = 0
+    for p, m, nl in zip(ps, yolo_layers, n):
+        i = ((j >= i0) & (j < i0 + nl)).nonzero().view(-1)  # output rows from this layer
+        if len(i):
+            c = j[i] - i0  # cell in layer, anchor-major as p[b, a, y, x]
+            x = p.view(bs, nl, no)[b[i], c]  # gather kept cells only
+            a, c = c // (m.ny * m.nx), c % (m.ny * m.nx)
+            xy = torch.stack((c % m.nx, c // m.nx), 1).to(x.dtype)  # grid x, y
+            out[i, :2] = (torch.sigmoid(x[:, :2]) + xy) * m.stride  # xy
+            out[i, 2:4] = torch.exp(x[:, 2:4]) * m.anchors.to(x.device, x.dtype)[a]  # wh pixels
+            out[i, 4:] = torch.sigmoid(x[:, 4:])  # obj, cls
+        i0 += nl
+    return list(out.split(nk))
+
+
 class Darknet(nn.Module):
     # YOLOv3 object detection model
 
@@ -222,6 +313,8 @@ class Darknet(nn.Module):
         self.module_defs = parse_model_cfg(cfg)
         self.module_list, self.routs = create_modules(self.module_defs, img_size)
         self.yolo_layers = get_yolo_layers(self)
+        self.plan = execution_plan(self.module_list)
+        self.segments, self.recompute = [], False  # activation checkpointing, see checkpoint()
         # torch_utils.initialize_weights(self)
 
         # Darknet Header https://github.com/AlexeyAB/darknet/issues/2914#issuecomment-496675346
@@ -229,37 +322,21 @@ class Darknet(nn.Module):
         self.seen = np.array([0], dtype=np.int64)  # (int64) number of images seen during training
         self.info(verbose) if not ONNX_EXPORT else None  # print model description
 
-    def forward(self, x, augment=False, verbose=False):
+    def forward(self, x, augment=False, verbose=False, conf_thres=None, max_det=3000):
+        # conf_thres: inference output is the per-image list of pre-filtered detections of fused_decode(), not augment
+        # augment: True (TTA) or (scale, flip) pairs, see utils/tta.py
 
         if not augment:
-            return self.forward_once(x)
+            return self.forward_once(x, conf_thres=conf_thres, max_det=max_det)
         else:  # Augment images (inference and test only) https://github.com/ultralytics/yolov3/issues/931
-            img_size = x.shape[-2:]  # height, width
-            s = [0.83, 0.67]  # scales
-            y = []
-            for i, xi in enumerate((x,
-                                    torch_utils.scale_img(x.flip(3), s[0], same_shape=False),  # flip-lr and scale
-                                    torch_utils.scale_img(x, s[1], same_shape=False),  # scale
-                                    )):
-                # cv2.imwrite('img%g.jpg' % i, 255 * xi[0].numpy().transpose((1, 2, 0))[:, :, ::-1])
-                y.append(self.forward_once(xi)[0])
-
-            y[1][..., :4] /= s[0]  # scale
-            y[1][..., 0] = img_size[1] - y[1][..., 0]  # flip lr
-            y[2][..., :4] /= s[1]  # scale
-
-            # for i, yi in enumerate(y):  # coco small, medium, large = < 32**2 < 96**2 <
-            #     area = yi[..., 2:4].prod(2)[:, :, None]
-            #     if i == 1:
-            #         yi *= (area < 96. ** 2).float()
-            #     elif i == 2:
-            #         yi *= (area > 32. ** 2).float()
-            #     y[i] = yi
-
-            y = torch.cat(y, 1)
-            return y, None
-
-    def forward_once(self, x, augment=False, verbose=False):
+            tta = TTA if augment is True else augment  # (scale, flip) pairs, see utils/tta.py
+            y = deaugment(self.forward_once(tta_batch(x, tta))[0], tta, x.shape[2:])  # one batch of all augmentations
+            return torch.cat(tuple(y), 1), None  # candidates for NMS, tta_detect() fuses them by WBF instead
+
+    def forward_once(self, x, augment=False, verbose=False, conf_thres=None, max_det=3000):
+        if self.segments and self.training and torch.is_grad_enabled():
+            return self.forward_checkpointed(x)
+
         img_size = x.shape[-2:]  # height, width
         yolo_out, out = [], []
         if verbose:
@@ -275,26 +352,31 @@ class Darknet(nn.Module):
                            torch_utils.scale_img(x, s[1]),  # scale
                            ), 0)
 
-        for i, module in enumerate(self.module_list):
-            name = module.__class__.__name__
-            if name in ['WeightedFeatureFusion', 'FeatureConcat']:  # sum, concat
+        for i, (module, (kind, keep, free)) in enumerate(zip(self.module_list, self.plan)):
+            if kind == FUSION:  # sum, concat
                 if verbose:
                     l = [i - 1] + module.layers  # layers
                     sh = [list(x.shape)] + [list(out[i].shape) for i in module.layers]  # shapes
                     str = ' >> ' + ' + '.join(['layer %g %s' % x for x in zip(l, sh)])
                 x = module(x, out)  # WeightedFeatureFusion(), FeatureConcat()
-            elif name == 'YOLOLayer':
-                yolo_out.append(module(x, out))
+            elif kind == YOLO:
+                yolo_out.append(module(x.float() if x.dtype == torch.bfloat16 else x, out,
+                                       raw=conf_thres is not None))  # fp32 decode and loss under cpu_autocast()
             else:  # run module directly, i.e. mtype = 'convolutional', 'upsample', 'maxpool', 'batchnorm2d' etc.
                 x = module(x)
 
-            out.append(x if self.routs[i] else [])
+            out.append(x if keep else [])
+            for j in free:  # last use, release
+                out[j] = []
             if verbose:
-                print('%g/%g %s -' % (i, len(self.module_list), name), list(x.shape), str)
+                print('%g/%g %s -' % (i, len(self.module_list), module.__class__.__name__), list(x.shape), str)
                 str = ''
 
         if self.training:  # train
             return yolo_out
+        elif conf_thres is not None and not ONNX_EXPORT:  # inference, fused decode of the kept cells only
+            return fused_decode(yolo_out, [self.module_list[i] for i in self.yolo_layers], conf_thres, max_det), \
+                   yolo_out
         elif ONNX_EXPORT:  # export
             x = [torch.cat(x, 0) for x in zip(*yolo_out)]
             return x[0], torch.cat(x[1:3], 1)  # scores, boxes: 3780x80, 3780x4
@@ -309,6 +391,62 @@ class Darknet(nn.Module):
                 x = torch.cat(x, 1)
             return x, p
 
+    def checkpoint(self, n=4):
+        # Activation checkpointing in training: ~n segments of similar activation size recomputed in backward instead of
+        # keeping their layer outputs, 0 disables. Segments are cut by layer index, so any image size works (multi-scale)
+        self.segments = []
+        if n:
+            cost = []  # layer output sizes, the same proportions at any image size
+            hooks = [m.register_forward_hook(lambda m, x, y: cost.append(y.numel() if isinstance(y, torch.Tensor) else
+                                                                         0)) for m in self.module_list]
+            training = self.training
+            with torch.no_grad():
+                self.eval()(torch.zeros(1, 3, 64, 64, device=next(self.parameters()).device))
+            self.train(training)
+            [h.remove() for h in hooks]
+            self.segments = checkpoint_segments(self.module_list, self.plan, n, cost)
+
+    def forward_checkpointed(self, x):
+        # Training forward_once() keeping only the self.segments inputs and outputs for backward
+        out, yolo_out = [], []
+        self.recompute = False
+        for a, b, ins, outs, free in self.segments:
+            if self.plan[a][0] == YOLO:  # decode outside the checkpoints, fp32 under cpu_autocast()
+                yolo_out.append(self.module_list[a](x.float() if x.dtype == torch.bfloat16 else x, out))
+                out.append(x if self.plan[a][1] else [])
+                continue
+            y = checkpoint(self.run_segment, a, b, ins, outs, x, *[out[j] for j in ins], use_reentrant=False)
+            x = y[0]
+            out.extend([[]] * (b - a))
+            for j, yj in zip(outs, y[1:]):
+                out[j] = yj
+            for j in free:  # last use, release
+                out[j] = []
+        self.recompute = True  # run_segment() calls from here on are the backward recomputes
+        return yolo_out
+
+    def run_segment(self, a, b, ins, outs, x, *xs):
+        # Layers a to b - 1 of forward_once() on x and the outputs xs of layers ins, returns x and the outs outputs
+        bns = [m for i in range(a, b) for m in self.module_list[i].modules() if isinstance(m, nn.BatchNorm2d)] \
+            if self.recompute else []
+        momentum = [m.momentum for m in bns]
+        for m in bns:  # running stats already updated in the forward pass
+            m.momentum = 0.0
+        try:
+            out = [[] for _ in range(a)]
+            for j, xj in zip(ins, xs):
+                out[j] = xj
+            for i in range(a, b):
+                module, (kind, keep, free) = self.module_list[i], self.plan[i]
+                x = module(x, out) if kind == FUSION else module(x)
+                out.append(x if keep else [])
+                for j in free:
+                    out[j] = []
+            return (x,) + tuple(out[j] for j in outs)
+        finally:  # recomputes may stop early, once the tensors backward needs exist
+            for m, v in zip(bns, momentum):
+                m.momentum = v
+
     def fuse(self):
         # Fuse Conv2d + BatchNorm2d layers throughout model
         print('Fusing layers...')
@@ -324,6 +462,7 @@ class Darknet(nn.Module):
                         break
             fused_list.append(a)
         self.module_list = fused_list
+        self.plan = execution_plan(self.module_list)
         self.info() if not ONNX_EXPORT else None  # yolov3-spp reduced from 225 to 152 layers
 
     def info(self, verbose=False):
@@ -334,6 +473,99 @@ def get_yolo_layers(model):
     return [i for i, m in enumerate(model.module_list) if m.__class__.__name__ == 'YOLOLayer']  # [89, 101, 113]
 
 
+def route_memory(cfg='cfg/yolov3-spp.cfg', img_size=608, batch_size=1):
+    # Peak memory of the layer outputs forward_once() keeps for route/shortcut layers, all kept to the end (before) vs
+    # freed after their last use: from models import *; route_memory('cfg/yolov3-spp.cfg', 608)
+    model = Darknet(cfg, img_size).eval()
+    nbytes = []
+    for m in model.module_list:
+        m.register_forward_hook(lambda m, x, y: nbytes.append(y.numel() * y.element_size() if
+                                                              isinstance(y, torch.Tensor) else 0))
+    with torch.no_grad():
+        model(torch.zeros(batch_size, 3, img_size, img_size))
+
+    kept = freed = peak_kept = peak_freed = 0
+    for i, (kind, keep, free) in enumerate(model.plan):
+        kept += nbytes[i] if model.routs[i] else 0
+        freed += nbytes[i] if keep else 0
+        peak_kept, peak_freed = max(peak_kept, kept), max(peak_freed, freed)
+        freed -= sum(nbytes[j] for j in free)
+    print('%s %gx%g batch %g: routed outputs peak %.1fMB all kept, %.1fMB freed after last use (%.0f%% saved)' %
+          (cfg, img_size, img_size, batch_size, peak_kept / 1E6, peak_freed / 1E6, 100 * (1 - peak_freed / peak_kept)))
+    return peak_kept, peak_freed
+
+
+def bf16_benchmark(cfgs=('cfg/yolov3-tiny.cfg', 'cfg/yolov3-spp-1cls.cfg', 'cfg/yolov3-spp.cfg'), img_size=416,
+                   batch_size=8, n=5):
+    # CPU inference images/s in fp32, fp32 channels_last and bfloat16 autocast + channels_last (detect.py/test.py
+    # --bf16), with the largest decoded output difference vs fp32: from models import *; bf16_benchmark()
+    print(('%30s' + '%14s' * 5) % ('cfg', 'fp32 img/s', '+nhwc img/s', 'bf16 img/s', 'speedup', 'max diff'))
+    x = torch.rand(batch_size, 3, img_size, img_size)
+    for cfg in cfgs:
+        model, xi = Darknet(cfg, img_size).eval(), x
+        model.fuse()
+        r, y = [], []
+        for nhwc, bf16 in ((False, False), (True, False), (True, True)):
+            if nhwc:
+                model, xi = torch_utils.channels_last(model), torch_utils.channels_last(x)
+            with torch.no_grad(), torch_utils.cpu_autocast(bf16):
+                y.append(model(xi)[0])  # warmup
+                t = time.time()
+                for _ in range(n):
+                    model(xi)
+                r.append(batch_size * n / (time.time() - t))
+        d = (y[2] - y[0]).abs()[..., 4:].max()  # objectness and class scores
+        print(('%30s' + '%14.3g' * 3 + '%13.2fx' + '%14.3g') % (cfg, *r, r[2] / r[0], d))
+
+
+def checkpoint_benchmark(cfg='cfg/yolov3-spp.cfg', img_size=608, batch_size=4, segments=(0, 2, 4, 8), n=3,
+                         device='cpu'):
+    # Training step (forward, backward) peak memory and time per Darknet.checkpoint() setting (0: off), with the
+    # largest gradient difference vs 0: from models import *; checkpoint_benchmark('cfg/yolov3-spp.cfg', 608, 4)
+    # Benchmark only: on CPU the peak is the process RSS high-water mark, reset through Linux /proc and glibc
+    def reset_peak():
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        elif os.path.exists('/proc/self/clear_refs'):  # Linux, resets VmHWM to VmRSS
+            try:
+                import ctypes
+                ctypes.CDLL('libc.so.6').malloc_trim(0)  # return freed heap to the OS, glibc keeps it otherwise
+            except (OSError, AttributeError):  # not glibc
+                pass
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+
+    def peak():  # bytes since reset_peak(), CUDA allocated, else peak RSS (Linux, 0 elsewhere)
+        if device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(device)
+        if os.path.exists('/proc/self/status'):
+            with open('/proc/self/status') as f:
+                return next((int(l.split()[1]) * 1024 for l in f if l.startswith('VmHWM')), 0)
+        return 0
+
+    device = torch.device(device)
+    model = Darknet(cfg, img_size).to(device).train()
+    x = torch.rand(batch_size, 3, img_size, img_size, device=device)
+    print(('%30s' + '%12s' * 4) % ('cfg', 'segments', 'peak (MB)', 'step (ms)', 'max diff'))
+    g0 = None
+    for k in segments:
+        model.checkpoint(k)
+        dt = []
+        for _ in range(n + 1):  # first step warmup
+            model.zero_grad(set_to_none=True)
+            reset_peak()
+            m0 = peak()
+            t = torch_utils.time_synchronized()
+            sum(p.float().square().mean() for p in model(x)).backward()  # loss-like scalar of the YOLO outputs
+            dt.append(torch_utils.time_synchronized() - t)
+            mem = peak() - m0
+        g = torch.cat([p.grad.view(-1) for p in model.parameters() if p.grad is not None])
+        g0 = g if g0 is None else g0
+        print(('%30s' + '%12g' + '%12.4g' * 3) % (cfg, len(model.segments), mem / 1E6, np.mean(dt[1:]) * 1E3,
+                                                 (g - g0).abs().max()))
+    model.checkpoint(0)
+
+
 def load_darknet_weights(self, weights, cutoff=-1):
     # Parses and loads the weights stored in 'weights'
 
@@ -5,6 +5,7 @@ from utils.parse_config_xview import *
 from utils.utils_xview import *
 
 ONNX_EXPORT = False
+LAYER, ROUTE, SHORTCUT, YOLO = 0, 1, 2, 3  # Darknet.forward() layer kinds, anything else passes x through
 
 
 def create_modules(module_defs, img_size, arc):
@@ -53,14 +54,16 @@ def create_modules(module_defs, img_size, arc):
         elif mdef['type'] == 'upsample':
             modules = nn.Upsample(scale_factor=int(mdef['stride']), mode='nearest')
 
-        elif mdef['type'] == 'route':  # nn.Sequential() placeholder for 'route' layer
+        elif mdef['type'] == 'route':  # FloatFunctional (torch.cat, quantizable) for 'route' layer
+            modules = nn.quantized.FloatFunctional()
             layers = [int(x) for x in mdef['layers'].split(',')]
             filters = sum([output_filters[i + 1 if i > 0 else i] for i in layers])
             routs.extend([l if l > 0 else l + i for l in layers])
             # if mdef[i+1]['type'] == 'reorg3d':
             #     modules = nn.Upsample(scale_factor=1/float(mdef[i+1]['stride']), mode='nearest')  # reorg3d
 
-        elif mdef['type'] == 'shortcut':  # nn.Sequential() placeholder for 'shortcut' layer
+        elif mdef['type'] == 'shortcut':  # FloatFunctional (torch.add, quantizable) for 'shortcut' layer
+            modules = nn.quantized.FloatFunctional()
             filters = output_filters[int(mdef['from'])]
             layer = int(mdef['from'])
             routs.extend([i + layer if layer < 0 else layer])
@@ -115,6 +118,25 @@ def create_modules(module_defs, img_size, arc):
     return module_list, routs
 
 
+def execution_plan(module_defs):
+    # Per layer (kind, layers, keep, free) for Darknet.forward(): layer kind, route/shortcut input layers, keep the
+    # output for a later layer, and the kept outputs whose last consumer is this layer (freed right after it)
+    kinds = {'convolutional': LAYER, 'upsample': LAYER, 'maxpool': LAYER, 'route': ROUTE, 'shortcut': SHORTCUT,
+             'yolo': YOLO}
+    plan, last = [], {}
+    for i, mdef in enumerate(module_defs):
+        kind = kinds.get(mdef['type'])
+        layers = [int(x) for x in mdef['layers'].split(',')] if kind == ROUTE else \
+            [int(mdef['from'])] if kind == SHORTCUT else []
+        for l in layers:
+            last[i + l if l < 0 else l] = i
+        plan.append([kind, layers])
+    free = [[] for _ in module_defs]
+    for j, i in last.items():
+        free[i].append(j)
+    return [(kind, layers, i in last, free[i]) for i, (kind, layers) in enumerate(plan)]
+
+
 class SwishImplementation(torch.autograd.Function):
     @staticmethod
     def forward(ctx, i):
@@ -153,6 +175,7 @@ class YOLOLayer(nn.Module):
         self.nx = 0  # initialize number of x gridpoints
         self.ny = 0  # initialize number of y gridpoints
         self.arc = arc
+        self.index = yolo_index  # index of this layer in the yolo layers (stride 32, 16, 8)
 
         if ONNX_EXPORT:  # grids must be computed in __init__
             stride = [32, 16, 8][yolo_index]  # stride of this layer
@@ -160,7 +183,25 @@ class YOLOLayer(nn.Module):
             ny = int(img_size[0] / stride)  # number y grid points
             create_grids(self, img_size, (nx, ny))
 
-    def forward(self, p, img_size, var=None):
+    def export_decode(self, p):
+        # Inference decode of p (bs, 255, ny, nx) with the grid made in the graph from its traced shape, for dynamic
+        # batch and image size ONNX export (utils/onnx_backend.py), 'default' arc
+        bs, _, ny, nx = p.shape
+        p = p.view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2)
+        yv, xv = torch.meshgrid([torch.arange(ny, device=p.device), torch.arange(nx, device=p.device)])
+        grid = torch.stack((xv, yv), 2).view(1, 1, ny, nx, 2).to(p.dtype)
+        stride = [32, 16, 8][self.index]
+        xy = (torch.sigmoid(p[..., :2]) + grid) * stride
+        wh = torch.exp(p[..., 2:4]) * self.anchors.view(1, self.na, 1, 1, 2).to(p.device)
+        cls = torch.ones_like(p[..., 5:]) if self.nc == 1 else p[..., 5:]  # single-class model, NMS sigmoids cls
+        return torch.cat((xy, wh, torch.sigmoid(p[..., 4:5]), cls), 4).view(bs, -1, self.no), p
+
+    def forward(self, p, img_size, var=None, raw=False):
+        # raw: return the (bs, na, ny, nx, no) prediction only, as in training, for fused_decode()
+        if torch.onnx.is_in_onnx_export() and not (ONNX_EXPORT or self.training or raw):
+            assert 'default' in self.arc, 'ONNX export supports the default arc only'
+            return self.export_decode(p)
+
         if ONNX_EXPORT:
             bs = 1  # batch size
         else:
@@ -171,7 +212,7 @@ class YOLOLayer(nn.Module):
         # p.view(bs, 255, 13, 13) -- > (bs, 3, 13, 13, 85)  # (bs, anchors, grid, grid, classes + xywh)
         p = p.view(bs, self.na, self.no, self.ny, self.nx).permute(0, 1, 3, 4, 2).contiguous()  # prediction
 
-        if self.training:
+        if self.training or raw:
             return p
 
         elif ONNX_EXPORT:
@@ -223,6 +264,41 @@ class YOLOLayer(nn.Module):
             return io.view(bs, -1, self.no), p
 
 
+def fused_decode(ps, yolo_layers, conf_thres=0.001, max_det=3000):
+    """
+    Decodes raw 'default' arc YOLOLayer predictions ps [(bs, na, ny, nx, no), ...] of all layers in one pass.
+    Objectness is read first: only cells with sigmoid(obj) > conf_thres, at most max_det per image (highest
+    objectness), are decoded (xywh pixels, obj sigmoid, raw cls) into one preallocated output. Returns a list of
+    (n, no) detections per image, rows as YOLOLayer inference output, sorted by objectness, i.e. for
+    non_max_suppression()
+    """
+    bs, no = ps[0].shape[0], ps[0].shape[-1]
+    t = torch.tensor(conf_thres).logit().item()  # objectness logit threshold, sigmoid(obj) > conf_thres
+    n = [p[0, ..., 0].numel() for p in ps]  # cells per layer
+    obj = torch.cat([p[..., 4].reshape(bs, -1) for p in ps], 1)  # (bs, cells) objectness logits, all layers
+    k = min(max_det, obj.shape[1])
+    v, j = obj.topk(k, 1) if k < obj.shape[1] else obj.sort(1, descending=True)  # top-k cells per image
+    keep = v > t
+    nk = keep.sum(1).tolist()  # detections per image
+    b, j = keep.nonzero().t()[0], j[keep]  # image, cell (in layer order), image-major
+
+    out = torch.empty((len(j), no), dtype=ps[0].dtype, device=ps[0].device)  # preallocated output
+    i0 = 0
+    for p, m, nl in zip(ps, yolo_layers, n):
+        i = ((j >= i0) & (j < i0 + nl)).nonzero().view(-1)  # output rows from this layer
+        if len(i):
+            c = j[i] - i0  # cell in layer, anchor-major as p[b, a, y, x]
+            x = p.view(bs, nl, no)[b[i], c]  # gather kept cells only
+            a, c = c // (m.ny * m.nx), c % (m.ny * m.nx)
+            xy = torch.stack((c % m.nx, c // m.nx), 1).to(x.dtype)  # grid x, y
+            out[i, :2] = (torch.sigmoid(x[:, :2]) + xy) * m.stride  # xy
+            out[i, 2:4] = torch.exp(x[:, 2:4]) * m.anchors.to(x.device, x.dtype)[a]  # wh pixels
+            out[i, 4] = torch.sigmoid(x[:, 4])  # obj, cls left to non_max_suppression()
+            out[i, 5:] = 1 if m.nc == 1 else x[:, 5:]  # single-class model
+        i0 += nl
+    return list(out.split(nk))
+
+
 class Darknet(nn.Module):
     # YOLOv3 object detection model
 
@@ -232,39 +308,46 @@ class Darknet(nn.Module):
         self.module_defs = parse_model_cfg(cfg)
         self.module_list, self.routs = create_modules(self.module_defs, img_size, arc)
         self.yolo_layers = get_yolo_layers(self)
+        self.plan = execution_plan(self.module_defs)
 
         # Darknet Header https://github.com/AlexeyAB/darknet/issues/2914#issuecomment-496675346
         self.version = np.array([0, 2, 5], dtype=np.int32)  # (int32) version info: major, minor, revision
         self.seen = np.array([0], dtype=np.int64)  # (int64) number of images seen during training
 
-    def forward(self, x, var=None):
+    def forward(self, x, var=None, conf_thres=None, max_det=3000):
+        # conf_thres: inference output is the per-image list of pre-filtered detections of fused_decode() ('default'
+        # arc, other arcs keep the full decode)
         img_size = x.shape[-2:]
+        fused = conf_thres is not None and not ONNX_EXPORT and 'default' in self.module_list[self.yolo_layers[0]].arc
         layer_outputs = []
         output = []
 
-        for i, (mdef, module) in enumerate(zip(self.module_defs, self.module_list)):
-            mtype = mdef['type']
-            if mtype in ['convolutional', 'upsample', 'maxpool']:
+        for i, (module, (kind, layers, keep, free)) in enumerate(zip(self.module_list, self.plan)):
+            if kind == LAYER:  # convolutional, upsample, maxpool
                 x = module(x)
-            elif mtype == 'route':
-                layers = [int(x) for x in mdef['layers'].split(',')]
+            elif kind == ROUTE:
                 if len(layers) == 1:
                     x = layer_outputs[layers[0]]
                 else:
                     try:
-                        x = torch.cat([layer_outputs[i] for i in layers], 1)
+                        x = module.cat([layer_outputs[i] for i in layers], 1)
                     except:  # apply stride 2 for darknet reorg layer
                         layer_outputs[layers[1]] = F.interpolate(layer_outputs[layers[1]], scale_factor=[0.5, 0.5])
-                        x = torch.cat([layer_outputs[i] for i in layers], 1)
+                        x = module.cat([layer_outputs[i] for i in layers], 1)
                     # print(''), [print(layer_outputs[i].shape) for i in layers], print(x.shape)
-            elif mtype == 'shortcut':
-                x = x + layer_outputs[int(mdef['from'])]
-            elif mtype == 'yolo':
-                output.append(module(x, img_size))
-            layer_outputs.append(x if i in self.routs else [])
+            elif kind == SHORTCUT:
+                x = module.add(x, layer_outputs[layers[0]])
+            elif kind == YOLO:
+                output.append(module(x.float() if x.dtype == torch.bfloat16 else x, img_size,
+                                     raw=fused))  # fp32 head (bf16)
+            layer_outputs.append(x if keep else [])
+            for j in free:  # last use, release
+                layer_outputs[j] = []
 
         if self.training:
             return output
+        elif fused:  # inference, fused decode of the kept cells only
+            return fused_decode(output, [self.module_list[i] for i in self.yolo_layers], conf_thres, max_det), output
         elif ONNX_EXPORT:
             output = torch.cat(output, 1)  # cat 3 layers 85 x (507, 2028, 8112) to 85 x 10647
             nc = self.module_list[self.yolo_layers[0]].nc  # number of classes
@@ -0,0 +1,75 @@
+import argparse
+import importlib
+from pathlib import Path
+
+import torch
+
+from utils.flat_weights import load_flat
+from utils.parse_config import parse_model_cfg
+from utils.prune import model_flops, prune_masks, prune_state_dict, write_cfg
+from utils.quantize import benchmark
+
+
+def load_state_dict(cfg, weights):
+    # state_dict of a *.pt checkpoint, *.flat file or *.weights file (needs its cfg)
+    if weights.endswith('.pt'):  # pytorch format
+        return torch.load(weights, map_location='cpu')['model']
+    elif weights.endswith('.flat'):  # flat format
+        return load_flat(weights)[0]
+    else:  # darknet format
+        from models import Darknet, load_darknet_weights
+        model = Darknet(cfg)
+        load_darknet_weights(model, weights)
+        return model.state_dict()
+
+
+def prune(opt):
+    # Drops the opt.ratio lowest-|gamma| channels of opt.weights, writes the slim *.cfg and a *.pt Darknet loads directly
+    mdefs = parse_model_cfg(opt.cfg)
+    net, layers, c = mdefs[0], mdefs[1:], int(mdefs[0].get('channels', 3))
+    state_dict = load_state_dict(opt.cfg, opt.weights)
+    masks = prune_masks(layers, state_dict, opt.ratio, opt.min_channels, c)
+    n = [(int(m.sum()), len(m)) for m in masks.values()]
+    state_dict = prune_state_dict(layers, state_dict, masks, c)
+
+    f = opt.output or str(Path(opt.weights).with_name('%s_prune%g' % (Path(opt.weights).stem, opt.ratio * 100)))
+    write_cfg(mdefs, f + '.cfg')
+    torch.save({'epoch': -1,  # train.py --weights *.pt --cfg *.cfg fine-tunes from epoch 0
+                'best_fitness': 0.0,
+                'training_results': None,
+                'model': state_dict,
+                'optimizer': None}, f + '.pt')
+    print('%g/%g channels of %g prunable groups kept, saved %s.cfg and %s.pt' %
+          (sum(x[0] for x in n), sum(x[1] for x in n), len(n), f, f))
+
+    # Report
+    mod = importlib.import_module('models_xview' if opt.xview else 'models')
+    print(('%10s' + '%12s' * 4) % ('', 'params', 'GFLOPs', 'ms (bs 1)', 'img/s (bs %g)' % opt.batch_size))
+    results = []
+    for name, cfg, weights in (('original', opt.cfg, opt.weights), ('pruned', f + '.cfg', f + '.pt')):
+        model = mod.Darknet(cfg, opt.img_size)
+        model.load_state_dict(load_state_dict(cfg, weights))  # strict, the pruned cfg and weights must match
+        model.fuse()
+        model.eval()
+        r = (sum(x.numel() for x in model.parameters()), model_flops(model, opt.img_size)) + \
+            benchmark(model, opt.img_size, opt.batch_size)
+        results.append(r)
+        print(('%10s' + '%12.4g' * 4) % ((name,) + r))
+    a, b = results
+    print(('%10s' + '%11.2fx' * 4) % ('gain', a[0] / b[0], a[1] / b[1], a[2] / b[2], b[3] / a[3]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='prune.py')
+    parser.add_argument('--cfg', type=str, default='cfg/yolov3-spp-1cls.cfg', help='*.cfg path')
+    parser.add_argument('--weights', type=str, default='weights/best.pt', help='trained weights path (*.pt, *.flat)')
+    parser.add_argument('--output', type=str, default='', help='pruned *.cfg and *.pt path without suffix')
+    parser.add_argument('--ratio', type=float, default=0.5, help='fraction of prunable channels to drop')
+    parser.add_argument('--min-channels', type=int, default=8, help='channels kept at least per layer')
+    parser.add_argument('--xview', action='store_true', help='report with the models_xview.py model, else models.py')
+    parser.add_argument('--img-size', type=int, default=608, help='report size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=8, help='report throughput batch size')
+    opt = parser.parse_args()
+    print(opt)
+
+    prune(opt)
@@ -0,0 +1,84 @@
+import argparse
+import importlib
+from pathlib import Path
+
+import torch
+from torch.quantization import convert
+from torch.utils.data import DataLoader
+
+from utils.flat_weights import load_flat_weights
+from utils.parse_config import parse_data_cfg
+from utils.quantize import benchmark, calibrate, quantizable, save_quantized
+
+
+def load_model(mod, cfg, weights, img_size):
+    # Float Darknet of models.py or models_xview.py with weights loaded on CPU
+    model = mod.Darknet(cfg, img_size)
+    if weights.endswith('.pt'):  # pytorch format
+        model.load_state_dict(torch.load(weights, map_location='cpu')['model'])
+    elif weights.endswith('.flat'):  # flat format, mmap, no copy
+        load_flat_weights(model, weights)
+    else:  # darknet format
+        mod.load_darknet_weights(model, weights)
+    return model.eval()
+
+
+def quantize(opt):
+    # Post-training static INT8 quantization of opt.weights, calibrated on opt.calib images of the .data val list
+    family = 'models_xview' if opt.xview else 'models'
+    mod = importlib.import_module(family)
+    datasets = importlib.import_module('utils.datasets_xview' if opt.xview else 'utils.datasets')
+    data = parse_data_cfg(opt.data)
+    dataset = datasets.LoadImagesAndLabels(data['valid'], data['valid_label'], opt.img_size, opt.batch_size, rect=True)
+    dataloader = DataLoader(dataset, batch_size=opt.batch_size, num_workers=min(opt.batch_size, 8), pin_memory=False,
+                            collate_fn=dataset.collate_fn)
+
+    qmodel = quantizable(load_model(mod, opt.cfg, opt.weights, opt.img_size), opt.backend)
+    n = calibrate(qmodel, dataloader, opt.calib)
+    convert(qmodel, inplace=True)
+    f = opt.output or str(Path(opt.weights).with_suffix('.int8.pt'))
+    save_quantized(qmodel, f, opt.cfg, family, opt.backend)
+    print('INT8 model calibrated on %g images saved to %s' % (n, f))
+
+    if opt.report:  # fp32 vs int8 mAP, latency and throughput
+        model = load_model(mod, opt.cfg, opt.weights, opt.img_size)
+        s = ('%10s' + '%12s' * 3 + '%14s') % ('', 'mAP@0.5', 'F1', 'ms (bs 1)', 'img/s (bs %g)' % opt.batch_size)
+        results = []
+        for name, m in (('fp32', model), ('int8', qmodel)):
+            if opt.xview:
+                import test_xview
+                opt.result_dir, opt.name = str(Path(f).parent), Path(f).stem + '_' + name
+                r = test_xview.test(opt.cfg, opt.data, batch_size=opt.batch_size, img_size=opt.img_size,
+                                    conf_thres=opt.conf_thres, iou_thres=opt.iou_thres, model=m, dataloader=dataloader,
+                                    opt=opt)[0]
+            else:
+                import test
+                r = test.test(opt.cfg, opt.data, batch_size=opt.batch_size, img_size=opt.img_size,
+                              conf_thres=opt.conf_thres, iou_thres=opt.iou_thres, model=m, dataloader=dataloader)[0]
+            results.append((name, r[2], r[3]) + benchmark(m, opt.img_size, opt.batch_size))
+        print(s)
+        for r in results:
+            print(('%10s' + '%12.4g' * 3 + '%14.4g') % r)
+        print(('%10s' + '%+12.4g' * 2 + '%11.2fx%13.2fx') % ('delta', results[1][1] - results[0][1],
+                                                           results[1][2] - results[0][2], results[0][3] / results[1][3],
+                                                           results[1][4] / results[0][4]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='quantize.py')
+    parser.add_argument('--cfg', type=str, default='cfg/yolov3-spp-1cls.cfg', help='*.cfg path')
+    parser.add_argument('--data', type=str, default='data/xview.data', help='*.data path, calibrates on valid')
+    parser.add_argument('--weights', type=str, default='weights/best.pt', help='fp32 weights path')
+    parser.add_argument('--output', type=str, default='', help='INT8 model path, default *.int8.pt next to weights')
+    parser.add_argument('--xview', action='store_true', help='models_xview.py model (test_xview.py), else models.py')
+    parser.add_argument('--img-size', type=int, default=608, help='inference size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=8, help='size of each image batch')
+    parser.add_argument('--calib', type=int, default=256, help='number of calibration images')
+    parser.add_argument('--backend', type=str, default='fbgemm', help='fbgemm (x86) or qnnpack (arm)')
+    parser.add_argument('--report', action='store_true', help='report fp32 vs int8 mAP, latency and throughput')
+    parser.add_argument('--conf-thres', type=float, default=0.001, help='object confidence threshold (report)')
+    parser.add_argument('--iou-thres', type=float, default=0.5, help='IOU threshold for NMS (report)')
+    opt = parser.parse_args()
+    print(opt)
+
+    quantize(opt)
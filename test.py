@@ -4,6 +4,8 @@ import json
 from torch.utils.data import DataLoader
 
 from models import *
+from utils.flat_weights import load_flat_weights
+from utils.tta import TTA, parse_tta, tta_detect, tta_name
 from utils.datasets import *
 from utils.utils import *
 
@@ -29,7 +31,8 @@ def test(cfg,
          iou_thres=0.6,  # for nms
          save_json=False,
          single_cls=False,
-         augment=False,
+         augment=False,  # True or (scale, flip) pairs, see utils/tta.py
+         bf16=False,  # bfloat16 autocast, channels_last (CPU)
          model=None,
          dataloader=None,
          opt=None):
@@ -49,6 +52,8 @@ def test(cfg,
         attempt_download(weights)
         if weights.endswith('.pt'):  # pytorch format
             model.load_state_dict(torch.load(weights, map_location=device)['model'])
+        elif weights.endswith('.flat'):  # flat format, mmap, no copy
+            load_flat_weights(model, weights)
         else:  # darknet format
             load_darknet_weights(model, weights)
 
@@ -61,12 +66,20 @@ def test(cfg,
     else:  # called by train.py
         device = next(model.parameters()).device  # get model device
         verbose = False
+    bf16 = bf16 and device.type == 'cpu'
+    if bf16:
+        model = torch_utils.channels_last(model)
+    tta = TTA if augment is True else augment or None  # (scale, flip) augmentations
+
+    def forward(x):  # plain model forward for tta_detect()
+        with torch_utils.cpu_autocast(bf16):
+            return model(x)
 
     # Configure run
     data = parse_data_cfg(data)
     nc = 1 if single_cls else int(data['classes'])  # number of classes
     path = data['valid']  # path to test images
-    lbl_path = data['valid_label']
+    lbl_path = data.get('valid_label')  # not needed if valid points at *.shards
     names = load_classes(data['names'])  # class names
     iouv = torch.linspace(0.5, 0.95, 10).to(device)  # iou vector for mAP@0.5:0.95
     iouv = iouv[0].view(1)  # comment for mAP@0.5:0.95
@@ -95,6 +108,7 @@ def test(cfg,
     jdict, stats, ap, ap_class = [], [], [], []
     for batch_i, (imgs, targets, paths, shapes) in enumerate(tqdm(dataloader, desc=s)):
         imgs = imgs.to(device).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
+        imgs = torch_utils.channels_last(imgs) if bf16 else imgs
         targets = targets.to(device)
         nb, _, height, width = imgs.shape  # batch size, channels, height, width
         whwh = torch.Tensor([width, height, width, height]).to(device)
@@ -108,18 +122,24 @@ def test(cfg,
         with torch.no_grad():
             # Run model
             t = torch_utils.time_synchronized()
-            inf_out, train_out = model(imgs, augment=augment)  # inference and training outputs
+            if tta:  # one batch of all augmentations, NMS per augmentation, then weighted box fusion (in inference)
+                output = tta_detect(forward, imgs, tta, non_max_suppression, conf_thres, iou_thres)
+                t0 += torch_utils.time_synchronized() - t
+            else:
+                fused = None if isinstance(model, nn.DataParallel) else conf_thres  # per-image lists don't gather
+                with torch_utils.cpu_autocast(bf16):  # fp32 outputs, loss and NMS below in fp32
+                    inf_out, train_out = model(imgs, conf_thres=fused)  # inference and training outputs
 
-            t0 += torch_utils.time_synchronized() - t
+                t0 += torch_utils.time_synchronized() - t
 
-            # Compute loss
-            if hasattr(model, 'hyp'):  # if model has loss hyperparameters
-                loss += compute_loss(train_out, targets, model)[1][:3]  # GIoU, obj, cls
+                # Compute loss
+                if hasattr(model, 'hyp'):  # if model has loss hyperparameters
+                    loss += compute_loss(train_out, targets, model)[1][:3]  # GIoU, obj, cls
 
-            # Run NMS
-            t = torch_utils.time_synchronized()
-            output = non_max_suppression(inf_out, conf_thres=conf_thres, iou_thres=iou_thres)  # nms
-            t1 += torch_utils.time_synchronized() - t
+                # Run NMS
+                t = torch_utils.time_synchronized()
+                output = non_max_suppression(inf_out, conf_thres=conf_thres, iou_thres=iou_thres)  # nms
+                t1 += torch_utils.time_synchronized() - t
 
         # Statistics per image
         for si, pred in enumerate(output):
@@ -192,6 +212,8 @@ def test(cfg,
         p, r, ap, f1, ap_class = ap_per_class(*stats)
         if niou > 1:
             p, r, ap, f1 = p[:, 0], r[:, 0], ap.mean(1), ap[:, 0]  # [P, R, AP@0.5:0.95, AP@0.5]
+        else:  # (nc, 1) to (nc,) per class, numpy 2 assigns and formats only scalars
+            p, r, ap, f1 = p[:, 0], r[:, 0], ap[:, 0], f1[:, 0]
         mp, mr, map, mf1 = p.mean(), r.mean(), ap.mean(), f1.mean()
         nt = np.bincount(stats[3].astype(np.int64), minlength=nc)  # number of targets per class
     else:
@@ -208,8 +230,8 @@ def test(cfg,
 
     # Print speeds
     if verbose or save_json:
-        t = tuple(x / seen * 1E3 for x in (t0, t1, t0 + t1)) + (img_size, img_size, batch_size)  # tuple
-        print('Speed: %.1f/%.1f/%.1f ms inference/NMS/total per %gx%g image at batch-size %g' % t)
+        t = tuple(x / seen * 1E3 for x in (t0, t1, t0 + t1)) + (img_size, img_size, batch_size, tta_name(tta))
+        print('Speed: %.1f/%.1f/%.1f ms inference/NMS/total per %gx%g image at batch-size %g, TTA %s' % t)
 
     # Save JSON
     if save_json and map and len(jdict):
@@ -265,6 +287,8 @@ if __name__ == '__main__':
     parser.add_argument('--device', default='0', help='device id (i.e. 0 or 0,1) or cpu')
     parser.add_argument('--single-cls', action='store_true', default=True, help='train as single-class dataset')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
+    parser.add_argument('--tta', type=str, default='1,0.83lr,0.67', help='--augment scales and flips (lr, ud, lrud)')
+    parser.add_argument('--bf16', action='store_true', help='bfloat16 autocast, channels_last inference (CPU)')
 
     parser.add_argument('--name', default='', help='renames results.txt to results_name.txt if supplied')
     parser.add_argument('--class_num', type=int, default=1, help='class number')
@@ -316,7 +340,8 @@ if __name__ == '__main__':
                  opt.iou_thres,
                  opt.save_json,
                  opt.single_cls,
-                 opt.augment,
+                 parse_tta(opt.tta) if opt.augment else False,
+                 opt.bf16,
                  opt = opt)
 
         elif opt.task == 'benchmark':  # mAPs at 320-608 at conf 0.5 and 0.7
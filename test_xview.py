@@ -5,6 +5,11 @@ from torch.utils.data import DataLoader
 
 from utils.parse_config_xview import *
 from models_xview import *
+from utils.compiled import CompiledDarknet
+from utils.flat_weights import load_flat_weights
+from utils.onnx_backend import ONNXDarknet
+from utils.quantize import load_quantized
+from utils.tta import parse_tta, tta_detect, tta_name
 
 from utils.datasets_xview import *
 # from utils.datasets_xview_backup import *
@@ -57,6 +62,7 @@ def test(cfg,
          conf_thres=0.001,
          iou_thres=0.5,  # for nms
          save_json=False,
+         tta=None,  # (scale, flip) augmentations, see utils/tta.py
          model=None,
          dataloader=None,
          opt=None):
@@ -70,20 +76,44 @@ def test(cfg,
             os.remove(f)
 
         # Initialize model
-        model = Darknet(cfg, img_size).to(device)
-
-        # Load weights
-        attempt_download(weights)
-        if weights.endswith('.pt'):  # pytorch format
-            model.load_state_dict(torch.load(weights, map_location=device)['model'])
-        else:  # darknet format
-            _ = load_darknet_weights(model, weights)
+        def build():
+            model = Darknet(cfg, img_size).to(device)
+            if opt.int8:  # quantize.py INT8 model, CPU only
+                return load_quantized(model, weights, 'models_xview')
+
+            # Load weights
+            if weights.endswith('.pt'):  # pytorch format
+                model.load_state_dict(torch.load(weights, map_location=device)['model'])
+            elif weights.endswith('.flat'):  # flat format, mmap, no copy
+                load_flat_weights(model, weights)
+            else:  # darknet format
+                _ = load_darknet_weights(model, weights)
+            return model
+
+        ort = weights.endswith('.onnx')  # export.py model run by onnxruntime (CPU)
+        attempt_download(weights) if not ort else None
+        bf16 = opt.bf16 and device.type == 'cpu' and not (opt.compile or opt.int8 or ort)  # bfloat16 autocast (CPU)
+        tta = tta or parse_tta(opt.tta)
+        assert not opt.int8 or (device.type == 'cpu' and not opt.compile), '--int8 runs eager on CPU (--device cpu)'
+        if ort:  # dynamic batch and image size graph, same pre/post-processing
+            model = ONNXDarknet(weights)
+        elif opt.compile:  # fused TorchScript graphs per batch shape, cached in weights/compiled
+            model = CompiledDarknet(cfg, weights, device, build)
+        else:
+            model = build()
 
-        if torch.cuda.device_count() > 1:
-            model = nn.DataParallel(model)
+            if bf16:
+                model = torch_utils.channels_last(model)
+            if torch.cuda.device_count() > 1:
+                model = nn.DataParallel(model)
     else:  # called by train.py
         device = next(model.parameters()).device  # get model device
         verbose = False
+        bf16 = False  # models passed in run as they are
+
+    def forward(x):  # plain model forward for tta_detect()
+        with torch_utils.cpu_autocast(bf16):
+            return model(x)
 
     # Configure run
     data = parse_data_cfg(data)
@@ -114,12 +144,13 @@ def test(cfg,
     # coco91class = coco80_to_coco91_class()
     xview_classes = np.arange(nc)
     s = ('%20s' + '%10s' * 6) % ('Class', 'Images', 'Targets', 'P', 'R', 'mAP@0.5', 'F1')
-    p, r, f1, mp, mr, map, mf1 = 0., 0., 0., 0., 0., 0., 0.
+    p, r, f1, mp, mr, map, mf1, t0 = 0., 0., 0., 0., 0., 0., 0., 0.
     loss = torch.zeros(3)
     jdict, stats, ap, ap_class = [], [], [], []
     # fixme
     for batch_i, (imgs, targets, paths, shapes) in enumerate(tqdm(dataloader, desc=s)):
         imgs = imgs.to(device).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
+        imgs = torch_utils.channels_last(imgs) if bf16 else imgs
         targets = targets.to(device)
         # print('targets--', targets.shape)
         # print('paths--', paths)
@@ -135,14 +166,21 @@ def test(cfg,
         # Disable gradients
         with torch.no_grad():
             # Run model
-            inf_out, train_out = model(imgs)  # inference and training outputs
-
-            # Compute loss
-            if hasattr(model, 'hyp'):  # if model has loss hyperparameters
-                loss += compute_loss(train_out, targets, model)[1][:3].cpu()  # GIoU, obj, cls
-
-            # Run NMS
-            output = non_max_suppression(inf_out, conf_thres=conf_thres, iou_thres=iou_thres)
+            t = torch_utils.time_synchronized()
+            if tta:  # one batch of all augmentations, NMS per augmentation, then weighted box fusion
+                output = tta_detect(forward, imgs, tta, non_max_suppression, conf_thres, iou_thres)
+            else:
+                fused = None if isinstance(model, nn.DataParallel) else conf_thres  # per-image lists don't gather
+                with torch_utils.cpu_autocast(bf16):  # fp32 outputs, loss and NMS below in fp32
+                    inf_out, train_out = model(imgs, conf_thres=fused)  # inference and training outputs
+
+                # Compute loss
+                if hasattr(model, 'hyp'):  # if model has loss hyperparameters
+                    loss += compute_loss(train_out, targets, model)[1][:3].cpu()  # GIoU, obj, cls
+
+                # Run NMS
+                output = non_max_suppression(inf_out, conf_thres=conf_thres, iou_thres=iou_thres)
+            t0 += torch_utils.time_synchronized() - t
 
         # Statistics per image
         for si, pred in enumerate(output):
@@ -230,6 +268,8 @@ def test(cfg,
         #fixme --yang.xu
         if niou > 1:
             p, r, ap, f1 = p[:, 0], r[:, 0], ap.mean(1), ap[:, 0]  # [P, R, AP@0.5:0.95, AP@0.5]
+        else:  # (nc, 1) to (nc,) per class, numpy 2 assigns and formats only scalars
+            p, r, ap, f1 = p[:, 0], r[:, 0], ap[:, 0], f1[:, 0]
         mp, mr, map, mf1 = p.mean(), r.mean(), ap.mean(), f1.mean()
         nt = np.bincount(stats[3].astype(np.int64), minlength=nc)  # number of targets per class
     else:
@@ -238,6 +278,8 @@ def test(cfg,
     # Print results
     pf = '%20s' + '%10.3g' * 6  # print format
     print(pf % ('all', seen, nt.sum(), mp, mr, map, mf1))
+    print('Speed: %.1f ms per %gx%g image inference + NMS, TTA %s' % (t0 / max(seen, 1) * 1E3, img_size, img_size,
+                                                                     tta_name(tta)))
 
     # Print results per class
     if verbose and nc > 1 and len(stats):
@@ -326,6 +368,10 @@ def get_opt(dt=None, sr=None, comments=''):
     parser.add_argument('--task', default='test', help="'test', 'study', 'benchmark'")
     parser.add_argument('--device', default='', help='device id (i.e. 0 or 0,1) or cpu')
     parser.add_argument('--name', default='', help='name')
+    parser.add_argument('--compile', action='store_true', help='compiled (TorchScript) inference, cached on disk')
+    parser.add_argument('--int8', action='store_true', help='weights is a quantize.py INT8 model (CPU)')
+    parser.add_argument('--bf16', action='store_true', help='bfloat16 autocast, channels_last inference (CPU)')
+    parser.add_argument('--tta', type=str, default='', help='TTA scales and flips, i.e. 1,0.83lr,0.67')
 
     opt = parser.parse_args()
     # opt.save_json = opt.save_json or any([x in opt.data for x in ['xview.data']])
@@ -0,0 +1,127 @@
+"""
+Vectorized loss target assignment and batched NMS of utils/utils.py and utils/utils_xview.py vs their per-layer and
+per-image references (build_targets_loop(), compute_loss(cache=False), non_max_suppression_loop()): ms per batch,
+and an assert that both give the same results, i.e.
+python -m tools.benchmark --check  # seeded small sizes, equivalence only, seconds on a CPU
+python -m tools.benchmark  # full size yolov3-spp 608 timings
+"""
+import argparse
+
+import torch
+
+import models
+import models_xview
+import utils.utils as yolo
+import utils.utils_xview as xview
+from utils import torch_utils
+
+
+def timed(f, n):
+    # Result of f() (warmup) and its mean ms over n more calls
+    y = f()
+    t = torch_utils.time_synchronized()
+    for _ in range(n):
+        f()
+    return y, (torch_utils.time_synchronized() - t) / n * 1E3
+
+
+def random_targets(batch_size, k, nc):
+    # k random (image, class, x, y, w, h) targets per image, wh mostly small
+    targets = torch.rand(batch_size * k, 6)
+    targets[:, 0] = torch.arange(batch_size).repeat_interleave(k)  # image
+    targets[:, 1] = (targets[:, 1] * nc).floor()  # class
+    targets[:, 4:] = targets[:, 4:] ** 2 * 0.3  # wh
+    return targets
+
+
+def random_predictions(batch_size, n, nc, img_size, wh=4, logits=False):
+    # (bs, n, 5 + nc) inference outputs, objectness mostly low, class scores or logits
+    p = torch.rand(batch_size, n, 5 + nc)
+    p[..., :2] *= img_size  # xy
+    p[..., 2:4] = p[..., 2:4] * 100 + wh  # wh
+    p[..., 4] **= 4  # objectness
+    if logits:
+        p[..., 5:] = torch.randn(batch_size, n, nc) * 2
+    return p
+
+
+def same_targets(a, b):
+    # build_targets() outputs equal, the loop gives a=[] for layers without targets
+    flat = lambda x: [u for v in x[:2] + x[3:] for u in v] + [u for v in x[2] for u in v]  # tensors
+    return all(len(u) == len(v) == 0 or torch.equal(u, v) for u, v in zip(flat(a), flat(b)))
+
+
+def same_detections(a, b):
+    return all((u is None and v is None) or torch.allclose(u, v, atol=1E-3) for u, v in zip(a, b))
+
+
+def loss_benchmark(family='yolo', cfg='cfg/yolov3-spp.cfg', img_size=608, batch_size=16, nt=(0, 64, 512), n=20,
+                   arc='default'):
+    # compute_loss() ms per batch and its build_targets() part vs the per-layer reference on random targets, nt per
+    # image. family: 'yolo' (models.py, utils/utils.py) or 'xview' (models_xview.py, utils/utils_xview.py)
+    if family == 'yolo':
+        u, model = yolo, models.Darknet(cfg, img_size).train()
+        model.gr = 1.0
+        model.hyp = {'giou': 3.54, 'cls': 37.4, 'cls_pw': 1.0, 'obj': 64.3, 'obj_pw': 1.0, 'iou_t': 0.20,
+                     'fl_gamma': 0.0}
+    else:
+        u, model = xview, models_xview.Darknet(cfg, (img_size, img_size), arc=arc).train()
+        model.arc = arc
+        model.hyp = {'giou': 1.0, 'cls': 37.4, 'cls_pw': 1.0, 'obj': 49.5, 'obj_pw': 1.0, 'iou_t': 0.225,
+                     'fl_gamma': 0.5}
+    model.nc = int(model.module_defs[-1]['classes'])
+    with torch.no_grad():
+        p = model(torch.zeros(batch_size, 3, img_size, img_size))
+    build = (lambda f, t: f(p, t, model)) if family == 'yolo' else (lambda f, t: f(model, t))
+
+    print(('%8s' + '%12s' * 6) % ('targets', 'matched', 'build loop', 'build', 'loss loop', 'loss', 'speedup'))
+    for k in nt:
+        targets = random_targets(batch_size, k, model.nc)
+        (a, t0), (b, t1) = [timed(lambda: build(f, targets), n) for f in (u.build_targets_loop, u.build_targets)]
+        (la, t2), (lb, t3) = [timed(lambda: u.compute_loss(p, targets, model, cache=c), n) for c in (False, True)]
+        assert same_targets(a, b), 'build_targets() differs from build_targets_loop()'
+        assert torch.allclose(la[1], lb[1]), 'compute_loss() differs from compute_loss(cache=False)'
+        print(('%8g' + '%12g' + '%12.3g' * 4 + '%11.2fx') % (batch_size * k, sum(len(x) for x in b[0]),
+                                                            t0, t1, t2, t3, t2 / t3))
+
+
+def nms_benchmark(family='yolo', batch_size=16, n=22743, nc=1, thres=None, img_size=608, r=10, methods=None):
+    # non_max_suppression() ms per batch vs non_max_suppression_loop() on random (bs, n, 5 + nc) predictions of a
+    # 608 yolov3 (22743 boxes per image), at the (conf_thres, iou_thres) defaults of the family's detect and test
+    # scripts, per method for 'xview'
+    if family == 'yolo':
+        u, p = yolo, random_predictions(batch_size, n, nc, img_size, wh=4)
+        thres, methods = thres or ((0.1, 0.6), (0.001, 0.6)), [{}]
+    else:
+        u, p = xview, random_predictions(batch_size, n, nc, img_size, wh=5, logits=True)
+        thres = thres or ((0.5, 0.5), (0.001, 0.5), (0.3, 0.5))
+        methods = [{'method': m} for m in methods or ('vision_batch', 'vision', 'or', 'and', 'merge', 'soft')]
+
+    print(('%14s' + '%8s' * 2 + '%12s' * 4) % ('method', 'conf', 'iou', 'boxes', 'loop', 'batched', 'speedup'))
+    for kw in methods:
+        for conf_thres, iou_thres in thres:
+            (a, t0), (b, t1) = [timed(lambda: f(p.clone(), conf_thres, iou_thres, **kw), r)
+                                for f in (u.non_max_suppression_loop, u.non_max_suppression)]
+            assert same_detections(a, b), 'non_max_suppression() differs from non_max_suppression_loop() %s' % kw
+            print(('%14s' + '%8.3g' * 2 + '%12g' + '%12.3g' * 2 + '%11.2fx') % (
+                kw.get('method', 'default'), conf_thres, iou_thres, sum(len(x) for x in b if x is not None), t0, t1,
+                t0 / t1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--check', action='store_true', help='seeded small sizes, equivalence checks only')
+    parser.add_argument('--cfg', type=str, default='', help='model cfg, default yolov3-spp (--check: yolov3-tiny)')
+    opt = parser.parse_args()
+
+    torch_utils.init_seeds(0)
+    if opt.check:
+        cfg = opt.cfg or 'cfg/yolov3-tiny-3cls.cfg'
+        for family in ('yolo', 'xview'):
+            loss_benchmark(family, cfg, img_size=128, batch_size=2, nt=(0, 8, 64), n=1)
+            nms_benchmark(family, batch_size=2, n=2000, nc=3, img_size=128, r=1)
+    else:
+        cfg = opt.cfg or 'cfg/yolov3-spp.cfg'
+        for family in ('yolo', 'xview'):
+            loss_benchmark(family, cfg)
+            nms_benchmark(family)
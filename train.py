@@ -7,7 +7,10 @@ from torch.utils.tensorboard import SummaryWriter
 
 import test  # import test.py to get mAP after each epoch
 from models import *
+from utils.batch_augment import augment_batch
 from utils.datasets import *
+from utils.prune import prunable_bn
+from utils.samplers import InfiniteBatchSampler, MixedBatchSampler
 from utils.utils import *
 
 mixed_precision = True
@@ -54,10 +57,6 @@ if f:
 if hyp['fl_gamma']:
     print('Using FocalLoss(gamma=%g)' % hyp['fl_gamma'])
 
-def infi_loop(dl):
-    while True:
-        for (imgs, targets, paths, _) in dl:
-            yield imgs, targets, paths
 
 def train():
     cfg = opt.cfg
@@ -89,8 +88,8 @@ def train():
     train_path = data_dict['train']
     test_path = data_dict['valid']
     #fixme --yang.xu
-    train_label_path = data_dict['train_label']
-    test_label_path = data_dict['valid_label']
+    train_label_path = data_dict.get('train_label')  # not needed if train/valid point at *.shards
+    test_label_path = data_dict.get('valid_label')
     nc = 1 if opt.single_cls else int(data_dict['classes'])  # number of classes
     #fixme --yang.xu
     # hyp['cls'] *= nc / 80  # update coco-tuned hyp['cls'] to current dataset
@@ -161,6 +160,17 @@ def train():
     if mixed_precision:
         model, optimizer = amp.initialize(model, optimizer, opt_level='O1', verbosity=0)
 
+    # bfloat16 autocast and channels_last on CPU (apex is CUDA only), loss in fp32
+    bf16 = opt.bf16 and device.type == 'cpu'
+    if bf16:
+        model = torch_utils.channels_last(model)
+
+    # Sparsity training, L1 on the BatchNorm2d gammas prune.py ranks channels by
+    bns = prunable_bn(model) if opt.sparsity else []
+
+    # Activation checkpointing, recompute segments in backward for larger batches (models.checkpoint_benchmark())
+    model.checkpoint(opt.checkpoint)
+
     # Scheduler https://arxiv.org/pdf/1812.01187.pdf
     lf = lambda x: (((1 + math.cos(x * math.pi / epochs)) / 2) ** 1.0) * 0.95 + 0.05  # cosine
     scheduler = lr_scheduler.LambdaLR(optimizer, lr_lambda=lf)
@@ -187,30 +197,65 @@ def train():
         model = torch.nn.parallel.DistributedDataParallel(model, find_unused_parameters=True)
         model.yolo_layers = model.module.yolo_layers  # move yolo layer indices to top level
 
+    # Test dataset, built first so an 'lru' image cache budget holds the test images (re-read every epoch) before
+    # training images: up to half of --cache-gb for test, the rest split over the training datasets
+    testset = LoadImagesAndLabels(test_path, test_label_path, imgsz_test, batch_size,
+                                  hyp=hyp,
+                                  rect=True,
+                                  cache_images=opt.cache_images,
+                                  single_cls=opt.single_cls,
+                                  cache_gb=opt.cache_gb / 2)
+    lru = opt.cache_images == 'lru'
+    cache_gb = (opt.cache_gb - (testset.imgs.nbytes / 1E9 if lru else 0)) / \
+               (1 + sum(bool(data_dict.get('train_' + k)) for k in ('syn', 'bg')))  # per training dataset
+
     # Dataset
     dataset = LoadImagesAndLabels(train_path, train_label_path, img_size, batch_size,
                                   augment=True,
                                   hyp=hyp,  # augmentation hyperparameters
                                   rect=opt.rect,  # rectangular training
+                                  image_weights=opt.image_weights,
                                   cache_images=opt.cache_images,
-                                  single_cls=opt.single_cls)
+                                  single_cls=opt.single_cls,
+                                  batch_augment=opt.batch_augment,
+                                  cache_gb=cache_gb)
+
+    # Synthetic and background images mixed into every batch at an exact ratio, i.e. *.data with
+    # train_syn=..., train_syn_label=..., syn_ratio=0.25 and/or train_bg=..., bg_ratio=0.125
+    mixed = [(LoadImagesAndLabels(data_dict['train_' + k],
+                                  None if k == 'bg' else data_dict['train_syn_label'],  # background images have no labels
+                                  img_size, batch_size,
+                                  augment=True,
+                                  hyp=hyp,
+                                  cache_images=opt.cache_images,
+                                  single_cls=opt.single_cls,
+                                  batch_augment=opt.batch_augment,
+                                  cache_gb=cache_gb), float(data_dict.get(k + '_ratio', 0)))
+             for k in ('syn', 'bg') if data_dict.get('train_' + k)]
 
-    # Dataloader
+    # Dataloader, endless so its workers are started once for the whole run (see InfiniteBatchSampler)
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count(), batch_size if batch_size > 1 else 0, 8])  # number of workers
-    dataloader = torch.utils.data.DataLoader(dataset,
-                                             batch_size=batch_size,
+    mixed_sampler = None
+    if mixed:  # one worker pool, mixed_sampler.set_ratios() changes the mix between epochs
+        assert not opt.rect, 'mixed real/synthetic batches need --rect off'
+        mixed_sampler = MixedBatchSampler([len(dataset)] + [len(d) for d, _ in mixed], batch_size, [r for _, r in mixed])
+        print('Mixed batches: %s real, synthetic/background %s' % (mixed_sampler.counts[0], mixed_sampler.counts[1:]))
+    sampler = InfiniteBatchSampler(len(dataset), batch_size,
+                                   shuffle=not opt.rect,  # Shuffle=True unless rectangular training is used
+                                   batches=mixed_sampler)
+    if opt.worker_targets:  # build_targets() in the workers, grids from the collated image size
+        assert not (opt.multi_scale or opt.batch_augment), '--worker-targets needs --multi-scale and --batch-augment off'
+    dataloader = torch.utils.data.DataLoader(torch.utils.data.ConcatDataset([dataset] + [d for d, _ in mixed]) if mixed
+                                             else dataset,
+                                             batch_sampler=sampler,
                                              num_workers=nw,
-                                             shuffle=not opt.rect,  # Shuffle=True unless rectangular training is used
                                              pin_memory=True,
-                                             collate_fn=dataset.collate_fn)
+                                             collate_fn=TargetCollate(model, hyp['iou_t'], nc) if opt.worker_targets
+                                             else dataset.collate_fn)
 
     # Testloader
-    testloader = torch.utils.data.DataLoader(LoadImagesAndLabels(test_path, test_label_path, imgsz_test, batch_size,
-                                                                 hyp=hyp,
-                                                                 rect=True,
-                                                                 cache_images=opt.cache_images,
-                                                                 single_cls=opt.single_cls),
+    testloader = torch.utils.data.DataLoader(testset,
                                              batch_size=batch_size,
                                              num_workers=nw,
                                              pin_memory=True,
@@ -240,26 +285,33 @@ def train():
     print('Image sizes %g - %g train, %g test' % (imgsz_min, imgsz_max, imgsz_test))
     print('Using %g dataloader workers' % nw)
     print('Starting training for %g epochs...' % epochs)
+    batches = iter(dataloader)  # nb batches per epoch, workers stay up between epochs
+    class_counts = labels_to_class_counts(dataset.labels, nc) if dataset.image_weights else None  # (n, nc), built once
     for epoch in range(start_epoch, epochs):  # epoch ------------------------------------------------------------------
         model.train()
 
         # Update image weights (optional)
         if dataset.image_weights:
             w = model.class_weights.cpu().numpy() * (1 - maps) ** 2  # class weights
-            image_weights = labels_to_image_weights(dataset.labels, nc=nc, class_weights=w)
-            dataset.indices = random.choices(range(dataset.n), weights=image_weights, k=dataset.n)  # rand weighted idx
+            image_weights = labels_to_image_weights(dataset.labels, nc=nc, class_weights=w, class_counts=class_counts)
+            sampler.set_weights(image_weights)  # rand weighted idx, resampled by the running sampler
+            if lru:
+                dataset.imgs.set_priority(image_weights)  # keep often sampled images cached
 
         mloss = torch.zeros(4).to(device)  # mean losses
         print(('\n' + '%10s' * 8) % ('Epoch', 'gpu_mem', 'GIoU', 'obj', 'cls', 'total', 'targets', 'img_size'))
         #fixme -- yang.xu
         # pbar = tqdm(enumerate(dataloader), total=nb)  # progress bar
         # for i, (imgs, targets, paths, _) in pbar:  # batch -------------------------------------------------------------
-        gen_data = infi_loop(dataloader)
         for i in range(nb):
-            imgs, targets, paths = next(gen_data)
+            imgs, targets, paths, _, *assigned = next(batches)  # assigned targets with --worker-targets
             ni = i + nb * epoch  # number integrated batches (since train start)
-            imgs = imgs.to(device).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
             targets = targets.to(device)
+            if opt.batch_augment:  # flip, HSV and affine on the whole batch
+                imgs, targets = augment_batch(imgs.to(device), targets, hyp)
+                imgs /= 255.0
+            else:
+                imgs = imgs.to(device).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
 
             # Burn-in
             if ni <= n_burn * 2:
@@ -283,10 +335,11 @@ def train():
                     imgs = F.interpolate(imgs, size=ns, mode='bilinear', align_corners=False)
 
             # Run model
-            pred = model(imgs)
+            with torch_utils.cpu_autocast(bf16):
+                pred = model(imgs if not bf16 else torch_utils.channels_last(imgs))  # fp32 outputs
 
             # Compute loss
-            loss, loss_items = compute_loss(pred, targets, model)
+            loss, loss_items = compute_loss(pred, targets, model, assigned=assigned[0] if assigned else None)
             if not torch.isfinite(loss):
                 print('WARNING: non-finite loss, ending training ', loss_items)
                 return results
@@ -303,6 +356,8 @@ def train():
 
             # Optimize accumulated gradient
             if ni % accumulate == 0:
+                for bn in bns:  # L1 subgradient, once per optimizer step whatever the batch size
+                    bn.weight.grad.add_(opt.sparsity * torch.sign(bn.weight.data))
                 optimizer.step()
                 optimizer.zero_grad()
                 ema.update(model)
@@ -347,8 +402,12 @@ def train():
                                       # save_json=final_epoch and is_coco,
                                       save_json=final_epoch and is_xview,
                                       single_cls=opt.single_cls,
+                                      bf16=bf16,
                                       dataloader=testloader)
 
+        if lru:
+            print('train %s\ntest %s' % (dataset.imgs.summary(), testset.imgs.summary()))
+
         # Write epoch results
         with open(results_file, 'a') as f:
             f.write(s + '%10.3g' * 7 % results + '\n')  # P, R, mAP, F1, test_losses=(GIoU, obj, cls)
@@ -433,16 +492,25 @@ def get_args():
     parser.add_argument('--multi-scale', action='store_true', help='adjust (67%% - 150%%) img_size every 10 batches')
     parser.add_argument('--img-size', nargs='+', type=int, default=[608, 608], help='[320, 640] [min_train, max-train, test] img sizes')
     parser.add_argument('--rect', action='store_true', help='rectangular training')
+    parser.add_argument('--batch-augment', action='store_true', help='augment collated batches on device')
+    parser.add_argument('--worker-targets', action='store_true', help='assign targets to anchors in dataloader workers')
+    parser.add_argument('--image-weights', action='store_true', help='sample images weighted by class mAP')
     parser.add_argument('--resume', action='store_true', help='resume training from last.pt')
     parser.add_argument('--nosave', action='store_true', help='only save final checkpoint')
     parser.add_argument('--notest', action='store_true', help='only test final epoch')
     parser.add_argument('--evolve', action='store_true', help='evolve hyperparameters')
     parser.add_argument('--bucket', type=str, default='', help='gsutil bucket')
-    parser.add_argument('--cache-images', action='store_true', help='cache images for faster training')
+    parser.add_argument('--cache-images', nargs='?', const=True, default=False,
+                        help="cache images for faster training, 'mmap' for a shared memory-mapped image arena, "
+                             "'lru' for a shared cache of at most --cache-gb")
+    parser.add_argument('--cache-gb', type=float, default=4.0, help="'lru' image cache budget (GB), train + test")
     parser.add_argument('--weights', type=str, default='', help='initial weights path  weights/yolov3-spp-ultralytics.pt')
     parser.add_argument('--name', default='', help='renames results.txt to results_name.txt if supplied')
     parser.add_argument('--device', default='0, 1', help='device id (i.e. 0 or 0,1 or cpu)')
+    parser.add_argument('--bf16', action='store_true', help='bfloat16 autocast, channels_last training (CPU)')
     parser.add_argument('--adam', action='store_true', help='use adam optimizer')
+    parser.add_argument('--checkpoint', type=int, default=0, help='activation checkpointing segments, 0 for none')
+    parser.add_argument('--sparsity', type=float, default=0.0, help='BatchNorm2d gamma L1 for prune.py, i.e. 1e-4')
     parser.add_argument('--single-cls', action='store_true', default='True', help='train as single-class dataset')
     #fixme
     parser.add_argument('--class-num', type=int, default=1)
@@ -8,6 +8,7 @@ from models_xview import *
 from utils import torch_utils
 from utils.datasets_xview import *
 # from utils.datasets_xview_backup import *
+from utils.samplers import InfiniteBatchSampler, MixedBatchSampler
 from utils.utils_xview import *
 from utils.torch_utils import *
 import warnings
@@ -64,12 +65,6 @@ def infi(dl, loop_count):
             yield dl[index_batch]
 
 
-def infi_loop(dl):
-    while True:
-        for (imgs, targets, paths, _) in dl:
-            yield imgs, targets, paths
-
-
 def train():
     cfg = opt.cfg
     data = opt.data
@@ -79,8 +74,6 @@ def train():
     accumulate = opt.accumulate  # effective bs = batch_size * accumulate = 16 * 4 = 64
     weights = opt.weights  # initial training weights
 
-    syn_batch_size = int(batch_size*opt.syn_ratio)
-
     # Initialize
     #fixme
     # init_seeds(opt.seed)
@@ -100,8 +93,6 @@ def train():
     train_syn_path = data_dict['train_syn']
     train_syn_label_path = data_dict['train_syn_label']
     nc = int(data_dict['classes'])  # number of classes
-    syn_0_xview_number = data_dict['syn_0_xview_number']
-    loop_count = int(syn_0_xview_number)//batch_size
     # Remove previous results
     for f in glob.glob('*_batch*.jpg') + glob.glob(results_file):
         os.remove(f)
@@ -207,7 +198,7 @@ def train():
         model.yolo_layers = model.module.yolo_layers  # move yolo layer indices to top level
 
     # Dataset
-    xview_dataset = LoadImagesAndLabels(train_path, train_label_path, img_size, batch_size=batch_size-syn_batch_size,
+    xview_dataset = LoadImagesAndLabels(train_path, train_label_path, img_size, batch_size=batch_size,
                                   class_num=opt.class_num,
                                   augment=True, # False, #True,
                                   hyp=hyp,  # augmentation hyperparameters
@@ -216,7 +207,7 @@ def train():
                                   cache_labels=epochs > 10,
                                   cache_images=opt.cache_images and not opt.prebias)
 
-    syn_dataset = LoadImagesAndLabels(train_syn_path, train_label_path, img_size, batch_size=syn_batch_size,
+    syn_dataset = LoadImagesAndLabels(train_syn_path, train_syn_label_path, img_size, batch_size=batch_size,
                                       class_num=opt.class_num,
                                       augment=True, # False, #True,
                                       hyp=hyp,  # augmentation hyperparameters
@@ -225,23 +216,17 @@ def train():
                                       cache_labels=epochs > 10,
                                       cache_images=opt.cache_images and not opt.prebias)
 
-    # Dataloader
+    # Dataloader, one worker pool for both datasets with exactly syn_ratio synthetic images per batch
     batch_size = min(batch_size, len(xview_dataset))
     nw = min([os.cpu_count(), batch_size if batch_size > 1 else 0, 8])  # number of workers
-    xview_dataloader = torch.utils.data.DataLoader(xview_dataset,
-                                             batch_size=batch_size,
+    mixed_sampler = MixedBatchSampler([len(xview_dataset), len(syn_dataset)], batch_size, [opt.syn_ratio])
+    sampler = InfiniteBatchSampler(len(xview_dataset), batch_size, batches=mixed_sampler)  # workers started once
+    dataloader = torch.utils.data.DataLoader(torch.utils.data.ConcatDataset([xview_dataset, syn_dataset]),
+                                             batch_sampler=sampler,
                                              num_workers=nw,
-                                             shuffle=not opt.rect,  # Shuffle=True unless rectangular training is used
                                              pin_memory=True,
                                              collate_fn=xview_dataset.collate_fn)
 
-    syn_dataloader = torch.utils.data.DataLoader(syn_dataset,
-                                                 batch_size=syn_batch_size,
-                                                 num_workers=nw,
-                                                 shuffle=not opt.rect,  # Shuffle=True unless rectangular training is used
-                                                 pin_memory=True,
-                                                 collate_fn=syn_dataset.collate_fn)
-
     # Test Dataloader
     if not opt.prebias:
         testloader = torch.utils.data.DataLoader(LoadImagesAndLabels(test_path, test_label_path, opt.img_size, batch_size * 2, class_num=opt.class_num,
@@ -256,8 +241,7 @@ def train():
 
     # Start training
     #fixme
-    # nb = len(dataloader)
-    nb = loop_count
+    nb = len(dataloader)  # one pass over the xView images
     print('nb ', nb)
     model.nc = nc  # attach number of classes to model
     model.arc = opt.arc  # attach yolo architecture
@@ -271,6 +255,7 @@ def train():
     torch_utils.model_info(model, report='summary')  # 'full' or 'summary'
     print('Using %g dataloader workers' % nw)
     print('Starting %s for %g epochs...' % ('prebias' if opt.prebias else 'training', epochs))
+    batches = iter(dataloader)  # nb batches per epoch, workers stay up between epochs
     for epoch in range(start_epoch, epochs):  # epoch ------------------------------------------------------------------
         model.train()
         print(('\n' + '%10s' * 8) % ('Epoch', 'gpu_mem', 'GIoU', 'obj', 'cls', 'total', 'targets', 'img_size'))
@@ -286,14 +271,8 @@ def train():
         # pbar = tqdm(enumerate(dataloader), total=nb)  # progress bar
         # for i, (imgs, targets, paths, _) in pbar:
 
-        gen_xview_data = infi_loop(xview_dataloader)
-        gen_syn_data = infi_loop(syn_dataloader)
         for i in range(nb):
-            xview_imgs, xview_targets, xview_paths = next(gen_xview_data)
-            syn_imgs, syn_targets, syn_paths = next(gen_syn_data)
-            imgs = torch.cat(xview_imgs, syn_imgs, dim=0)
-            targets = torch.cat(xview_targets, syn_targets, dim=0)
-            paths = np.concatenate((xview_paths, syn_paths), axis=0)
+            imgs, targets, paths, _ = next(batches)
 
 
             ni = i + nb * epoch  # number integrated batches (since train start)
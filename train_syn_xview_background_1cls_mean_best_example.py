@@ -9,6 +9,7 @@ import torch.optim.lr_scheduler as lr_scheduler
 import test_xview as test  # import test.py to get mAP after each epoch
 from models_xview import *
 from utils.datasets_xview import *
+from utils.samplers import InfiniteBatchSampler
 from utils.utils_xview import *
 from utils.torch_utils import *
 import warnings
@@ -39,12 +40,6 @@ hyp = {'giou': 1.0, #1.0,  1.5# giou loss gain 3.54
        'shear': 0.641}  # image shear (+/- deg)
 
 
-def infi_loop(dl):
-    while True:
-        for (imgs, targets, paths, _) in dl:
-            yield imgs, targets, paths
-
-
 def train(opt):
     cfg = opt.cfg_model
     data = opt.data
@@ -192,15 +187,17 @@ def train(opt):
                                   rect=opt.rect,  # rectangular training
                                   image_weights=False,
                                   cache_labels=epochs > 10,
-                                  cache_images=opt.cache_images and not opt.prebias)
+                                  cache_images=False if opt.prebias else opt.cache_images,
+                                  cache_gb=opt.cache_gb / 2)
 
-    # Dataloader
+    # Dataloader, endless so its workers are started once for the whole run, loop_count batches per epoch
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count(), batch_size if batch_size > 1 else 0, 8])  # number of workers
+    sampler = InfiniteBatchSampler(len(dataset), batch_size, nb=loop_count,
+                                   shuffle=not opt.rect)  # Shuffle=True unless rectangular training is used
     dataloader = torch.utils.data.DataLoader(dataset,
-                                             batch_size=batch_size,
+                                             batch_sampler=sampler,
                                              num_workers=nw,
-                                             shuffle=not opt.rect,  # Shuffle=True unless rectangular training is used
                                              pin_memory=True,
                                              collate_fn=dataset.collate_fn)
     # Test Dataloader
@@ -210,7 +207,8 @@ def train(opt):
                                 hyp=hyp,
                                 rect=True,
                                 cache_labels=True,
-                                cache_images=opt.cache_images),
+                                cache_images=opt.cache_images,
+                                cache_gb=opt.cache_gb / 2),
             batch_size=batch_size * 2,
             num_workers=nw,
             pin_memory=True,
@@ -242,6 +240,8 @@ def train(opt):
 
     print('Using %g dataloader workers' % nw)
     print('Starting %s for %g epochs...' % ('prebias' if opt.prebias else 'training', epochs))
+    batches = iter(dataloader)  # nb batches per epoch, workers stay up between epochs
+    class_counts = labels_to_class_counts(dataset.labels, nc) if dataset.image_weights else None  # (n, nc), built once
     for epoch in range(start_epoch, epochs):  # epoch ------------------------------------------------------------------
         # if epoch == epochs-1:
         #     return
@@ -251,17 +251,18 @@ def train(opt):
         # Update image weights (optional)
         if dataset.image_weights:
             w = model.class_weights.cpu().numpy() * (1 - maps) ** 2  # class weights
-            image_weights = labels_to_image_weights(dataset.labels, nc=nc, class_weights=w)
-            dataset.indices = random.choices(range(dataset.n), weights=image_weights, k=dataset.n)  # rand weighted idx
+            image_weights = labels_to_image_weights(dataset.labels, nc=nc, class_weights=w, class_counts=class_counts)
+            sampler.set_weights(image_weights)  # rand weighted idx, resampled by the running sampler
+            if opt.cache_images == 'lru':
+                dataset.imgs.set_priority(image_weights)  # keep often sampled images cached
 
         mloss = torch.zeros(4).to(device)  # mean losses
         #fixme
         # pbar = tqdm(enumerate(dataloader), total=nb)  # progress bar
         # for i, (imgs, targets, paths, _) in pbar:
 
-        gen_data = infi_loop(dataloader)
         for i in range(nb):
-            imgs, targets, paths = next(gen_data)
+            imgs, targets, paths, _ = next(batches)
             ni = i + nb * epoch  # number integrated batches (since train start)
             imgs = imgs.to(device).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
             targets = targets.to(device)
@@ -316,6 +317,9 @@ def train(opt):
             # pbar.set_description(s)
             # end batch ------------------------------------------------------------------------------------------------
 
+        if opt.cache_images == 'lru' and not opt.prebias:
+            print('train %s\ntest %s' % (dataset.imgs.summary(), testloader.dataset.imgs.summary()))
+
         # Update scheduler
         scheduler.step()
         print(scheduler.get_lr())
@@ -445,7 +449,10 @@ def get_opt():
     parser.add_argument('--notest', action='store_true', help='only test final epoch')
     parser.add_argument('--evolve', action='store_true', help='evolve hyperparameters')
     parser.add_argument('--bucket', type=str, default='', help='gsutil bucket')
-    parser.add_argument('--cache_images', action='store_true', help='cache images for faster training')
+    parser.add_argument('--cache_images', nargs='?', const=True, default=False,
+                        help="cache images for faster training, 'mmap' for a shared memory-mapped image arena, "
+                             "'lru' for a shared cache of at most --cache_gb")
+    parser.add_argument('--cache_gb', type=float, default=4.0, help="'lru' image cache budget (GB), half for test")
     parser.add_argument('--weights', type=str, default='', help='initial weights')  # weights/ultralytics68.pt
     parser.add_argument('--arc', type=str, default='default', help='yolo architecture')  # defaultpw, uCE, uBCE
     parser.add_argument('--prebias', action='store_true', help='pretrain model biases')
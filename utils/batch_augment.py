@@ -0,0 +1,119 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from utils.utils import xywh2xyxy, xyxy2xywh
+
+
+def rgb_to_hsv(x):
+    # (b, 3, h, w) RGB 0-1 to HSV, hue in degrees 0-360, saturation and value 0-1
+    mx, i = x.max(1)
+    d = mx - x.min(1)[0]
+    r, g, b = x.unbind(1)
+    dz = torch.where(d > 0, d, torch.ones_like(d))  # avoid /0, hue is 0 for gray pixels
+    h = torch.stack(((g - b) / dz % 6, (b - r) / dz + 2, (r - g) / dz + 4), 1).gather(1, i.unsqueeze(1)).squeeze(1)
+    h = torch.where(d > 0, h * 60, torch.zeros_like(h))
+    s = torch.where(mx > 0, d / torch.where(mx > 0, mx, torch.ones_like(mx)), torch.zeros_like(mx))
+    return torch.stack((h, s, mx), 1)
+
+
+def hsv_to_rgb(x):
+    # Inverse of rgb_to_hsv()
+    h, s, v = x.unbind(1)
+    k = (torch.tensor([5., 3., 1.], device=x.device).view(1, 3, 1, 1) + h.unsqueeze(1) / 60) % 6
+    return v.unsqueeze(1) - (v * s).unsqueeze(1) * torch.min(k, 4 - k).clamp(0, 1)
+
+
+def batch_augment_hsv(imgs, hgain=0.5, sgain=0.5, vgain=0.5):
+    # Batched augment_hsv(), imgs (b, 3, h, w) float RGB 0-255, random gains per image, in place
+    b = imgs.shape[0]
+    x = (torch.rand(b, 3, device=imgs.device) * 2 - 1) * torch.tensor([hgain, sgain, vgain], device=imgs.device) + 1
+    hsv = rgb_to_hsv(imgs / 255.0) * x.view(b, 3, 1, 1)
+    hsv[:, 0].clamp_(None, 358)  # hue clip (0 - 179 in OpenCV half-degrees)
+    hsv[:, 1:].clamp_(None, 1)
+    imgs[:] = hsv_to_rgb(hsv) * 255.0
+    return imgs
+
+
+def batch_flip_lr(imgs, targets, p=0.5):
+    # Random left-right flip per image, imgs (b, 3, h, w), targets (n, 6) [image, class, xywh normalized]
+    f = torch.rand(imgs.shape[0], device=imgs.device) < p
+    imgs[f] = imgs[f].flip(3)
+    j = f[targets[:, 0].long()]
+    targets[j, 2] = 1 - targets[j, 2]
+    return imgs, targets
+
+
+def batch_random_affine(imgs, targets, degrees=10, translate=.1, scale=.1, shear=10):
+    # Batched random_affine() with one grid_sample, imgs (b, 3, h, w) float 0-255, targets (n, 6) xywh normalized
+    if not (degrees or translate or scale or shear):
+        return imgs, targets
+    b, _, height, width = imgs.shape
+    device = imgs.device
+    u = lambda lim: (torch.rand(b, device=device) * 2 - 1) * lim  # uniform(-lim, lim) per image
+
+    # Rotation and Scale, as cv2.getRotationMatrix2D()
+    a, s = u(degrees) * math.pi / 180, 1 + u(scale)
+    alpha, beta = s * torch.cos(a), s * torch.sin(a)
+    cx, cy = width / 2, height / 2
+    R = torch.eye(3, device=device).repeat(b, 1, 1)
+    R[:, 0, 0], R[:, 0, 1], R[:, 0, 2] = alpha, beta, (1 - alpha) * cx - beta * cy
+    R[:, 1, 0], R[:, 1, 1], R[:, 1, 2] = -beta, alpha, beta * cx + (1 - alpha) * cy
+
+    # Translation
+    T = torch.eye(3, device=device).repeat(b, 1, 1)
+    T[:, 0, 2] = u(translate) * height  # x translation (pixels), as random_affine()
+    T[:, 1, 2] = u(translate) * width  # y translation (pixels)
+
+    # Shear
+    S = torch.eye(3, device=device).repeat(b, 1, 1)
+    S[:, 0, 1] = torch.tan(u(shear) * math.pi / 180)  # x shear (deg)
+    S[:, 1, 0] = torch.tan(u(shear) * math.pi / 180)  # y shear (deg)
+
+    # Warp, sampling each output pixel at M^-1 @ xy like cv2.warpAffine()
+    M = S @ T @ R  # ORDER IS IMPORTANT HERE!!
+    yv, xv = torch.meshgrid(torch.arange(height, device=device, dtype=torch.float32),
+                            torch.arange(width, device=device, dtype=torch.float32))
+    xy = torch.stack((xv, yv, torch.ones_like(xv)), 2).view(1, -1, 3)  # output pixel coordinates
+    xy = (xy @ torch.inverse(M).transpose(1, 2))[..., :2]  # source pixel coordinates
+    grid = (2 * xy + 1) / torch.tensor([width, height], device=device) - 1  # normalized, align_corners=False
+    imgs = F.grid_sample(imgs - 114, grid.view(b, height, width, 2), mode='bilinear', padding_mode='zeros',
+                         align_corners=False) + 114  # border value 114
+
+    # Transform label coordinates
+    n = len(targets)
+    if n:
+        box0 = xywh2xyxy(targets[:, 2:6]) * torch.tensor([width, height, width, height], device=device)
+        xy = torch.ones(n, 4, 3, device=device)
+        xy[..., :2] = box0[:, [0, 1, 2, 3, 0, 3, 2, 1]].view(n, 4, 2)  # x1y1, x2y2, x1y2, x2y1
+        xy = (xy @ M[targets[:, 0].long()].transpose(1, 2))[..., :2]
+
+        # create new boxes
+        box = torch.cat((xy.min(1)[0], xy.max(1)[0]), 1)
+
+        # reject warped points outside of image
+        box[:, [0, 2]] = box[:, [0, 2]].clamp(0, width)
+        box[:, [1, 3]] = box[:, [1, 3]].clamp(0, height)
+        w, h = box[:, 2] - box[:, 0], box[:, 3] - box[:, 1]
+        area0 = (box0[:, 2] - box0[:, 0]) * (box0[:, 3] - box0[:, 1])
+        ar = torch.max(w / (h + 1e-16), h / (w + 1e-16))  # aspect ratio
+        i = (w > 4) & (h > 4) & (w * h / (area0 + 1e-16) > 0.2) & (ar < 10)
+
+        targets = targets[i]
+        targets[:, 2:6] = xyxy2xywh(box[i] / torch.tensor([width, height, width, height], device=device))
+
+    return imgs, targets
+
+
+def augment_batch(imgs, targets, hyp):
+    """
+    Batched augmentation of a collated LoadImagesAndLabels(..., batch_augment=True) batch, on imgs' device.
+    imgs: (b, h, w, 3) uint8 BGR letterboxed images, targets: (n, 6) [image, class, xywh normalized]
+    Returns (b, 3, h, w) float32 RGB 0-255 images and targets, augmented like LoadImagesAndLabels.__getitem__()
+    """
+    imgs = imgs.permute(0, 3, 1, 2).flip(1).float()  # BGR to RGB, to bx3x416x416
+    imgs, targets = batch_random_affine(imgs, targets, degrees=hyp['degrees'], translate=hyp['translate'],
+                                        scale=hyp['scale'], shear=hyp['shear'])
+    batch_augment_hsv(imgs, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
+    return batch_flip_lr(imgs, targets)
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import time
+import warnings
+from pathlib import Path
+
+import torch
+
+COMPILED_VERSION = 1
+
+
+def file_hash(path, chunk=1 << 20):
+    # sha1 hex digest of a file's contents, i.e. a weights file
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for b in iter(lambda: f.read(chunk), b''):
+            h.update(b)
+    return h.hexdigest()
+
+
+class CompiledDarknet:
+    """
+    Fused, traced and frozen TorchScript Darknet for inference, one graph per input hw shape (letterboxed shapes are
+    multiples of 32/64, so a dataset only uses a few), cached on disk as cache_dir/<cfg>_<key>_<h>x<w>.torchscript.pt
+    with key = hash(cfg text, weights contents, shape, torch version). A cached graph loads without parse_model_cfg()/
+    create_modules() or reading the weights into a Darknet; build() (returning an eager Darknet with weights loaded)
+    is only called on the first cache miss. Batch size is dynamic. Called like the eager model in eval mode, i.e.
+    model = CompiledDarknet(opt.cfg, opt.weights, device, build)  # build(): Darknet(opt.cfg) + load weights
+    inf_out, train_out = model(imgs)
+    """
+
+    def __init__(self, cfg, weights, device='cpu', build=None, cache_dir='weights/compiled'):
+        self.cfg, self.weights, self.build, self.cache_dir = cfg, weights, build, cache_dir
+        self.device = torch.device(device)
+        self.key_prefix = hashlib.sha1()  # cfg + weights part of the key, weights hashed once
+        self.key_prefix.update(Path(cfg).read_bytes())
+        self.key_prefix.update(file_hash(weights).encode())
+        self.graphs, self.model = {}, None  # hw: ScriptModule, eager model (only built on a cache miss)
+
+    def path(self, shape):
+        h = self.key_prefix.copy()
+        h.update(('%s %g %s' % (tuple(shape), COMPILED_VERSION, torch.__version__)).encode())
+        return str(Path(self.cache_dir) / ('%s_%s_%gx%g.torchscript.pt' % (Path(self.cfg).stem, h.hexdigest()[:16],
+                                                                           *shape)))
+
+    def compile(self, shape):
+        # Traces and freezes the fused eager model for hw shape
+        if self.model is None:
+            self.model = self.build()
+            self.model.fuse()
+            self.model.to(self.device).eval()
+        img = torch.zeros((1, 3) + tuple(shape), device=self.device)
+        with torch.no_grad(), warnings.catch_warnings():
+            warnings.simplefilter('ignore', torch.jit.TracerWarning)  # grid sizes are constant per shape
+            graph = torch.jit.freeze(torch.jit.trace(self.model, img, strict=False, check_trace=False))
+        return graph
+
+    def get(self, shape):
+        # Graph for hw shape: in memory, else from the disk cache, else compiled (and cached)
+        shape = tuple(int(x) for x in shape)
+        if shape not in self.graphs:
+            warnings.filterwarnings('ignore', category=FutureWarning, module='torch.jit')  # TorchScript deprecation
+            f = self.path(shape)
+            if os.path.exists(f):
+                self.graphs[shape] = torch.jit.load(f, map_location=self.device)
+            else:
+                graph = self.compile(shape)
+                try:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    tmp = '%s.%g.tmp' % (f, os.getpid())
+                    torch.jit.save(graph, tmp)
+                    os.replace(tmp, f)  # atomic
+                except OSError as e:
+                    print('WARNING: compiled model cache %s not writeable: %s' % (f, e))
+                self.graphs[shape] = graph
+        return self.graphs[shape]
+
+    def __call__(self, x, augment=False, conf_thres=None, max_det=3000):
+        # conf_thres: per-image list of detections above conf_thres as Darknet(..., conf_thres), decoded in the graph
+        assert not augment, 'augmented inference is not compiled, use the eager model'
+        io, p = self.get(x.shape[-2:])(x)
+        if conf_thres is not None:
+            io = [xi[xi[:, 4] > conf_thres] for xi in io]
+            io = [xi[xi[:, 4].argsort(descending=True)[:max_det]] for xi in io]
+        return io, p
+
+    def eval(self):  # already inference-only, for model.eval() callers
+        return self
+
+
+def benchmark(cfg, weights, build, img_size=416, batch_size=1, n=20, device='cpu', cache_dir='weights/compiled'):
+    # Startup (model ready to run) and latency of the eager vs compiled model, build(): eager Darknet with weights loaded
+    shape = (img_size, img_size) if isinstance(img_size, int) else img_size
+    x = torch.rand((batch_size, 3) + tuple(shape), device=device)
+
+    def timeit(model):
+        with torch.no_grad():
+            model(x)  # warmup
+            t = time.time()
+            for _ in range(n):
+                y = model(x)[0]
+            return (time.time() - t) / n, y
+
+    t = time.time()
+    model = build().to(device).eval()
+    t_eager = time.time() - t
+    dt_eager, y0 = timeit(model)
+    model.fuse()
+    dt_fused, _ = timeit(model)
+
+    compiled = CompiledDarknet(cfg, weights, device, build, cache_dir)
+    if os.path.exists(compiled.path(shape)):
+        os.remove(compiled.path(shape))
+    t = time.time()
+    compiled.get(shape)  # cold: build + trace + freeze + save
+    t_cold = time.time() - t
+    t = time.time()
+    compiled = CompiledDarknet(cfg, weights, device, cache_dir=cache_dir)  # warm: no build() needed
+    compiled.get(shape)
+    t_warm = time.time() - t
+    dt_compiled, y1 = timeit(compiled)
+
+    print('%s %gx%g batch %g on %s, max output diff %.3g' % (cfg, *shape, batch_size, device, (y1 - y0).abs().max()))
+    print('%-30s%12s%12s' % ('', 'startup (s)', 'latency (ms)'))
+    print('%-30s%12.3f%12.1f' % ('eager', t_eager, dt_eager * 1E3))
+    print('%-30s%12s%12.1f' % ('eager fused', '', dt_fused * 1E3))
+    print('%-30s%12.3f%12.1f' % ('compiled, cache miss', t_cold, dt_compiled * 1E3))
+    print('%-30s%12.3f%12s' % ('compiled, cache hit', t_warm, ''))
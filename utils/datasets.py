@@ -14,7 +14,14 @@ from PIL import Image, ExifTags
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
+from utils.image_cache import ImageArena, LRUImageCache, arena_path
+from utils.label_cache import check_labels, label_cache_path, load_label_cache, print_label_report
+from utils.manifest import load_manifest
+from utils.shards import ShardIndex
+from utils.targets import match_targets
 from utils.utils import xyxy2xywh, xywh2xyxy
+from utils.warp import affine_targets, flip_matrix, letterbox_matrix, random_affine_matrix, warp_boxes, \
+    warp_image
 import pandas as pd
 
 help_url = 'https://github.com/ultralytics/yolov3/wiki/Train-Custom-Data'
@@ -258,22 +265,33 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
 class LoadImagesAndLabels(Dataset):  # for training/testing
     def __init__(self, path, label_path, img_size=416, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
-                 cache_labels=True, cache_images=False, single_cls=False):
+                 cache_labels=True, cache_images=False, single_cls=False, batch_augment=False, cache_gb=4.0):
+        # cache_images: False, True (decoded images in RAM), 'mmap' (shared ImageArena file next to the image list) or
+        # 'lru' (LRUImageCache of at most cache_gb, filled while loading)
+        # batch_augment: return letterboxed uint8 HWC BGR images, augmented per batch by utils/batch_augment.py
+        # path: image list *.txt, or a *.shards index from utils/shards.py (label_path is then unused)
+        # label_path: label list *.txt, or None for images without labels (i.e. backgrounds), no label files are read
         path = str(Path(path))  # os-agnostic
         assert os.path.isfile(path), 'File not found %s. See %s' % (path, help_url)
-        with open(path, 'r') as f:
-            self.img_files = [x.replace('/', os.sep) for x in f.read().splitlines()  # os-agnostic
-                              if os.path.splitext(x)[-1].lower() in img_formats]
+        self.shards = ShardIndex(path) if path.endswith('.shards') else None
+        if self.shards:
+            self.img_files = self.shards.img_files
+        else:
+            with open(path, 'r') as f:
+                self.img_files = [x.replace('/', os.sep) for x in f.read().splitlines()  # os-agnostic
+                                  if os.path.splitext(x)[-1].lower() in img_formats]
 
         n = len(self.img_files)
         assert n > 0, 'No images found in %s. See %s' % (path, help_url)
-        bi = np.floor(np.arange(n) / batch_size).astype(np.int)  # batch index
+        bi = np.floor(np.arange(n) / batch_size).astype(int)  # batch index
         nb = bi[-1] + 1  # number of batches
 
         self.n = n
+        self.indices = range(n)  # image index of each sample, resampled by train.py for image weights
         self.batch = bi  # batch index of image
         self.img_size = img_size
         self.augment = augment
+        self.batch_augment = augment and batch_augment
         self.hyp = hyp
         self.image_weights = image_weights
         self.rect = False if image_weights else rect
@@ -285,21 +303,49 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         #fixme---yang.xu
         # self.label_files = [x.replace('images', 'labels').replace(os.path.splitext(x)[-1], '.txt')
         #                     for x in self.img_files]
-        with open(label_path, 'r') as f:
-            self.label_files = [x.replace('/', os.sep) for x in f.read().splitlines()  # os-agnostic
-                              if os.path.splitext(x)[-1].lower()=='.txt']
+        if self.shards:
+            self.label_files = self.shards.label_files
+        elif label_path is None:  # images without labels, i.e. backgrounds, no label files are read
+            self.label_files = [None] * n
+        else:
+            with open(label_path, 'r') as f:
+                self.label_files = [x.replace('/', os.sep) for x in f.read().splitlines()  # os-agnostic
+                                  if os.path.splitext(x)[-1].lower()=='.txt']
+
+        # Manifest (wh, box counts, class histograms, image ids), loaded on first use (self.manifest), i.e. rect shapes
+        self._manifest = None
+        self.manifest_args = None if self.shards else \
+            (path, label_path, self.img_files, self.label_files if label_path else [])
+        rows = np.arange(n)  # manifest rows of the images
+
+        # Validate labels, images with malformed label files are dropped before shapes and batches are set
+        cache, cache_files, nbad = None, None, 0
+        if (cache_labels or image_weights) and (self.shards or label_path):
+            if self.shards:
+                cache = self.shards.label_cache()
+            else:
+                cache = load_label_cache(self.label_files, label_cache_path(label_path))  # packed, keyed by path/size/mtime
+            self.label_report = check_labels(cache, self.label_files, ncols=(5,), normalized=True)  # bad files
+            print_label_report(self.label_report)
+            cache_files = self.label_files  # all label files, in cache['labels'] order
+            bad = set(sum(self.label_report.values(), []))
+            if bad:
+                rows = np.array([i for i, f in enumerate(self.label_files) if f not in bad], dtype=np.int64)
+                nbad = n - len(rows)  # images dropped
+                self.img_files = [self.img_files[i] for i in rows]
+                self.label_files = [self.label_files[i] for i in rows]
+                if self.shards:
+                    self.shards.select(rows)
+                n = len(self.img_files)
+                assert n > 0, 'No images with valid labels in %s. See %s' % (path, help_url)
+                bi = np.floor(np.arange(n) / batch_size).astype(int)  # batch index
+                nb = bi[-1] + 1  # number of batches
+                self.n, self.indices, self.batch = n, range(n), bi
 
         # Rectangular Training  https://github.com/ultralytics/yolov3/issues/232
         if self.rect:
-            # Read image shapes (wh)
-            sp = path.replace('.txt', '.shapes')  # shapefile path
-            try:
-                with open(sp, 'r') as f:  # read existing shapefile
-                    s = [x.split() for x in f.read().splitlines()]
-                    assert len(s) == n, 'Shapefile out of sync'
-            except:
-                s = [exif_size(Image.open(f)) for f in tqdm(self.img_files, desc='Reading image shapes')]
-                np.savetxt(sp, s, fmt='%g')  # overwrites existing (if any)
+            # Image shapes (wh)
+            s = self.shards.wh() if self.shards else self.manifest.wh[rows]
 
             # Sort by aspect ratio
             s = np.array(s, dtype=np.float64)
@@ -307,6 +353,8 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             i = ar.argsort()
             self.img_files = [self.img_files[i] for i in i]
             self.label_files = [self.label_files[i] for i in i]
+            if self.shards:
+                self.shards.select(i)
             self.shapes = s[i]  # wh
             ar = ar[i]
 
@@ -320,40 +368,29 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                 elif mini > 1:
                     shapes[i] = [1, 1 / mini]
 
-            self.batch_shapes = np.ceil(np.array(shapes) * img_size / 64.).astype(np.int) * 64
+            self.batch_shapes = np.ceil(np.array(shapes) * img_size / 64.).astype(int) * 64
 
         # Preload labels (required for weighted CE training)
         self.imgs = [None] * n
-        self.labels = [None] * n
-        if cache_labels or image_weights:  # cache labels for faster training
+        self.labels = [None] * n if self.shards or label_path else [np.zeros((0, 5), dtype=np.float32)] * n
+        if cache is not None:  # cache labels for faster training
             self.labels = [np.zeros((0, 5))] * n
             extract_bounding_boxes = False
             create_datasubset = False
-            pbar = tqdm(self.label_files, desc='Caching labels')
-            nm, nf, ne, ns, nd = 0, 0, 0, 0, 0  # number missing, found, empty, datasubset, duplicate
-            for i, file in enumerate(pbar):
-                try:
-                    with open(file, 'r') as f:
-                        # l = np.array([x.split() for x in f.read().splitlines()], dtype=np.float32)
-                        #fixme--yang.xu
-                        # if empty label file, will report an exception
-                        df_txt = pd.read_csv(file, header=None, delimiter=' ')
-                        l = df_txt.to_numpy()
-                        l = l[:, :5]
-                except:
-                    nm += 1  # print('missing labels for image %s' % self.img_files[i])  # file missing
-                    continue
+            nf, nm, ne, nd = cache['counts']  # number found, missing, empty, duplicate
+            nf -= nbad
+            labels = dict(zip(cache_files, cache['labels']))  # by file
+            ns = 0  # number datasubset
+            for i, file in enumerate(self.label_files):
+                l = labels[file]
+                if l is None:
+                    continue  # print('missing labels for image %s' % self.img_files[i])  # file missing
+                l = l[:, :5]
 
                 if l.shape[0]:
-                    assert l.shape[1] == 5, '> 5 label columns: %s' % file
-                    assert (l >= 0).all(), 'negative labels: %s' % file
-                    assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels: %s' % file
-                    if np.unique(l, axis=0).shape[0] < l.shape[0]:  # duplicate rows
-                        nd += 1  # print('WARNING: duplicate rows in %s' % self.label_files[i])  # duplicate rows
                     if single_cls:
                         l[:, 0] = 0  # force dataset into single-class mode
                     self.labels[i] = l
-                    nf += 1  # file found
 
                     # Create subdataset (a smaller dataset)
                     if create_datasubset and ns < 1E4:
@@ -381,23 +418,24 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                             b = x[1:] * [w, h, w, h]  # box
                             b[2:] = b[2:].max()  # rectangle to square
                             b[2:] = b[2:] * 1.3 + 30  # pad
-                            b = xywh2xyxy(b.reshape(-1, 4)).ravel().astype(np.int)
+                            b = xywh2xyxy(b.reshape(-1, 4)).ravel().astype(int)
 
                             b[[0, 2]] = np.clip(b[[0, 2]], 0, w)  # clip boxes outside of image
                             b[[1, 3]] = np.clip(b[[1, 3]], 0, h)
                             assert cv2.imwrite(f, img[b[1]:b[3], b[0]:b[2]]), 'Failure extracting classifier boxes'
-                else:
-                    ne += 1  # print('empty labels for image %s' % self.img_files[i])  # file empty
-                    # os.system("rm '%s' '%s'" % (self.img_files[i], self.label_files[i]))  # remove
 
-                # pbar.desc = 'Caching labels (%g found, %g missing, %g empty, %g duplicate, for %g images)' % (
-                #     nf, nm, ne, nd, n)
-                pbar.desc = 'Caching labels ({} found, {} missing, {} empty, {} duplicate, for {} images)'.format(
-                    nf, nm, ne, nd, n)
+            print('Caching labels ({} found, {} missing, {} empty, {} duplicate, for {} images, {} dropped)'.format(
+                nf, nm, ne, nd, n, nbad))
             assert nf > 0, 'No labels found in %s. See %s' % (os.path.dirname(file) + os.sep, help_url)
 
         # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
-        if cache_images:  # if training
+        if cache_images == 'lru':  # byte-budgeted, shared by the DataLoader workers, filled on first load
+            self.imgs = LRUImageCache(n, cache_gb, (img_size, img_size, 3))
+            self.img_hw0, self.img_hw = self.imgs.hw0, self.imgs.hw
+        elif cache_images == 'mmap':  # shared memory-mapped arena on disk, reused by workers, test loader and later runs
+            self.imgs = ImageArena(arena_path(path, img_size, augment), self.img_files, lambda i: load_image(self, i))
+            self.img_hw0, self.img_hw = self.imgs.hw0, self.imgs.hw
+        elif cache_images:  # if training
             gb = 0  # Gigabytes of cached images
             pbar = tqdm(range(len(self.img_files)), desc='Caching images')
             self.img_hw0, self.img_hw = [None] * n, [None] * n
@@ -416,6 +454,14 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                 except:
                     print('Corrupted image detected: %s' % file)
 
+    @property
+    def manifest(self):
+        # Manifest of the img/lbl lists as read (rows before bad-label drops and sorting), None for shards. Built once
+        # per list pair, so constructing a dataset does not stat or open every image unless this is used
+        if self._manifest is None and self.manifest_args:
+            self._manifest = load_manifest(*self.manifest_args)
+        return self._manifest
+
     def __len__(self):
         return len(self.img_files)
 
@@ -436,12 +482,12 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             shapes = None
 
         else:
-            # Load image
-            img, (h0, w0), (h, w) = load_image(self, index)
+            # Load image, resized and letterboxed below by one fused warp
+            img, (h0, w0), (h, w) = load_image(self, index, resize=False)
 
             # Letterbox
             shape = self.batch_shapes[self.batch[index]] if self.rect else self.img_size  # final letterboxed shape
-            img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
+            M, ratio, pad, shape = letterbox_matrix(img.shape[:2], shape, resized=(h, w), scaleup=self.augment)
             shapes = (h0, w0), ((h / h0, w / w0), pad)  # for COCO mAP rescaling
 
             # Load labels
@@ -450,14 +496,22 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             if x is not None and x.size > 0:
                 # Normalized xywh to pixel xyxy format
                 labels = x.copy()
-                labels[:, 1] = ratio[0] * w * (x[:, 1] - x[:, 3] / 2) + pad[0]  # pad width
-                labels[:, 2] = ratio[1] * h * (x[:, 2] - x[:, 4] / 2) + pad[1]  # pad height
-                labels[:, 3] = ratio[0] * w * (x[:, 1] + x[:, 3] / 2) + pad[0]
-                labels[:, 4] = ratio[1] * h * (x[:, 2] + x[:, 4] / 2) + pad[1]
-
-        if self.augment:
+                labels[:, 1:5] = warp_boxes(xywh2xyxy(x[:, 1:5]) * np.tile(img.shape[1::-1], 2), M)
+
+            interp = cv2.INTER_AREA if M[0, 0] < 1 and not self.augment else cv2.INTER_LINEAR
+            if self.augment and not self.batch_augment:
+                # Augment imagespace: random affine and left-right flip, folded into the letterbox warp
+                A = random_affine_matrix(shape, degrees=hyp['degrees'], translate=hyp['translate'],
+                                         scale=hyp['scale'], shear=hyp['shear'])
+                if random.random() < 0.5:  # random left-right flip
+                    A = flip_matrix(shape[1]) @ A
+                labels = affine_targets(labels, A, shape[1], shape[0])
+                M = A @ M
+            img = warp_image(img, M, shape, interp=interp, copy=self.augment)
+
+        if self.augment and not self.batch_augment:
             # Augment imagespace
-            if not self.mosaic:
+            if self.mosaic:
                 img, labels = random_affine(img, labels,
                                             degrees=hyp['degrees'],
                                             translate=hyp['translate'],
@@ -480,7 +534,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             labels[:, [2, 4]] /= img.shape[0]  # height
             labels[:, [1, 3]] /= img.shape[1]  # width
 
-        if self.augment:
+        if self.augment and not self.batch_augment and self.mosaic:
             # random left-right flip
             lr_flip = True
             if lr_flip and random.random() < 0.5:
@@ -500,6 +554,8 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             labels_out[:, 1:] = torch.from_numpy(labels)
 
         # Convert
+        if self.batch_augment:
+            return torch.from_numpy(np.ascontiguousarray(img)), labels_out, self.img_files[index], shapes  # HWC BGR
         img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
         img = np.ascontiguousarray(img)
 
@@ -513,21 +569,46 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         return torch.stack(img, 0), torch.cat(label, 0), path, shapes
 
 
-def load_image(self, index):
+class TargetCollate:
+    # LoadImagesAndLabels.collate_fn that also assigns the batch targets to the YOLO layers and anchors of model in the
+    # DataLoader workers, appended to the batch as the assigned= argument of compute_loss(). Grids follow the collated
+    # image size, so rect batches work, but not --multi-scale or --batch-augment (targets change after collate)
+    def __init__(self, model, iou_t, nc):
+        m = model.module if hasattr(model, 'module') else model
+        layers = [m.module_list[j] for j in m.yolo_layers]
+        self.anchors = torch.stack([x.anchor_vec for x in layers]).float().cpu()  # (nl, na, 2) grid units
+        self.strides = [x.stride for x in layers]
+        self.iou_t = iou_t  # iou training threshold
+        self.nc = nc
+
+    def __call__(self, batch):
+        img, targets, path, shapes = LoadImagesAndLabels.collate_fn(batch)
+        h, w = img.shape[2:]
+        ng = torch.tensor([(w // s, h // s) for s in self.strides], dtype=targets.dtype)  # (nl, 2) nx, ny
+        return img, targets, path, shapes, match_targets(targets, self.anchors, ng, self.iou_t, self.nc)
+
+
+def load_image(self, index, resize=True):
     # loads 1 image from dataset, returns img, original hw, resized hw
+    # resize=False: returns the image unresized if not cached, left to the fused warp in __getitem__
     img = self.imgs[index]
     if img is None:  # not cached
         img_path = self.img_files[index]
-        img = cv2.imread(img_path)  # BGR
+        img = self.shards.imread(index) if self.shards else cv2.imread(img_path)  # BGR
         assert img is not None, 'Image Not Found ' + img_path
         h0, w0 = img.shape[:2]  # orig hw
         r = self.img_size / max(h0, w0)  # resize image to img_size
+        lru = isinstance(self.imgs, LRUImageCache)
         if r < 1 or (self.augment and r != 1):  # always resize down, only resize up if training with augmentation
+            if not resize and not lru:
+                return img, (h0, w0), (int(h0 * r), int(w0 * r))
             interp = cv2.INTER_AREA if r < 1 and not self.augment else cv2.INTER_LINEAR
             img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=interp)
+        if lru:
+            self.imgs.put(index, img, (h0, w0))
         return img, (h0, w0), img.shape[:2]  # img, hw_original, hw_resized
     else:
-        return self.imgs[index], self.img_hw0[index], self.img_hw[index]  # img, hw_original, hw_resized
+        return img, self.img_hw0[index], self.img_hw[index]  # img, hw_original, hw_resized
 
 
 def augment_hsv(img, hgain=0.5, sgain=0.5, vgain=0.5):
@@ -574,7 +655,7 @@ def load_mosaic(self, index):
 
         # Load labels
         label_path = self.label_files[index]
-        if os.path.isfile(label_path):
+        if label_path and os.path.isfile(label_path):
             x = self.labels[index]
             if x is None:  # labels not preloaded
                 with open(label_path, 'r') as f:
@@ -644,71 +725,20 @@ def letterbox(img, new_shape=(416, 416), color=(114, 114, 114), auto=True, scale
 
 def random_affine(img, targets=(), degrees=10, translate=.1, scale=.1, shear=10, border=0):
     # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
-    # https://medium.com/uruvideo/dataset-augmentation-with-random-homographies-a8f4b44830d4
+    # matrix and label transform in utils/warp.py, shared with the fused LoadImagesAndLabels warp
 
     if targets is None:  # targets = [cls, xyxy]
         targets = []
     height = img.shape[0] + border * 2
     width = img.shape[1] + border * 2
 
-    # Rotation and Scale
-    R = np.eye(3)
-    a = random.uniform(-degrees, degrees)
-    # a += random.choice([-180, -90, 0, 90])  # add 90deg rotations to small rotations
-    s = random.uniform(1 - scale, 1 + scale)
-    R[:2] = cv2.getRotationMatrix2D(angle=a, center=(img.shape[1] / 2, img.shape[0] / 2), scale=s)
-
-    # Translation
-    T = np.eye(3)
-    T[0, 2] = random.uniform(-translate, translate) * img.shape[0] + border  # x translation (pixels)
-    T[1, 2] = random.uniform(-translate, translate) * img.shape[1] + border  # y translation (pixels)
-
-    # Shear
-    S = np.eye(3)
-    S[0, 1] = math.tan(random.uniform(-shear, shear) * math.pi / 180)  # x shear (deg)
-    S[1, 0] = math.tan(random.uniform(-shear, shear) * math.pi / 180)  # y shear (deg)
-
     # Combined rotation matrix
-    M = S @ T @ R  # ORDER IS IMPORTANT HERE!!
+    M = random_affine_matrix(img.shape[:2], degrees, translate, scale, shear, border)
     if (border != 0) or (M != np.eye(3)).any():  # image changed
         img = cv2.warpAffine(img, M[:2], dsize=(width, height), flags=cv2.INTER_LINEAR, borderValue=(114, 114, 114))
 
     # Transform label coordinates
-    n = len(targets)
-    if n:
-        # warp points
-        xy = np.ones((n * 4, 3))
-        xy[:, :2] = targets[:, [1, 2, 3, 4, 1, 4, 3, 2]].reshape(n * 4, 2)  # x1y1, x2y2, x1y2, x2y1
-        xy = (xy @ M.T)[:, :2].reshape(n, 8)
-
-        # create new boxes
-        x = xy[:, [0, 2, 4, 6]]
-        y = xy[:, [1, 3, 5, 7]]
-        xy = np.concatenate((x.min(1), y.min(1), x.max(1), y.max(1))).reshape(4, n).T
-
-        # # apply angle-based reduction of bounding boxes
-        # radians = a * math.pi / 180
-        # reduction = max(abs(math.sin(radians)), abs(math.cos(radians))) ** 0.5
-        # x = (xy[:, 2] + xy[:, 0]) / 2
-        # y = (xy[:, 3] + xy[:, 1]) / 2
-        # w = (xy[:, 2] - xy[:, 0]) * reduction
-        # h = (xy[:, 3] - xy[:, 1]) * reduction
-        # xy = np.concatenate((x - w / 2, y - h / 2, x + w / 2, y + h / 2)).reshape(4, n).T
-
-        # reject warped points outside of image
-        xy[:, [0, 2]] = xy[:, [0, 2]].clip(0, width)
-        xy[:, [1, 3]] = xy[:, [1, 3]].clip(0, height)
-        w = xy[:, 2] - xy[:, 0]
-        h = xy[:, 3] - xy[:, 1]
-        area = w * h
-        area0 = (targets[:, 3] - targets[:, 1]) * (targets[:, 4] - targets[:, 2])
-        ar = np.maximum(w / (h + 1e-16), h / (w + 1e-16))  # aspect ratio
-        i = (w > 4) & (h > 4) & (area / (area0 + 1e-16) > 0.2) & (ar < 10)
-
-        targets = targets[i]
-        targets[:, 1:5] = xy[i]
-
-    return img, targets
+    return img, affine_targets(targets, M, width, height, area_thr=0.2)
 
 
 def cutout(image, labels):
@@ -1,4 +1,5 @@
 import glob
+import json
 import math
 import os
 import random
@@ -15,7 +16,13 @@ from torch.utils.data import Dataset
 from tqdm import tqdm
 import pandas as pd
 
+from utils.image_cache import ImageArena, LRUImageCache, arena_path
+from utils.label_cache import check_labels, label_cache_path, load_label_cache, print_label_report
+from utils.manifest import load_manifest
+from utils.shards import ShardIndex
 from utils.utils_xview import xyxy2xywh, xywh2xyxy
+from utils.warp import affine_targets, flip_matrix, letterbox_matrix, random_affine_matrix, warp_boxes, \
+    warp_image
 
 help_url = 'https://github.com/ultralytics/yolov3/wiki/Train-Custom-Data'
 img_formats = ['.bmp', '.jpg', '.jpeg', '.png', '.tif', '.dng']
@@ -263,30 +270,49 @@ class LoadStreams:  # multiple IP or RTSP cameras
         return 0  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
 
+def img_id_map(path, img_files):
+    # {image name: id} of the xview_val*_img_id_map.json next to the image list path (the ids of
+    # test_xview.get_val_imgid_by_name()) if it covers all img_files, else None (manifest ids are then list rows)
+    for f in glob.glob(os.path.join(os.path.dirname(path), 'xview_val*_img_id_map.json')):
+        with open(f) as fp:
+            m = json.load(fp)
+        if all(os.path.basename(x) in m for x in img_files):
+            return m
+    return None
+
+
 class LoadImagesAndLabels(Dataset):  # for training/testing
     def __init__(self, path, label_path, img_size=608, batch_size=8, class_num=60, augment=False, hyp=None, rect=False, image_weights=False,
-                 cache_labels=False, cache_images=False, with_modelid=False):
+                 cache_labels=False, cache_images=False, with_modelid=False, cache_gb=4.0):
+        # cache_images: False, True (decoded images in RAM), 'mmap' (shared ImageArena file next to the image list) or
+        # 'lru' (LRUImageCache of at most cache_gb, filled while loading)
+        # path: image list *.txt, or a *.shards index from utils/shards.py (label_path is then unused)
         #fixme
         path = str(Path(path))  # os-agnostic
         assert os.path.isfile(path), 'File not found %s. See %s' % (path, help_url)
-        with open(path, 'r') as f:
-            self.img_files = [x.replace('/', os.sep) for x in f.read().splitlines()  # os-agnostic
-                              if os.path.splitext(x)[-1].lower() in img_formats]
-            # img_names = [os.path.basename(f) for f in self.img_files]
-        #fixme---lbl_formats
-        with open(label_path, 'r') as f:
-            self.lbl_files = [x.replace('/', os.sep) for x in f.read().splitlines()  # os-agnostic
-                              if os.path.splitext(x)[-1].lower() in lbl_formats]
+        self.shards = ShardIndex(path) if path.endswith('.shards') else None
+        if self.shards:
+            self.img_files, self.lbl_files = self.shards.img_files, self.shards.label_files
+        else:
+            with open(path, 'r') as f:
+                self.img_files = [x.replace('/', os.sep) for x in f.read().splitlines()  # os-agnostic
+                                  if os.path.splitext(x)[-1].lower() in img_formats]
+                # img_names = [os.path.basename(f) for f in self.img_files]
+            #fixme---lbl_formats
+            with open(label_path, 'r') as f:
+                self.lbl_files = [x.replace('/', os.sep) for x in f.read().splitlines()  # os-agnostic
+                                  if os.path.splitext(x)[-1].lower() in lbl_formats]
 
         self.label_files = self.lbl_files
         n = len(self.img_files)
         # print('self.img_files', self.img_files)
         assert n > 0, 'No images found in %s. See %s' % (path, help_url)
-        bi = np.floor(np.arange(n) / batch_size).astype(np.int)  # batch index
+        bi = np.floor(np.arange(n) / batch_size).astype(int)  # batch index
         nb = bi[-1] + 1  # number of batches
 
         self.batch_size = batch_size
         self.n = n
+        self.indices = range(n)  # image index of each sample, resampled by the training script for image weights
         self.batch = bi  # batch index of image
         self.img_size = img_size
         self.augment = augment
@@ -299,17 +325,41 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         # self.label_files = [x.replace('images', 'labels').replace(os.path.splitext(x)[-1], '.txt')
         #                     for x in self.img_files]
 
+        # Manifest (wh, box counts, class/model-id histograms, image ids), loaded on first use (self.manifest), i.e.
+        # rect shapes
+        self._manifest = None
+        self.manifest_args = None if self.shards else (path, label_path, self.img_files, self.lbl_files)
+        rows = np.arange(n)  # manifest rows of the images
+
+        # Validate labels, images with malformed label files are dropped before shapes and batches are set
+        cache, cache_files, nbad = None, None, 0
+        if cache_labels or image_weights or self.shards:  # shard labels are already in memory
+            if self.shards:
+                cache = self.shards.label_cache()
+            else:
+                cache = load_label_cache(self.label_files, label_cache_path(label_path))  # packed, keyed by path/size/mtime
+            self.label_report = check_labels(cache, self.label_files, ncols=(5, 6) if with_modelid else (5,),
+                                             normalized=False, extra=with_modelid)  # bad files
+            print_label_report(self.label_report)
+            cache_files = self.label_files  # all label files, in cache['labels'] order
+            bad = set(sum(self.label_report.values(), []))
+            if bad:
+                rows = np.array([i for i, f in enumerate(self.label_files) if f not in bad], dtype=np.int64)
+                nbad = n - len(rows)  # images dropped
+                self.img_files = [self.img_files[i] for i in rows]
+                self.label_files = self.lbl_files = [self.label_files[i] for i in rows]
+                if self.shards:
+                    self.shards.select(rows)
+                n = len(self.img_files)
+                assert n > 0, 'No images with valid labels in %s. See %s' % (path, help_url)
+                bi = np.floor(np.arange(n) / batch_size).astype(int)  # batch index
+                nb = bi[-1] + 1  # number of batches
+                self.n, self.indices, self.batch = n, range(n), bi
+
         # Rectangular Training  https://github.com/ultralytics/yolov3/issues/232
         if self.rect:
-            # Read image shapes
-            sp = path.replace('.txt', '.shapes')  # shapefile path
-            try:
-                with open(sp, 'r') as f:  # read existing shapefile
-                    s = [x.split() for x in f.read().splitlines()]
-                    assert len(s) == n, 'Shapefile out of sync'
-            except:
-                s = [exif_size(Image.open(f)) for f in tqdm(self.img_files, desc='Reading image shapes')] # h w
-                np.savetxt(sp, s, fmt='%g')  # overwrites existing (if any)
+            # Image shapes (wh)
+            s = self.shards.wh() if self.shards else self.manifest.wh[rows]
 
             # Sort by aspect ratio
             s = np.array(s, dtype=np.float64)
@@ -318,6 +368,8 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             self.img_files = [self.img_files[i] for i in i]
             self.label_files = [self.lbl_files[i] for i in i]
             # print('label_files', self.label_files)
+            if self.shards:
+                self.shards.select(i)
             self.shapes = s[i]
             ar = ar[i]
 
@@ -331,12 +383,12 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                 elif mini > 1:
                     shapes[i] = [1, 1 / mini]
 
-            self.batch_shapes = np.ceil(np.array(shapes) * img_size / 32.).astype(np.int) * 32
+            self.batch_shapes = np.ceil(np.array(shapes) * img_size / 32.).astype(int) * 32
 
         # Preload labels (required for weighted CE training)
         self.imgs = [None] * n
         self.labels = [None] * n
-        if cache_labels or image_weights:  # cache labels for faster training
+        if cache is not None:  # cache labels for faster training
             #fixme yang.xu
             # self.labels = [np.zeros((0, 5))] * n
             if self.with_modelid:
@@ -344,47 +396,25 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             else:
                 self.labels = [np.zeros((0, 5))] * n
 
-            pbar = tqdm(self.label_files, desc='Caching labels')
-
             extract_bounding_boxes = False
             create_datasubset = False
 
-            nm, nf, ne, ns, nd = 0, 0, 0, 0, 0  # number missing, found, empty, datasubset, duplicate
-            for i, file in enumerate(pbar):
-                try:
-                    # with open(file, 'r') as f:
-                    #     l = np.array([x.split() for x in f.read().splitlines()], dtype=np.float32)
-                    # print(file)
-
-                    #fixme if empty label file, will report an exception
-                    df_txt = pd.read_csv(file, header=None, delimiter=' ')
-                    #fixme
-                    l = df_txt.to_numpy()
-                    # print(l.shape)
-                    #fixme yang.xu
-                    # l = l[:, :5]
-                    if not with_modelid:
-                        l = l[:, :5]
-
-                except:
-                    nm += 1
+            nf, nm, ne, nd = cache['counts']  # number found, missing, empty, duplicate
+            nf += nm  # missing label files are kept as a single zero label below
+            nf -= nbad
+            labels = dict(zip(cache_files, cache['labels']))  # by file
+            ns = 0  # number datasubset
+            for i, file in enumerate(self.label_files):
+                l = labels[file]
+                if l is None:
                     #fixme --yang.xu to deal with empty labels
-                    # continue
                     l = np.zeros((1, 5))
                     # print('missing labels for image %s' % self.img_files[i])  # file missing
-
+                elif not with_modelid:
+                    l = l[:, :5]
 
                 if l.shape[0]:
-                    #fixme -- yang.xu
-                    assert l.shape[1] == 5 or l.shape[1] == 6, '> 5 label columns: %s' % file
-                    assert (l >= 0).all(), 'negative labels: %s' % file
-                    #fixme
-                    # assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels: %s' % file
-                    if np.unique(l, axis=0).shape[0] < l.shape[0]:  # duplicate rows
-                        nd += 1  # print('WARNING: duplicate rows in %s' % self.label_files[i])  # duplicate rows
-
                     self.labels[i] = l
-                    nf += 1  # file found
 
                     # Create subdataset (a smaller dataset)
                     if create_datasubset and ns < 1E4:
@@ -412,21 +442,28 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                             b = x[1:] * np.array([w, h, w, h])  # box
                             b[2:] = b[2:].max()  # rectangle to square
                             b[2:] = b[2:] * 1.3 + 30  # pad
-                            b = xywh2xyxy(b.reshape(-1, 4)).ravel().astype(np.int)
+                            b = xywh2xyxy(b.reshape(-1, 4)).ravel().astype(int)
 
                             b[[0, 2]] = np.clip(b[[0, 2]], 0, w)  # clip boxes outside of image
                             b[[1, 3]] = np.clip(b[[1, 3]], 0, h)
                             assert cv2.imwrite(f, img[b[1]:b[3], b[0]:b[2]]), 'Failure extracting classifier boxes'
                 else:
-                    ne += 1
                     print('empty labels for image %s' % self.img_files[i])  # file empty
                     # os.system("rm '%s' '%s'" % (self.img_files[i], self.label_files[i]))  # remove
-                pbar.desc = 'Caching labels (%g found, %g missing, %g empty, %g duplicate, for %g images)' % (
-                    nf, nm, ne, nd, n)
+            print('Caching labels (%g found, %g missing, %g empty, %g duplicate, for %g images, %g dropped)' %
+                  (nf, nm, ne, nd, n, nbad))
             assert nf > 0, 'No labels found. See %s' % help_url
 
         # Cache images into memory for faster training (WARNING: Large datasets may exceed system RAM)
-        if cache_images:  # if training
+        if cache_images == 'lru':  # byte-budgeted, shared by the DataLoader workers, filled on first load
+            self.imgs = LRUImageCache(n, cache_gb, (img_size, img_size, 3))
+        elif cache_images == 'mmap':  # shared memory-mapped arena on disk, reused by workers, test loader and later runs
+            def load_fn(i):
+                img = load_image(self, i)
+                return img, img.shape[:2], img.shape[:2]
+
+            self.imgs = ImageArena(arena_path(path, img_size, augment), self.img_files, load_fn)
+        elif cache_images:  # if training
             gb = 0  # Gigabytes of cached images
             pbar = tqdm(range(len(self.img_files)), desc='Caching images')
             for i in pbar:  # max 10k images
@@ -446,6 +483,15 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                     print('Corrupted image detected: %s' % file)
         # print('self.lables[0]', self.labels[0])
 
+    @property
+    def manifest(self):
+        # Manifest of the img/lbl lists as read (rows before bad-label drops and sorting), None for shards. Built once
+        # per list pair, so constructing a dataset does not stat or open every image unless this is used
+        if self._manifest is None and self.manifest_args:
+            path, label_path, img_files, lbl_files = self.manifest_args
+            self._manifest = load_manifest(path, label_path, img_files, lbl_files, img_id_map(path, img_files))
+        return self._manifest
+
     def __len__(self):
         return len(self.img_files)
 
@@ -473,21 +519,20 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             ratio, pad = None, None
 
         else:
-            # Load image
-            img = load_image(self, index)
+            # Load image, resized and letterboxed below by one fused warp
+            img, (h, w) = load_image(self, index, resize=False)
             # print(img.shape)
 
             # Letterbox
-            h, w = img.shape[:2]
-            # print('after resize', img.shape)
             shape = self.batch_shapes[self.batch[index]] if self.rect else self.img_size  # final letterboxed shape
             # print('shape', shape)
-            img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
+            M, ratio, pad, shape = letterbox_matrix(img.shape[:2], shape, resized=(h, w), scaleup=self.augment,
+                                                    square=True)
             # print('ratio, w, h', ratio, w, h)
 
             # Load labels
             labels = []
-            if os.path.isfile(label_path):
+            if self.shards or os.path.isfile(label_path):  # shard labels are preloaded
                 x = self.labels[index]
                 if x is None:  # labels not preloaded
                     with open(label_path, 'r') as f:
@@ -496,25 +541,31 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                 if x.size > 0: #
                     # Normalized xywh to pixel xyxy format
                     labels = x.copy()
-                    labels[:, 1] = ratio[0] * w * (x[:, 1] - x[:, 3] / 2) + pad[0]  # pad width
-                    labels[:, 2] = ratio[1] * h * (x[:, 2] - x[:, 4] / 2) + pad[1]  # pad height
-                    labels[:, 3] = ratio[0] * w * (x[:, 1] + x[:, 3] / 2) + pad[0]
-                    labels[:, 4] = ratio[1] * h * (x[:, 2] + x[:, 4] / 2) + pad[1]
+                    labels[:, 1:5] = warp_boxes(xywh2xyxy(x[:, 1:5]) * np.tile(img.shape[1::-1], 2), M)
+
+            if self.augment:
+                # Augment imagespace: random affine and left-right flip, folded into the letterbox warp
+                A = random_affine_matrix(shape, degrees=hyp['degrees'], translate=hyp['translate'],
+                                         scale=hyp['scale'], shear=hyp['shear'])
+                if random.random() < 0.5:  # random left-right flip
+                    A = flip_matrix(shape[1]) @ A
+                labels = affine_targets(labels, A, shape[1], shape[0], area_thr=0.1)
+                #fixme--yang.xu to deal with the empty labels
+                # if len(img) and not len(labels):
+                #     labels = np.zeros((1, 5))
+                M = A @ M
+            img = warp_image(img, M, shape, color=(128, 128, 128),
+                             interp=cv2.INTER_LINEAR if self.augment else cv2.INTER_AREA, copy=self.augment)
 
         # print(labels[0])
         if self.augment:
             # Augment imagespace
-            if not mosaic:
+            if mosaic:
                 img, labels = random_affine(img, labels,
                                             degrees=hyp['degrees'],
                                             translate=hyp['translate'],
                                             scale=hyp['scale'],
                                             shear=hyp['shear'])
-                #fixme--yang.xu to deal with the empty labels
-                # print('img', len(img))
-                # print('labels', labels)
-                # if len(img) and not len(labels):
-                #     labels = np.zeros((1, 5))
 
             # Augment colorspace
             augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
@@ -532,7 +583,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             labels[:, [2, 4]] /= img.shape[0]  # height
             labels[:, [1, 3]] /= img.shape[1]  # width
 
-        if self.augment:
+        if self.augment and mosaic:
             # random left-right flip
             lr_flip = True
             if lr_flip and random.random() < 0.5:
@@ -571,20 +622,26 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         return torch.stack(img, 0), torch.cat(label, 0), path, shapes
 
 
-def load_image(self, index):
+def load_image(self, index, resize=True):
     # loads 1 image from dataset
+    # resize=False: returns img, resized hw with the image unresized if not cached, for the fused warp in __getitem__
     # print(index)
     img = self.imgs[index]
     if img is None:
         img_path = self.img_files[index]
-        img = cv2.imread(img_path)  # BGR
+        img = self.shards.imread(index) if self.shards else cv2.imread(img_path)  # BGR
         # print('load_img', img.shape)
         assert img is not None, 'Image Not Found ' + img_path
         r = self.img_size / max(img.shape)  # resize image to img_size
+        h, w = img.shape[:2]
+        lru = isinstance(self.imgs, LRUImageCache)
         if self.augment and (r != 1):  # always resize down, only resize up if training with augmentation
-            h, w = img.shape[:2]
-            return cv2.resize(img, (int(w * r), int(h * r)), interpolation=cv2.INTER_LINEAR)  # _LINEAR fastest
-    return img
+            if not resize and not lru:
+                return img, (int(h * r), int(w * r))
+            img = cv2.resize(img, (int(w * r), int(h * r)), interpolation=cv2.INTER_LINEAR)  # _LINEAR fastest
+        if lru:
+            self.imgs.put(index, img, (h, w))
+    return img if resize else (img, img.shape[:2])
 
 
 def augment_hsv(img, hgain=0.5, sgain=0.5, vgain=0.5):
@@ -626,7 +683,7 @@ def load_mosaic(self, index):
 
         # Load labels
         label_path = self.label_files[index]
-        if os.path.isfile(label_path):
+        if self.shards or os.path.isfile(label_path):
             x = self.labels[index]
             if x is None:  # labels not preloaded
                 with open(label_path, 'r') as f:
@@ -698,72 +755,20 @@ def letterbox(img, new_shape=(416, 416), color=(128, 128, 128),
 
 def random_affine(img, targets=(), degrees=10, translate=.1, scale=.1, shear=10, border=0):
     # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
-    # https://medium.com/uruvideo/dataset-augmentation-with-random-homographies-a8f4b44830d4
+    # matrix and label transform in utils/warp.py, shared with the fused LoadImagesAndLabels warp
 
     if targets is None:  # targets = [cls, xyxy]
         targets = []
     height = img.shape[0] + border * 2
     width = img.shape[1] + border * 2
 
-    # Rotation and Scale
-    R = np.eye(3)
-    a = random.uniform(-degrees, degrees)
-    # a += random.choice([-180, -90, 0, 90])  # add 90deg rotations to small rotations
-    s = random.uniform(1 - scale, 1 + scale)
-    R[:2] = cv2.getRotationMatrix2D(angle=a, center=(img.shape[1] / 2, img.shape[0] / 2), scale=s)
-
-    # Translation
-    T = np.eye(3)
-    T[0, 2] = random.uniform(-translate, translate) * img.shape[0] + border  # x translation (pixels)
-    T[1, 2] = random.uniform(-translate, translate) * img.shape[1] + border  # y translation (pixels)
-
-    # Shear
-    S = np.eye(3)
-    S[0, 1] = math.tan(random.uniform(-shear, shear) * math.pi / 180)  # x shear (deg)
-    S[1, 0] = math.tan(random.uniform(-shear, shear) * math.pi / 180)  # y shear (deg)
-
     # Combined rotation matrix
-    M = S @ T @ R  # ORDER IS IMPORTANT HERE!!
-    changed = (border != 0) or (M != np.eye(3)).any()
-    if changed:
+    M = random_affine_matrix(img.shape[:2], degrees, translate, scale, shear, border)
+    if (border != 0) or (M != np.eye(3)).any():  # image changed
         img = cv2.warpAffine(img, M[:2], dsize=(width, height), flags=cv2.INTER_AREA, borderValue=(128, 128, 128))
 
     # Transform label coordinates
-    n = len(targets)
-    if n:
-        # warp points
-        xy = np.ones((n * 4, 3))
-        xy[:, :2] = targets[:, [1, 2, 3, 4, 1, 4, 3, 2]].reshape(n * 4, 2)  # x1y1, x2y2, x1y2, x2y1
-        xy = (xy @ M.T)[:, :2].reshape(n, 8)
-
-        # create new boxes
-        x = xy[:, [0, 2, 4, 6]]
-        y = xy[:, [1, 3, 5, 7]]
-        xy = np.concatenate((x.min(1), y.min(1), x.max(1), y.max(1))).reshape(4, n).T
-
-        # # apply angle-based reduction of bounding boxes
-        # radians = a * math.pi / 180
-        # reduction = max(abs(math.sin(radians)), abs(math.cos(radians))) ** 0.5
-        # x = (xy[:, 2] + xy[:, 0]) / 2
-        # y = (xy[:, 3] + xy[:, 1]) / 2
-        # w = (xy[:, 2] - xy[:, 0]) * reduction
-        # h = (xy[:, 3] - xy[:, 1]) * reduction
-        # xy = np.concatenate((x - w / 2, y - h / 2, x + w / 2, y + h / 2)).reshape(4, n).T
-
-        # reject warped points outside of image
-        xy[:, [0, 2]] = xy[:, [0, 2]].clip(0, width)
-        xy[:, [1, 3]] = xy[:, [1, 3]].clip(0, height)
-        w = xy[:, 2] - xy[:, 0]
-        h = xy[:, 3] - xy[:, 1]
-        area = w * h
-        area0 = (targets[:, 3] - targets[:, 1]) * (targets[:, 4] - targets[:, 2])
-        ar = np.maximum(w / (h + 1e-16), h / (w + 1e-16))  # aspect ratio
-        i = (w > 4) & (h > 4) & (area / (area0 + 1e-16) > 0.1) & (ar < 10)
-
-        targets = targets[i]
-        targets[:, 1:5] = xy[i]
-
-    return img, targets
+    return img, affine_targets(targets, M, width, height, area_thr=0.1)
 
 
 def cutout(image, labels):
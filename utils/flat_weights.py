@@ -0,0 +1,96 @@
+import json
+import os
+import struct
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import torch
+
+FLAT_MAGIC = b'YOLOFLAT'
+FLAT_VERSION = 1
+FLAT_ALIGN = 64  # tensor data alignment (bytes)
+
+
+def save_flat(state_dict, path, meta=None):
+    """
+    Writes a state_dict as a flat weights file: magic, version, header length, json header (meta and per tensor name,
+    dtype, shape, offset), then the raw tensors, each FLAT_ALIGN aligned. No pickle, so it loads by mmap, see load_flat()
+    meta: small json-able checkpoint info, i.e. {'epoch': 272, 'best_fitness': 0.61}
+    """
+    tensors, offset = [], 0
+    arrays = [(k, v.detach().cpu().contiguous().numpy()) for k, v in state_dict.items()]
+    for k, a in arrays:
+        tensors.append([k, a.dtype.str, list(a.shape), offset])
+        offset += -(-a.nbytes // FLAT_ALIGN) * FLAT_ALIGN
+    header = json.dumps({'meta': meta or {}, 'tensors': tensors}).encode()
+    start = -(-(16 + len(header)) // FLAT_ALIGN) * FLAT_ALIGN  # data start
+    header += b' ' * (start - 16 - len(header))
+
+    tmp = '%s.%g.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(FLAT_MAGIC + struct.pack('<II', FLAT_VERSION, len(header)) + header)
+        for (k, a), (_, _, _, o) in zip(arrays, tensors):
+            f.seek(start + o)
+            f.write(a.tobytes())
+        f.truncate(start + offset)
+    os.replace(tmp, path)  # atomic
+
+
+def load_flat(path):
+    # Returns (state_dict, meta) of a save_flat() file. Tensors are zero-copy views of a copy-on-write mmap of the file,
+    # pages are read on first use and writes (i.e. training) stay in memory
+    with open(path, 'rb') as f:
+        magic, (version, n) = f.read(8), struct.unpack('<II', f.read(8))
+        assert magic == FLAT_MAGIC, '%s is not a flat weights file' % path
+        assert version == FLAT_VERSION, 'flat weights version %g not supported' % version
+        header = json.loads(f.read(n))
+    start = -(-(16 + n) // FLAT_ALIGN) * FLAT_ALIGN
+    mm = np.memmap(path, dtype=np.uint8, mode='c')
+    state_dict = OrderedDict()
+    for k, dtype, shape, o in header['tensors']:
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        state_dict[k] = torch.from_numpy(mm[start + o:start + o + nbytes].view(dtype).reshape(shape))
+    return state_dict, header['meta']
+
+
+def load_flat_weights(model, path):
+    # Loads a flat weights file into model, CPU parameters and buffers become views of the file (no copy), returns meta
+    state_dict, meta = load_flat(path)
+    tensors = OrderedDict(model.named_parameters())
+    tensors.update(model.named_buffers())
+    missing = set(tensors) - set(state_dict)
+    assert not missing, '%s is missing %s' % (path, ', '.join(sorted(missing)[:5]))
+    for k, v in state_dict.items():
+        t = tensors[k]
+        assert t.shape == v.shape, '%s: %s shape %s, model %s' % (path, k, tuple(v.shape), tuple(t.shape))
+        if t.device.type == 'cpu' and t.dtype == v.dtype:
+            t.data = v
+        else:
+            t.data.copy_(v)
+    return meta
+
+
+def convert_flat(weights, cfg=None, path=None):
+    """
+    Converts a *.pt checkpoint or *.weights file (needs its cfg) to *.flat next to it (or path), i.e.
+    from utils.flat_weights import *; [convert_flat(f) for f in glob.glob('weights/**/best*.pt', recursive=True)]
+    """
+    path = path or str(Path(weights).with_suffix('.flat'))
+    if weights.endswith('.pt'):  # pytorch format, model and checkpoint info only (no optimizer, training_results)
+        chkpt = torch.load(weights, map_location='cpu')
+        meta = {k: chkpt.get(k) for k in ('epoch', 'best_fitness')}
+        meta['best_fitness'] = None if meta['best_fitness'] is None else float(meta['best_fitness'])
+        save_flat(chkpt['model'], path, meta)
+    elif weights.endswith('.weights'):  # darknet format
+        from models import Darknet, load_darknet_weights
+        assert cfg, 'converting *.weights needs cfg'
+        model = Darknet(cfg)
+        load_darknet_weights(model, weights)
+        save_flat(model.state_dict(), path, {'version': model.version.tolist(), 'seen': int(model.seen[0])})
+    else:
+        print('Error: extension not supported.')
+        return
+    print("Success: converted '%s' to '%s'" % (weights, path))
+    return path
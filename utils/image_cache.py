@@ -0,0 +1,231 @@
+import os
+import weakref
+from multiprocessing import shared_memory
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from utils.label_cache import file_stat
+
+ARENA_VERSION = 1
+
+
+def arena_path(path, img_size, augment=False):
+    # Image arena for an image list, i.e. 'xview_train_img.txt' at 608 -> 'xview_train_img_608.arena'
+    p = Path(path)
+    return str(p.with_name('%s_%g%s.arena' % (p.stem, img_size, '_aug' if augment else '')))
+
+
+class ImageArena:
+    """
+    Decoded, resized uint8 images packed in one memory-mapped file with an offset/shape index (<arena>.index).
+    The file is mapped read-only, so forked DataLoader workers, train and test datasets and later runs on the same
+    image list share the same page cache pages instead of each holding a copy. Indexed by dataset image index.
+    """
+
+    def __init__(self, path, img_files, load_fn=None, workers=8):
+        self.path, self.index_path = path, path + '.index'
+        self.img_files = img_files
+        if not self.valid():
+            assert load_fn is not None, 'Image arena %s missing or stale' % path
+            self.build(load_fn, workers)
+        self.open()
+
+    def valid(self):
+        # Arena is valid if it indexes every image at its current size and mtime
+        try:
+            x = np.load(self.index_path, allow_pickle=False)
+            index = {f: j for j, f in enumerate(x['files'].tolist())}
+            slot = np.array([index[f] for f in self.img_files])
+            stat = np.array([file_stat(f) for f in self.img_files], dtype=np.int64)
+            return int(x['version']) == ARENA_VERSION and (x['stat'][slot] == stat).all() and \
+                   os.path.getsize(self.path) == int(x['nbytes'])
+        except Exception:
+            return False
+
+    def build(self, load_fn, workers=8):
+        # Decodes all images with load_fn(i) -> (img, hw0, hw) and streams them into the arena file
+        n = len(self.img_files)
+        offsets, shapes, hw0 = np.zeros(n + 1, dtype=np.int64), np.zeros((n, 3), dtype=np.int64), []
+        tmp = '%s.%g.tmp' % (self.path, os.getpid())
+        with open(tmp, 'wb') as f, ThreadPool(workers) as pool:  # cv2 decode releases the GIL
+            pbar = tqdm(enumerate(pool.imap(load_fn, range(n))), total=n, desc='Caching images (arena)')
+            for i, (img, h0w0, _) in pbar:
+                img = np.ascontiguousarray(img)
+                shapes[i] = img.shape if img.ndim == 3 else img.shape + (1,)
+                hw0.append(h0w0)
+                f.write(img.data)
+                offsets[i + 1] = offsets[i] + img.nbytes
+                pbar.desc = 'Caching images (arena %.1fGB)' % (offsets[i + 1] / 1E9)
+        os.replace(tmp, self.path)
+        with open(tmp, 'wb') as f:
+            np.savez(f, version=ARENA_VERSION, files=np.array(self.img_files, dtype=str), offsets=offsets,
+                     shapes=shapes, hw0=np.array(hw0, dtype=np.int64).reshape(n, 2), nbytes=offsets[-1],
+                     stat=np.array([file_stat(x) for x in self.img_files], dtype=np.int64).reshape(n, 2))
+        os.replace(tmp, self.index_path)
+
+    def open(self):
+        x = np.load(self.index_path, allow_pickle=False)
+        index = {f: j for j, f in enumerate(x['files'].tolist())}
+        slot = np.array([index[f] for f in self.img_files], dtype=np.int64)  # dataset index -> arena slot
+        self.offsets, self.shapes = x['offsets'][slot], x['shapes'][slot]
+        self.hw0 = [tuple(s) for s in x['hw0'][slot].tolist()]  # original hw
+        self.hw = [tuple(s[:2]) for s in self.shapes.tolist()]  # resized hw
+        self.nbytes = int(x['nbytes'])
+        self.mm = np.memmap(self.path, dtype=np.uint8, mode='r') if self.nbytes else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.img_files)
+
+    def __getitem__(self, i):
+        # Zero-copy read-only view of image i
+        h, w, c = self.shapes[i]
+        img = self.mm[self.offsets[i]:self.offsets[i] + h * w * c]
+        return img.reshape(h, w, c) if c > 1 else img.reshape(h, w)
+
+    def __getstate__(self):  # pickled to spawned DataLoader workers without the mapping, which is reopened there
+        d = self.__dict__.copy()
+        d['mm'] = None
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.mm = np.memmap(self.path, dtype=np.uint8, mode='r') if self.nbytes else np.zeros(0, dtype=np.uint8)
+
+
+def unlink_shared(shm, pid):
+    # Unlinks a shared memory block in the process that created it only, forked workers inherit its finalizer
+    if os.getpid() == pid:
+        shm.unlink()
+
+
+class Rows:
+    # Tuple rows of a 2D array, i.e. LRUImageCache.hw0[i] -> (h0, w0) like ImageArena.hw0[i]
+    def __init__(self, x):
+        self.x = x
+
+    def __getitem__(self, i):
+        return tuple(self.x[i].tolist())
+
+
+class LRUImageCache:
+    """
+    Decoded, resized images kept within a byte budget of shared memory, filled on first load, i.e.
+    LoadImagesAndLabels(..., cache_images='lru', cache_gb=8) for image lists too large for cache_images=True/'mmap'.
+    The budget is cut into image-sized slots in one named shared memory block (/dev/shm), inherited by forked and
+    reattached by spawned DataLoader workers. All workers read every slot, and each worker writes (evicts from) its own
+    share of them. Eviction is GreedyDual: the slot with the lowest clock + value goes, where
+    value = times the image was loaded + set_priority() weight, so frequently (image-weighted) resampled images outlive
+    images drawn once, and the least recently used go first among equals. Hits, misses and evictions are counted per
+    process (no shared read-modify-writes) and summed over workers by summary() to size the budget.
+    """
+
+    def __init__(self, n, budget_gb, max_shape):
+        # n: dataset images, max_shape: largest cached (resized) image hwc, larger images are never cached
+        self.slot_bytes = int(np.prod(max_shape))
+        self.nslots = int(min(n, budget_gb * 1E9 // self.slot_bytes))
+        self.nbytes = self.nslots * self.slot_bytes  # reserved, pages are only used once written
+        self.layout = [('slab', (self.nslots, self.slot_bytes), np.uint8, 0),
+                       ('owner', self.nslots, np.int64, -1),  # slot -> image
+                       ('version', self.nslots, np.int64, 0),  # odd while a slot is being written
+                       ('score', self.nslots, np.float64, 0),  # eviction order, lowest first
+                       ('slot', n, np.int64, -1),  # image -> slot
+                       ('shape', (n, 3), np.int64, 0),  # cached image hwc
+                       ('orig', (n, 2), np.int64, 0),  # original hw
+                       ('freq', n, np.float64, 0),  # loads per image
+                       ('prio', n, np.float64, 0),  # set_priority() weights
+                       ('stats', (65, 3), np.int64, 0)]  # hits, misses, evictions of the main process and 64 workers
+        size = sum(-(-np.prod(shape) * np.dtype(t).itemsize // 64) * 64 for _, shape, t, _ in self.layout)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(int(size), 1))  # zeroed
+        weakref.finalize(self, unlink_shared, self.shm, os.getpid())
+        self.views(fill=True)
+        self.clock = 0.0  # GreedyDual clock of this process, score of the last eviction
+        self.pid, self.row, self.mine = None, 0, None  # process, its stats row and the slots it writes
+
+    def views(self, fill=False):
+        # numpy arrays of self.layout in the shared memory block, 64-byte aligned
+        o = 0
+        for name, shape, dtype, value in self.layout:
+            x = np.ndarray(shape, dtype, buffer=self.shm.buf, offset=o)
+            if fill and value:
+                x[:] = value
+            setattr(self, name, x)
+            o += -(-x.nbytes // 64) * 64
+        self.hw0, self.hw = Rows(self.orig), Rows(self.shape[:, :2])  # original, resized hw of cached images
+
+    def __len__(self):
+        return len(self.slot)
+
+    def worker(self):
+        # Stats row and written slots of this process, set on first use in each DataLoader worker
+        if self.pid != os.getpid():
+            info = torch.utils.data.get_worker_info()
+            k, nw = (info.id, info.num_workers) if info else (0, 1)
+            self.pid, self.row, self.mine = os.getpid(), 1 + k % 64 if info else 0, np.arange(k, self.nslots, nw)
+        return self.row
+
+    def __getitem__(self, i):
+        # Copy of image i if cached, else None (load it and put() it)
+        row = self.worker()
+        self.freq[i] += 1
+        s = self.slot[i]
+        if s >= 0:
+            v = self.version[s]
+            if v % 2 == 0 and self.owner[s] == i:
+                h, w, c = self.shape[i]
+                img = self.slab[s, :h * w * c].reshape(h, w, c).copy()
+                if self.version[s] == v and self.owner[s] == i:  # not replaced while copying
+                    self.score[s] = self.clock + self.freq[i] + self.prio[i]
+                    self.stats[row, 0] += 1
+                    return img
+        self.stats[row, 1] += 1
+        return None
+
+    def put(self, i, img, hw0):
+        # Caches image i (original hw hw0) in this process' lowest scoring slot
+        row = self.worker()
+        if img.nbytes > self.slot_bytes or not len(self.mine):
+            return
+        if self.slot[i] >= 0 and self.owner[self.slot[i]] == i:  # cached meanwhile by another worker
+            return
+
+        s = self.mine[np.where(self.owner[self.mine] < 0, -np.inf, self.score[self.mine]).argmin()]
+        j = self.owner[s]
+        if j >= 0:  # evict
+            if self.slot[j] == s:  # not remapped to a newer copy
+                self.slot[j] = -1
+            self.clock = max(self.clock, self.score[s])
+            self.stats[row, 2] += 1
+        self.version[s] += 1
+        self.owner[s] = i
+        self.slab[s, :img.nbytes] = img.reshape(-1)
+        self.shape[i] = img.shape
+        self.orig[i] = hw0
+        self.version[s] += 1
+        self.score[s] = self.clock + self.freq[i] + self.prio[i]
+        self.slot[i] = s
+
+    def set_priority(self, weights):
+        # Image sampling weights (i.e. labels_to_image_weights()) as expected loads per pass, kept over lower ones
+        w = np.asarray(weights, dtype=np.float64)
+        self.prio[:] = w * len(w) / w.sum() if w.sum() > 0 else 0
+
+    def summary(self):
+        hits, misses, evictions = self.stats.sum(0).tolist()
+        used = self.owner[self.owner >= 0]
+        return 'LRU image cache: %.3g%% hits (%g hits, %g misses, %g evictions), %g/%g images, %.3g/%.3gGB' % (
+            100 * hits / max(hits + misses, 1), hits, misses, evictions, len(used), self.nslots,
+            self.shape[used].prod(1).sum() / 1E9, self.nbytes / 1E9)
+
+    def __getstate__(self):  # pickled to spawned DataLoader workers without the mapping, which is reattached there
+        d = {k: v for k, v in self.__dict__.items() if k not in [x[0] for x in self.layout] + ['shm', 'hw0', 'hw']}
+        d['shm_name'], d['pid'] = self.shm.name, None
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.shm = shared_memory.SharedMemory(name=self.shm_name)  # same resource tracker as the creating process
+        self.views()
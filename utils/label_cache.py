@@ -0,0 +1,166 @@
+import os
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+LABEL_CACHE_VERSION = 2
+FOUND, MISSING, EMPTY = 0, 1, 2  # label file status codes
+NEGATIVE, NOT_NORMALIZED, NEGATIVE_EXTRA = 1, 2, 4  # label file problem flags (bitmask)
+
+
+def label_cache_path(label_path):
+    # Packed label cache for a label list, i.e. 'xview_train_lbl.txt' -> 'xview_train_lbl.cache'
+    return str(Path(label_path).with_suffix('.cache'))
+
+
+def file_stat(file):
+    # Returns (size, mtime_ns) of file, or (-1, -1) if it does not exist
+    try:
+        s = os.stat(file)
+        return s.st_size, s.st_mtime_ns
+    except OSError:
+        return -1, -1
+
+
+def read_label_file(file):
+    # Parses and dedupes one label *.txt, returns (labels, status, duplicate, flags)
+    try:
+        with open(file, 'r') as f:
+            rows = [x.split() for x in f.read().splitlines() if x.strip()]
+        if not rows:
+            return None, MISSING, False, 0  # empty file, pd.read_csv() raised EmptyDataError here
+        if len(set(len(x) for x in rows)) == 1:
+            l = np.array(rows, dtype=np.float32)
+        else:  # ragged rows, pad with nan like pd.read_csv()
+            l = pd.read_csv(file, header=None, delimiter=' ').to_numpy(dtype=np.float32)
+    except (OSError, ValueError):  # missing or unparseable file (pandas parser errors are ValueErrors)
+        return None, MISSING, False, 0
+    if not l.shape[0]:
+        return l, EMPTY, False, 0
+
+    # Dedupe rows, keeping first occurrences in file order
+    _, j = np.unique(l, axis=0, return_index=True)
+    dup = len(j) < l.shape[0]
+    if dup:
+        l = l[np.sort(j)]
+
+    # Validate (nan compares False, so it is flagged too)
+    flags = NEGATIVE * (~(l[:, :5] >= 0)).any() | \
+            NOT_NORMALIZED * (~(l[:, 1:5] <= 1)).any() | \
+            NEGATIVE_EXTRA * (~(l[:, 5:] >= 0)).any()
+    return l, FOUND, dup, int(flags)
+
+
+def read_label_chunk(files):
+    # Process pool target, parses a chunk of label files
+    return [read_label_file(f) for f in files]
+
+
+def ingest_labels(files, workers=None, chunk=256, desc='Caching labels'):
+    # Parses, validates and dedupes label files in chunks across a process pool, returns list of read_label_file()
+    workers = min(os.cpu_count() or 1, 16) if workers is None else workers
+    chunks = [files[i:i + chunk] for i in range(0, len(files), chunk)]
+    pbar = tqdm(total=len(files), desc=desc, disable=not files)
+    results = []
+    if workers > 1 and len(chunks) > 1:
+        with Pool(min(workers, len(chunks))) as pool:
+            for r in pool.imap(read_label_chunk, chunks):  # ordered
+                results += r
+                pbar.update(len(r))
+    else:
+        for c in chunks:
+            results += read_label_chunk(c)
+            pbar.update(len(c))
+    pbar.close()
+    return results
+
+
+def check_labels(cache, label_files, ncols=(5,), normalized=True, extra=False):
+    """
+    Validates cached labels against a dataset's label format without asserting.
+    Returns report dict {problem: [label files]} for 'columns', 'negative' and 'non-normalized' problems.
+    ncols: accepted column counts, normalized: require xywh <= 1, extra: also require columns 5+ >= 0
+    """
+    flags, found = cache['flags'], cache['status'] == FOUND
+    ncol = np.array([0 if l is None else l.shape[1] for l in cache['labels']])
+    bad = {'columns': found & ~np.isin(ncol, ncols),
+           'negative': found & (flags & (NEGATIVE | (NEGATIVE_EXTRA if extra else 0)) > 0),
+           'non-normalized': found & (flags & NOT_NORMALIZED > 0) if normalized else np.zeros_like(found)}
+    return {k: [label_files[i] for i in np.nonzero(v)[0]] for k, v in bad.items()}
+
+
+def print_label_report(report, n=5):
+    # Prints a summary of check_labels() problems, listing the first n files of each
+    for k, v in report.items():
+        if v:
+            print('WARNING: %g label files with %s labels, their images are dropped, i.e. %s' %
+                  (len(v), k, ', '.join(v[:n])))
+
+
+def load_label_cache(label_files, cache_path, desc='Caching labels'):
+    """
+    Loads labels for label_files from the packed cache at cache_path in one read. Entries whose file size or mtime
+    changed, and files not in the cache yet, are re-parsed and the cache is rewritten.
+    Returns dict with 'labels' (list of deduped nx(5|6) arrays, None if missing), 'status', 'duplicate', 'flags'
+    and 'counts' (found, missing, empty, duplicate).
+    """
+    n = len(label_files)
+    stat = np.array([file_stat(f) for f in label_files], dtype=np.int64).reshape(n, 2)
+
+    # Read existing cache
+    index, c = {}, None
+    if os.path.isfile(cache_path):
+        try:
+            c = dict(np.load(cache_path, allow_pickle=False))
+            if int(c['version']) == LABEL_CACHE_VERSION:
+                index = {f: j for j, f in enumerate(c['files'].tolist())}
+        except Exception as e:
+            print('WARNING: ignoring unreadable label cache %s: %s' % (cache_path, e))
+
+    labels, status, dup = [None] * n, np.zeros(n, dtype=np.int8), np.zeros(n, dtype=bool)
+    flags = np.zeros(n, dtype=np.int8)
+    stale = []
+    for i, f in enumerate(label_files):
+        j = index.get(f)
+        if j is None or (c['stat'][j] != stat[i]).any():  # uncached or changed (missing files cache as -1)
+            stale.append(i)
+            continue
+        status[i], dup[i], flags[i] = c['status'][j], c['duplicate'][j], c['flags'][j]
+        if status[i] != MISSING:
+            o0, o1 = c['offsets'][j], c['offsets'][j + 1]
+            labels[i] = c['labels'][o0:o1, :c['ncol'][j]]
+
+    # Parse stale or uncached entries
+    results = ingest_labels([label_files[i] for i in stale], desc='%s (%g/%g cached)' % (desc, n - len(stale), n))
+    for i, r in zip(stale, results):
+        labels[i], status[i], dup[i], flags[i] = r
+
+    counts = tuple(int(x) for x in ((status == FOUND).sum(), (status == MISSING).sum(), (status == EMPTY).sum(),
+                                    dup.sum()))  # found, missing, empty, duplicate
+    if stale or len(index) != n:
+        try:
+            save_label_cache(cache_path, label_files, stat, labels, status, dup, flags, counts)
+        except OSError as e:
+            print('WARNING: label cache %s not writeable: %s' % (cache_path, e))
+
+    return {'labels': labels, 'status': status, 'duplicate': dup, 'flags': flags, 'counts': counts}
+
+
+def save_label_cache(cache_path, label_files, stat, labels, status, dup, flags, counts):
+    # Packs all label arrays into one (N, ncol_max) float32 table with per-file offsets and writes it atomically
+    ncol = np.array([0 if l is None else l.shape[1] for l in labels], dtype=np.int16)
+    rows = np.array([0 if l is None else l.shape[0] for l in labels], dtype=np.int64)
+    offsets = np.concatenate(([0], rows.cumsum()))
+    table = np.zeros((offsets[-1], max(ncol.max(initial=0), 1)), dtype=np.float32)
+    for l, o, k in zip(labels, offsets, ncol):
+        if l is not None and l.shape[0]:
+            table[o:o + l.shape[0], :k] = l
+
+    tmp = '%s.%g.tmp' % (cache_path, os.getpid())
+    with open(tmp, 'wb') as f:  # file handle, np.savez() would append .npz to a path
+        np.savez(f, version=LABEL_CACHE_VERSION, files=np.array(label_files, dtype=str), stat=stat, status=status,
+                 duplicate=dup, flags=flags, ncol=ncol, offsets=offsets, labels=table, counts=np.array(counts, dtype=np.int64))
+    os.replace(tmp, cache_path)  # atomic, concurrent seeds sharing a list never read a partial cache
@@ -0,0 +1,131 @@
+import os
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from utils.label_cache import file_stat, label_cache_path, load_label_cache
+
+MANIFEST_VERSION = 1
+
+
+def manifest_path(img_path, lbl_path=None):
+    # Manifest of an img/lbl list pair, named after the label list as one image list can pair with several label lists
+    # i.e. 'xviewval_lbl_px23whr3_seed17_with_model.txt' -> 'xviewval_lbl_px23whr3_seed17_with_model.manifest'
+    return str(Path(lbl_path or img_path).with_suffix('.manifest'))
+
+
+def read_list(path):
+    # Reads an image or label list *.txt
+    with open(path, 'r') as f:
+        return [x.replace('/', os.sep) for x in f.read().splitlines() if x.strip()]  # os-agnostic
+
+
+def image_wh(file):
+    # Returns exif-corrected (w, h) of an image file from its header, (0, 0) if unreadable
+    try:
+        with Image.open(file) as img:
+            w, h = img.size
+            return (h, w) if img.getexif().get(0x0112) in (6, 8) else (w, h)  # exif orientation rotated 270/90
+    except Exception:
+        return 0, 0
+
+
+def column_histogram(labels, col):
+    # Per-image histogram of label column col, returns (values, (n, len(values)) counts)
+    x = [l[:, col] if l is not None and l.ndim == 2 and l.shape[1] > col else np.zeros(0) for l in labels]
+    values = np.unique(np.concatenate(x + [np.zeros(0)]))
+    hist = np.zeros((len(labels), len(values)), dtype=np.int32)
+    for i, v in enumerate(x):
+        if len(v):
+            hist[i] = np.bincount(np.searchsorted(values, v), minlength=len(values))
+    return values, hist
+
+
+class Manifest:
+    """
+    Indexed, columnar metadata of one dataset split (an img/lbl list pair), stored as a single npz:
+    image and label paths, image wh, box count, per-image class and model-id histograms and image id.
+    Rows are in list order, image names (basenames) are looked up in O(1).
+    """
+
+    def __init__(self, x):
+        # x: manifest columns, i.e. np.load(manifest_path(img_path, lbl_path))
+        assert int(x['version']) == MANIFEST_VERSION, 'Manifest out of date'
+        self.img_files, self.label_files = x['img_files'].tolist(), x['label_files'].tolist()
+        self.wh, self.boxes, self.img_ids = x['wh'], x['boxes'], x['img_ids']
+        self.classes, self.cls_hist = x['classes'], x['cls_hist']
+        self.model_ids, self.mid_hist = x['model_ids'], x['mid_hist']
+        self.stat = x['stat']
+        self.rows = {os.path.basename(f): i for i, f in enumerate(self.img_files)}  # image name -> row
+
+    def __len__(self):
+        return len(self.img_files)
+
+    def row(self, name):
+        # Row of an image by file name, i.e. '1094_11.jpg'
+        return self.rows[os.path.basename(name)]
+
+    def img_id(self, name):
+        return int(self.img_ids[self.row(name)])
+
+    def class_counts(self, rows=None):
+        # {class: number of boxes} over all rows (or the given rows)
+        c = self.cls_hist.sum(0) if rows is None else self.cls_hist[rows].sum(0)
+        return {int(k): int(v) for k, v in zip(self.classes.tolist(), c)}
+
+    def model_counts(self, rows=None):
+        # {model id: number of boxes} over all rows (or the given rows), model id is label column 5
+        c = self.mid_hist.sum(0) if rows is None else self.mid_hist[rows].sum(0)
+        return {int(k): int(v) for k, v in zip(self.model_ids.tolist(), c)}
+
+
+def build_manifest(path, img_files, label_files, img_ids, label_cache=None, workers=8):
+    # Builds and writes the manifest of img_files/label_files in parallel, see load_manifest()
+    n = len(img_files)
+    with ThreadPool(workers) as pool:  # image headers only
+        wh = list(tqdm(pool.imap(image_wh, img_files), total=n, desc='Building manifest'))
+    wh = np.array(wh, dtype=np.int64).reshape(n, 2)
+    labels = load_label_cache(label_files, label_cache)['labels'] if label_files else [None] * n
+    boxes = np.array([0 if l is None else l.shape[0] for l in labels], dtype=np.int32)
+    classes, cls_hist = column_histogram(labels, 0)
+    model_ids, mid_hist = column_histogram(labels, 5)
+    stat = np.array([file_stat(f) for f in img_files + label_files], dtype=np.int64).reshape(-1, 2)
+    x = dict(version=MANIFEST_VERSION, img_files=np.array(img_files, dtype=str),
+             label_files=np.array(label_files, dtype=str), wh=wh, boxes=boxes,
+             img_ids=img_ids,
+             classes=classes, cls_hist=cls_hist, model_ids=model_ids, mid_hist=mid_hist, stat=stat)
+
+    tmp = '%s.%g.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:  # file handle, np.savez() would append .npz to a path
+            np.savez(f, **x)
+        os.replace(tmp, path)  # atomic
+    except OSError as e:
+        print('WARNING: manifest %s not writeable: %s' % (path, e))
+    return Manifest(x)
+
+
+def load_manifest(img_path, lbl_path=None, img_files=None, label_files=None, img_id_map=None):
+    """
+    Loads the manifest of an img/lbl list pair, building it once (or when a listed file changed).
+    img_files/label_files: lists already read by a dataset (default: read img_path/lbl_path), lbl_path may be None
+    img_id_map: {image name: id} dict, default image id is the row in the image list
+    i.e. load_manifest('xviewval_img_px23whr3_seed17.txt', 'xviewval_lbl_px23whr3_seed17_with_model.txt').model_counts()
+    """
+    img_files = read_list(img_path) if img_files is None else img_files
+    label_files = (read_list(lbl_path) if lbl_path else []) if label_files is None else label_files
+    img_ids = np.arange(len(img_files)) if img_id_map is None else \
+        np.array([img_id_map[os.path.basename(f)] for f in img_files], dtype=np.int64)
+    path = manifest_path(img_path, lbl_path)
+    try:
+        m = Manifest(np.load(path, allow_pickle=False))
+        stat = np.array([file_stat(f) for f in img_files + label_files], dtype=np.int64).reshape(-1, 2)
+        if m.img_files == img_files and m.label_files == label_files and np.array_equal(m.stat, stat) and \
+                np.array_equal(m.img_ids, img_ids):  # same meaning of image ids, rows or img_id_map
+            return m
+    except Exception:
+        pass
+    return build_manifest(path, img_files, label_files, img_ids, label_cache_path(lbl_path) if lbl_path else None)
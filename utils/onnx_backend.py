@@ -0,0 +1,92 @@
+import inspect
+import time
+import warnings
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class ExportDarknet(nn.Module):
+    # Inference output only of a Darknet (models.py or models_xview.py), the graph exported by export_onnx()
+    def __init__(self, model):
+        super(ExportDarknet, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x)[0]
+
+
+def export_onnx(model, path, img_size=416, opset=12):
+    """
+    Exports a fused eval Darknet to ONNX with dynamic batch, height and width axes, input 'images' (bs, 3, h, w) float
+    0-1, output 'output' (bs, n, no) xywh, obj, cls as the eager inference output, the same pre/post-processing applies.
+    Independent of models.ONNX_EXPORT (fixed shape, batch 1): YOLO layers build their grids in the graph, see
+    YOLOLayer.export_decode()
+    """
+    import onnx
+
+    shape = (img_size, img_size) if isinstance(img_size, int) else tuple(img_size)
+    model.fuse()
+    model.eval()
+    img = torch.zeros((1, 3) + shape)
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}  # TorchScript
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # tracer and exporter deprecation warnings
+        torch.onnx.export(ExportDarknet(model), img, path, opset_version=opset, input_names=['images'],
+                          output_names=['output'], dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'},
+                                                                 'output': {0: 'batch', 1: 'anchors'}}, **kwargs)
+    onnx.checker.check_model(onnx.load(path))  # check that the IR is well formed
+    return path
+
+
+class ONNXDarknet:
+    """
+    ONNX Runtime (CPU) inference of an export_onnx() model, called like the eager model in eval mode, i.e.
+    model = ONNXDarknet('weights/best.onnx')
+    inf_out, _ = model(imgs)  # imgs (bs, 3, h, w) float 0-1, any batch size and 32-multiple h, w
+    """
+
+    def __init__(self, path, threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads  # 0: onnxruntime default (physical cores)
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input = self.session.get_inputs()[0].name
+
+    def __call__(self, x, augment=False, conf_thres=None, max_det=3000):
+        # conf_thres: per-image list of detections above conf_thres as Darknet(..., conf_thres)
+        assert not augment, 'augmented inference is not exported, use utils/tta.py tta_detect()'
+        io = self.session.run(None, {self.input: x.detach().cpu().float().numpy()})[0]
+        io = torch.from_numpy(io).to(x.device)
+        if conf_thres is not None:
+            io = [xi[xi[:, 4] > conf_thres] for xi in io]
+            io = [xi[xi[:, 4].argsort(descending=True)[:max_det]] for xi in io]
+        return io, None
+
+    def eval(self):  # already inference-only, for model.eval() callers
+        return self
+
+
+def check(model, path, shapes=((1, 416, 416), (2, 320, 416), (1, 608, 608)), n=10):
+    # Parity (max xywh, obj difference) and latency of the eager Darknet model (fused by export_onnx()) vs its ONNX
+    # Runtime export at path, per (batch, height, width) shape, i.e. the dynamic axes
+    model.eval()
+    session = ONNXDarknet(path)
+    print('%20s%14s%14s%14s%10s' % ('shape', 'max diff', 'torch (ms)', 'onnx (ms)', 'speedup'))
+    results = []
+    for bs, h, w in shapes:
+        x = torch.rand(bs, 3, h, w)
+        dt = []
+        with torch.no_grad():
+            for m in (model, session):
+                m(x)  # warmup
+                t = time.time()
+                for _ in range(n):
+                    m(x)
+                dt.append((time.time() - t) / n)
+            d = (model(x)[0] - session(x)[0]).abs()[..., :5].max().item()  # xywh, obj
+        results.append((d,) + tuple(dt))
+        print('%20s%14.3g%14.1f%14.1f%9.2fx' % ('%gx3x%gx%g' % (bs, h, w), d, dt[0] * 1E3, dt[1] * 1E3, dt[0] / dt[1]))
+    return np.array(results)
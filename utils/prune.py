@@ -0,0 +1,157 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+ACTIVATIONS = {'leaky': lambda x: F.leaky_relu(x, 0.1),
+               'swish': lambda x: x * torch.sigmoid(x),
+               'mish': lambda x: x * torch.tanh(F.softplus(x)),
+               'linear': lambda x: x}
+
+
+def _ints(v):
+    # '-1, 61' (models_xview parser) or [-1, 61] (models parser) as a list of ints
+    return [int(x) for x in v.split(',')] if isinstance(v, str) else [int(x) for x in np.atleast_1d(v)]
+
+
+def channel_groups(mdefs, channels=3):
+    """
+    Channel dependencies of a Darknet cfg, mdefs are the module_defs without [net] (either parser). Each conv starts
+    a channel group, shortcut layers merge the groups of the outputs they add, route/maxpool/upsample pass channels on.
+    Returns (root, segments, fixed): the group of each conv (root[i], -1 for the input image), per layer output the
+    (conv, channels) segments it is made of, and the groups that can't lose channels: the input image, convs without
+    BatchNorm2d (YOLO heads) and grouped convs with their inputs
+    """
+    parent, fixed, segments = {-1: -1}, {-1}, []
+
+    def find(g):
+        while parent[g] != g:
+            g = parent[g]
+        return g
+
+    x = [(-1, channels)]  # previous layer output
+    for i, mdef in enumerate(mdefs):
+        t = mdef['type']
+        if t == 'convolutional':
+            assert len(_ints(mdef['size'])) == 1, 'layer %g: MixConv2d is not prunable' % i
+            parent[i] = i
+            if not int(mdef['batch_normalize']):
+                fixed.add(i)
+            if int(mdef.get('groups', 1)) != 1:
+                fixed.update([i] + [g for g, _ in x])
+            x = [(i, int(mdef['filters']))]
+        elif t == 'route':
+            x = sum([segments[l if l >= 0 else i + l] for l in _ints(mdef['layers'])], [])
+        elif t == 'shortcut':
+            for l in _ints(mdef['from']):
+                y = segments[l if l >= 0 else i + l]
+                assert len(x) == len(y) == 1, 'layer %g: shortcut of a route concat is not prunable' % i
+                parent[find(y[0][0])] = find(x[0][0])
+        elif t not in ('maxpool', 'upsample', 'yolo'):
+            raise ValueError('layer %g: %s layers are not prunable' % (i, t))
+        segments.append(x)
+
+    return {g: find(g) for g in parent}, segments, {find(g) for g in fixed}
+
+
+def prunable_bn(model):
+    # BatchNorm2d modules of a Darknet's prunable convs, for the gamma L1 sparsity penalty of train.py --sparsity
+    root, _, fixed = channel_groups(model.module_defs)
+    return [model.module_list[i].BatchNorm2d for i in sorted(root) if i >= 0 and root[i] not in fixed]
+
+
+def prune_masks(mdefs, state_dict, ratio=0.5, min_channels=8, channels=3):
+    """
+    Kept channels {group: bool mask} of the prunable groups of channel_groups(): a channel scores the largest |gamma|
+    of the group's convs (all the convs added by shortcuts must be ~0 to drop it), the lowest ratio of all prunable
+    channels are dropped under one global threshold, keeping at least min_channels per group
+    """
+    root, _, fixed = channel_groups(mdefs, channels)
+    score = {}
+    for i, r in root.items():
+        if i >= 0 and r not in fixed:
+            g = state_dict['module_list.%g.BatchNorm2d.weight' % i].detach().abs().float().cpu()
+            score[r] = torch.max(score[r], g) if r in score else g
+    if not score:
+        return {}
+
+    s = torch.cat(list(score.values())).sort()[0]
+    thres = s[min(int(ratio * len(s)), len(s) - 1)]
+    masks = {}
+    for r, g in score.items():
+        masks[r] = g >= thres if ratio > 0 else torch.ones_like(g, dtype=torch.bool)
+        n = min(min_channels, len(g))
+        if masks[r].sum() < n:
+            masks[r][g.argsort(descending=True)[:n]] = True
+    return masks
+
+
+def prune_state_dict(mdefs, state_dict, masks, channels=3):
+    """
+    Compacts state_dict (and the 'filters' of mdefs, in place) to the kept channels of prune_masks(). A dropped
+    channel is taken as constant, activation(BatchNorm2d bias) as for gamma 0, carried through route/maxpool/upsample
+    and summed by shortcuts; its contribution is folded into each consumer conv, BatchNorm2d running_mean or bias
+    """
+    root, segments, _ = channel_groups(mdefs, channels)
+    sd = dict(state_dict)
+    const = []  # per layer output, the constant value of dropped channels
+    x, xc = [(-1, channels)], torch.zeros(channels)  # previous layer output segments and constants
+    for i, mdef in enumerate(mdefs):
+        t = mdef['type']
+        if t == 'convolutional':
+            p = 'module_list.%g.' % i
+            w = sd[p + 'Conv2d.weight'].detach().float()
+            keep = torch.cat([masks.get(root[g], torch.ones(n, dtype=torch.bool)) for g, n in x])  # inputs kept
+            if not keep.all():
+                b = w[:, ~keep].sum((2, 3)) @ xc[~keep]  # dropped inputs' contribution
+                w = w[:, keep]
+                k = p + ('BatchNorm2d.running_mean' if int(mdef['batch_normalize']) else 'Conv2d.bias')
+                sd[k] = sd[k] - b if k.endswith('mean') else sd[k] + b
+            sd[p + 'Conv2d.weight'] = w
+
+            if int(mdef['batch_normalize']):
+                xc = ACTIVATIONS[mdef['activation']](sd[p + 'BatchNorm2d.bias'].detach().float())
+                m = masks.get(root[i])
+                if m is not None:
+                    sd[p + 'Conv2d.weight'] = w[m]
+                    for k in ('weight', 'bias', 'running_mean', 'running_var'):
+                        sd[p + 'BatchNorm2d.' + k] = sd[p + 'BatchNorm2d.' + k][m]
+                    mdef['filters'] = int(m.sum())
+            else:
+                xc = torch.zeros(w.shape[0])
+        elif t == 'route':
+            xc = torch.cat([const[l if l >= 0 else i + l] for l in _ints(mdef['layers'])])
+        elif t == 'shortcut':
+            xc = xc + sum(const[l if l >= 0 else i + l] for l in _ints(mdef['from']))
+        x = segments[i]
+        const.append(xc)
+    return sd
+
+
+def write_cfg(mdefs, path):
+    # Writes parse_model_cfg() module_defs ([net] included) back to a *.cfg file
+    with open(path, 'w') as f:
+        for mdef in mdefs:
+            f.write('[%s]\n' % mdef['type'])
+            for k, v in mdef.items():
+                if k == 'type' or (k == 'batch_normalize' and not v):
+                    continue
+                if isinstance(v, np.ndarray):  # anchors
+                    v = ',  '.join('%g,%g' % tuple(a) for a in v)
+                elif isinstance(v, (list, tuple)):
+                    v = ','.join(str(a) for a in v)
+                f.write('%s=%s\n' % (k, v))
+            f.write('\n')
+
+
+def model_flops(model, img_size=416):
+    # Conv2d GFLOPs (2 * multiply-adds) of a model on one img_size image
+    img_size = (img_size, img_size) if isinstance(img_size, int) else img_size
+    flops = []
+    hooks = [m.register_forward_hook(lambda m, x, y: flops.append(2 * y.numel() * m.weight[0].numel()))
+             for m in model.modules() if isinstance(m, torch.nn.Conv2d)]
+    training = model.training
+    with torch.no_grad():
+        model.eval()(torch.zeros((1, 3) + tuple(img_size), device=next(model.parameters()).device))
+    model.train(training)
+    [h.remove() for h in hooks]
+    return sum(flops) / 1E9
@@ -0,0 +1,117 @@
+import time
+import warnings
+
+import torch
+import torch.nn as nn
+from torch.quantization import DeQuantStub, QuantStub, convert, get_default_qconfig, prepare
+
+from utils.layers import FeatureConcat, WeightedFeatureFusion
+
+
+class QFeatureConcat(FeatureConcat):
+    # FeatureConcat with a quantizable cat
+    def __init__(self, layers):
+        super(QFeatureConcat, self).__init__(layers)
+        self.ff = nn.quantized.FloatFunctional()
+
+    def forward(self, x, outputs):
+        return self.ff.cat([outputs[i] for i in self.layers], 1) if self.multiple else outputs[self.layers[0]]
+
+
+class QWeightedFeatureFusion(WeightedFeatureFusion):
+    # Unweighted, same-channel WeightedFeatureFusion (shortcut) with a quantizable add
+    def __init__(self, layers):
+        super(QWeightedFeatureFusion, self).__init__(layers, weight=False)
+        self.ff = nn.quantized.FloatFunctional()
+
+    def forward(self, x, outputs):
+        for i in self.layers:
+            x = self.ff.add(x, outputs[i])
+        return x
+
+
+class QuantizedDarknet(nn.Module):
+    # Darknet (models.py or models_xview.py) with quantized input, called like the wrapped model
+    def __init__(self, model):
+        super(QuantizedDarknet, self).__init__()
+        self.quant = QuantStub()
+        self.model = model
+
+    def forward(self, x, *args, **kwargs):
+        return self.model(self.quant(x), *args, **kwargs)
+
+
+def quantizable(model, backend='fbgemm'):
+    """
+    Prepares a Darknet for post-training static INT8 quantization: conv+bn fused, the graph quantized from the input
+    on, route concats and shortcut adds through FloatFunctional, and each YOLO head (the conv before a YOLO layer and
+    the YOLO layer) kept in float behind a DeQuantStub, as exp() wh and grid decoding lose too much in 8 bits.
+    Returns the prepared QuantizedDarknet with observers, to be calibrated and convert()ed, i.e.
+    qmodel = quantizable(model); calibrate(qmodel, dataloader); convert(qmodel, inplace=True)
+    """
+    torch.backends.quantized.engine = backend
+    model.fuse()
+    model.eval()
+    for m in model.modules():
+        if isinstance(m, nn.LeakyReLU):
+            m.inplace = False  # not supported by quantized::leaky_relu
+    for i, m in enumerate(model.module_list):
+        if isinstance(m, FeatureConcat) and m.multiple:
+            model.module_list[i] = QFeatureConcat(m.layers)
+        elif isinstance(m, WeightedFeatureFusion):
+            assert not m.weight, 'weighted shortcuts are not quantizable'
+            model.module_list[i] = QWeightedFeatureFusion(m.layers)
+    for j in model.yolo_layers:
+        head = model.module_list[j - 1]
+        head.qconfig = None  # float
+        model.module_list[j - 1] = nn.Sequential(DeQuantStub(), head)
+        model.module_list[j].qconfig = None
+    qmodel = QuantizedDarknet(model)
+    qmodel.qconfig = get_default_qconfig(backend)
+    prepare(qmodel, inplace=True)
+    return qmodel
+
+
+def calibrate(qmodel, dataloader, n=64):
+    # Runs about n images of a LoadImagesAndLabels dataloader through a prepared model to set activation ranges
+    seen = 0
+    with torch.no_grad():
+        for imgs, *_ in dataloader:
+            qmodel(imgs.float() / 255.0)
+            seen += imgs.shape[0]
+            if seen >= n:
+                break
+    return seen
+
+
+def save_quantized(qmodel, path, cfg, family, backend='fbgemm'):
+    # Saves a converted model's INT8 state_dict with what load_quantized() needs to rebuild it
+    torch.save({'model': qmodel.state_dict(), 'cfg': cfg, 'family': family, 'backend': backend}, path)
+
+
+def load_quantized(model, path, family):
+    # Loads a save_quantized() checkpoint into model, a float Darknet of the same cfg (and family: 'models' for
+    # detect.py, 'models_xview' for test_xview.py), returns the INT8 QuantizedDarknet (CPU only)
+    chkpt = torch.load(path, map_location='cpu')
+    assert chkpt['family'] == family, '%s is a %s INT8 model, not %s' % (path, chkpt['family'], family)
+    qmodel = quantizable(model, chkpt['backend'])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # uncalibrated observers, qparams come from the checkpoint
+        convert(qmodel, inplace=True)
+    qmodel.load_state_dict(chkpt['model'])
+    return qmodel
+
+
+def benchmark(model, img_size=416, batch_size=8, n=10):
+    # CPU latency (batch 1, ms) and throughput (batch_size, img/s) of a model in eval mode
+    shape = (img_size, img_size) if isinstance(img_size, int) else img_size
+    with torch.no_grad():
+        dt = []
+        for bs in (1, batch_size):
+            x = torch.rand((bs, 3) + tuple(shape))
+            model(x)  # warmup
+            t = time.time()
+            for _ in range(n):
+                model(x)
+            dt.append((time.time() - t) / n)
+    return dt[0] * 1E3, batch_size / dt[1]
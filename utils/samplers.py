@@ -0,0 +1,142 @@
+import math
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class AliasTable:
+    """
+    Walker/Vose alias table for drawing indices with replacement from a discrete distribution, i.e. image weights.
+    Built in O(n), draws k indices in O(k) with two vectorized uniform draws, i.e.
+    dataset.indices = AliasTable(image_weights).sample(dataset.n)  # weighted epoch for LoadImagesAndLabels
+    """
+
+    def __init__(self, weights):
+        p = np.asarray(weights, dtype=np.float64)
+        n = len(p)
+        p = p * n / p.sum() if p.sum() > 0 else np.ones(n)  # scaled so the mean is 1, uniform if all zero
+        self.prob, self.alias = np.ones(n), np.arange(n)
+        small, large = np.nonzero(p < 1)[0].tolist(), np.nonzero(p >= 1)[0].tolist()
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s], self.alias[s] = p[s], l  # column s: s with prob p[s], else l
+            p[l] -= 1 - p[s]
+            (small if p[l] < 1 else large).append(l)
+        # leftovers (rounding) keep prob 1
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, k, rng=np.random):
+        # k weighted indices, with replacement
+        i = rng.randint(0, len(self.prob), k)
+        return np.where(rng.random_sample(k) < self.prob[i], i, self.alias[i])
+
+
+class MixedBatchSampler(Sampler):
+    """
+    Batch sampler over a ConcatDataset of [real, synthetic, background, ...] datasets with an exact per-batch mix, i.e.
+    MixedBatchSampler([len(real), len(syn)], batch_size=8, ratios=[0.25]) -> every batch is 6 real + 2 synthetic
+    Each part is drawn without replacement from its own shuffled order and reshuffled when used up, so small synthetic
+    or background sets cycle while the real set is covered once per epoch. Used with one DataLoader (one worker pool):
+    DataLoader(ConcatDataset(datasets), batch_sampler=sampler, collate_fn=...). Ratios can be changed between epochs
+    with set_ratios() and real image weights with set_weights(), the loader does not need to be rebuilt.
+    """
+
+    def __init__(self, sizes, batch_size, ratios=(), nb=None, shuffle=True, seed=0):
+        # sizes: dataset lengths in ConcatDataset order, ratios: batch fractions of datasets 1, 2, ... (real is the rest)
+        # nb: batches per epoch, default one pass over the real dataset
+        self.sizes, self.batch_size, self.nb, self.shuffle = list(sizes), batch_size, nb, shuffle
+        self.offsets = np.concatenate(([0], np.cumsum(self.sizes)))  # ConcatDataset index offsets
+        self.rng = np.random.RandomState(seed)
+        self.orders, self.pos = [None] * len(self.sizes), [0] * len(self.sizes)
+        self.weights = None
+        self.set_ratios(*ratios)
+
+    def set_ratios(self, *ratios):
+        # Sets per-batch fractions of datasets 1, 2, ..., takes effect from the next epoch (iter)
+        assert len(ratios) == len(self.sizes) - 1, 'need one ratio per non-real dataset'
+        k = [int(round(self.batch_size * r)) for r in ratios]
+        assert sum(k) < self.batch_size or not self.sizes[0], 'ratios %s leave no real images per batch' % (ratios,)
+        self.counts = [self.batch_size - sum(k)] + k  # images per batch from each dataset
+        assert all(n for n, c in zip(self.sizes, self.counts) if c), 'empty dataset with a non-zero ratio'
+        self.ratios = ratios
+
+    def set_weights(self, weights):
+        # Real (dataset 0) image sampling weights for its next passes, None for uniform; other datasets stay uniform
+        self.weights = None if weights is None else AliasTable(weights)
+
+    def take(self, d, k):
+        # Next k ConcatDataset indices of dataset d, reshuffling its order when used up
+        out = []
+        while len(out) < k:
+            if self.orders[d] is None or self.pos[d] >= self.sizes[d]:
+                if d == 0 and self.weights is not None:
+                    self.orders[d] = self.weights.sample(self.sizes[d], self.rng)  # weighted, with replacement
+                else:
+                    self.orders[d] = self.rng.permutation(self.sizes[d]) if self.shuffle else np.arange(self.sizes[d])
+                self.pos[d] = 0
+            j = self.orders[d][self.pos[d]:self.pos[d] + k - len(out)]
+            self.pos[d] += len(j)
+            out += (j + self.offsets[d]).tolist()
+        return out
+
+    def __iter__(self):
+        self.pos[0] = self.sizes[0]  # the real dataset starts a fresh pass every epoch
+        for _ in range(len(self)):
+            yield sum([self.take(d, k) for d, k in enumerate(self.counts) if k], [])
+
+    def __len__(self):
+        return self.nb or max(math.ceil(self.sizes[0] / max(self.counts[0], 1)), 1)
+
+
+class InfiniteBatchSampler(Sampler):
+    """
+    Endless batch sampler for a DataLoader that is iterated once for the whole run, i.e.
+    batches = iter(DataLoader(dataset, batch_sampler=InfiniteBatchSampler(len(dataset), 16), num_workers=8))
+    so workers are started (and labels/images forked) once and keep prefetching across epochs, unlike re-entering
+    `for ... in dataloader` every epoch. A logical epoch is exactly nb batches (len(sampler)); each starts a new pass
+    over a fresh shuffled order and runs into further passes if needed, like the old infi_loop(). Image weights set
+    with set_weights() are resampled in place from the next pass, which may be up to the workers' prefetch depth
+    ahead of the training loop. batches: a finite batch sampler (i.e. MixedBatchSampler) repeated per epoch, which
+    then gets the weights.
+    """
+
+    def __init__(self, n, batch_size=16, nb=None, shuffle=True, seed=0, batches=None):
+        self.n, self.batch_size, self.nb, self.shuffle, self.batches = n, batch_size, nb, shuffle, batches
+        self.rng = np.random.RandomState(seed)
+        self.weights = None
+        self.epoch = 0
+
+    def set_weights(self, weights):
+        # Image sampling weights (i.e. labels_to_image_weights()) for the next passes, None for uniform
+        if self.batches is not None:
+            self.batches.set_weights(weights)
+        else:
+            self.weights = None if weights is None else AliasTable(weights)
+
+    def passes(self):
+        # Endless stream of batches, one pass (ceil(n / batch_size) batches, last one partial) after another
+        while True:
+            if self.batches is not None:
+                yield from self.batches
+                continue
+            if self.weights is not None:
+                order = self.weights.sample(self.n, self.rng)  # weighted, with replacement, O(n)
+            else:
+                order = self.rng.permutation(self.n) if self.shuffle else np.arange(self.n)
+            for i in range(0, self.n, self.batch_size):
+                yield order[i:i + self.batch_size].tolist()
+
+    def __iter__(self):
+        while True:
+            stream = self.passes()  # fresh pass every epoch
+            for _ in range(len(self)):
+                yield next(stream)
+            self.epoch += 1
+
+    def __len__(self):
+        # batches per logical epoch
+        if self.nb:
+            return self.nb
+        return len(self.batches) if self.batches is not None else math.ceil(self.n / self.batch_size)
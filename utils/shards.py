@@ -0,0 +1,155 @@
+import argparse
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from utils.label_cache import FOUND, MISSING, EMPTY, ingest_labels
+
+SHARD_VERSION = 1
+
+
+def shard_file(path, k):
+    # k-th shard of a shard index, i.e. 'xview_train.shards' -> 'xview_train_003.shard'
+    p = Path(path)
+    return str(p.with_name('%s_%03g.shard' % (p.stem, k)))
+
+
+def read_image_bytes(file, raw=False):
+    # Returns (bytes, hwc shape) of one image, decoded to uint8 BGR if raw else the encoded file as is
+    img = cv2.imread(file)  # BGR, also validates encoded images
+    assert img is not None, 'Image Not Found ' + file
+    if raw:
+        return np.ascontiguousarray(img).reshape(-1), img.shape
+    return np.fromfile(file, dtype=np.uint8), img.shape
+
+
+def pack_shards(img_path, lbl_path, out, shard_gb=4.0, raw=False, workers=8):
+    """
+    Packs an img/lbl list pair into large sequential shard files, i.e.
+    pack_shards('data_wnd/real/wnd_train_img_px10_seed17.txt', 'data_wnd/real/wnd_train_lbl_px10_seed17.txt',
+                'data_wnd/real/wnd_train_px10_seed17.shards')
+    Writes contiguous images to <out stem>_000.shard, _001.shard ... (a new shard every shard_gb) and the index,
+    label table and image shapes to <out>. raw: store decoded uint8 BGR instead of the encoded files (skips decode,
+    ~10x larger). Point 'train' or 'valid' in a *.data file at <out> to train/test from the shards.
+    """
+    with open(img_path, 'r') as f:
+        img_files = [x for x in f.read().splitlines() if x.strip()]
+    with open(lbl_path, 'r') as f:
+        label_files = [x for x in f.read().splitlines() if x.strip()]
+    assert len(img_files) == len(label_files), 'Image/label list length mismatch %s, %s' % (img_path, lbl_path)
+    n = len(img_files)
+
+    # Labels
+    results = ingest_labels(label_files, desc='Packing labels')
+    rows = np.array([0 if r[0] is None else r[0].shape[0] for r in results], dtype=np.int64)
+    ncol = max([r[0].shape[1] for r in results if r[0] is not None] + [5])
+    label_offsets = np.concatenate(([0], rows.cumsum()))
+    table = np.zeros((label_offsets[-1], ncol), dtype=np.float32)
+    for (l, *_), o in zip(results, label_offsets):
+        if l is not None and l.shape[0]:
+            table[o:o + l.shape[0], :l.shape[1]] = l
+
+    # Images, written in list order so reads are sequential within a shard
+    shard, offsets = np.zeros(n, dtype=np.int32), np.zeros(n, dtype=np.int64)
+    nbytes, shapes = np.zeros(n, dtype=np.int64), np.zeros((n, 3), dtype=np.int64)
+    k, o, gb, f = 0, 0, 0, open(shard_file(out, 0), 'wb')
+    with ThreadPool(workers) as pool:
+        pbar = tqdm(enumerate(pool.imap(lambda x: read_image_bytes(x, raw), img_files)), total=n, desc='Packing images')
+        for i, (b, s) in pbar:
+            if o and o + b.nbytes > shard_gb * 1E9:  # start next shard
+                f.close()
+                k, o, f = k + 1, 0, open(shard_file(out, k + 1), 'wb')
+            f.write(b.data)
+            shard[i], offsets[i], nbytes[i], shapes[i] = k, o, b.nbytes, s
+            o, gb = o + b.nbytes, gb + b.nbytes / 1E9
+            pbar.desc = 'Packing images (%g shards, %.1fGB)' % (k + 1, gb)
+    f.close()
+
+    with open(out, 'wb') as f:  # file handle, np.savez() would append .npz to a path
+        np.savez(f, version=SHARD_VERSION, raw=raw, nshards=k + 1, files=np.array(img_files, dtype=str),
+                 label_files=np.array(label_files, dtype=str), shard=shard, offsets=offsets, nbytes=nbytes,
+                 shapes=shapes, status=np.array([r[1] for r in results], dtype=np.int8),
+                 duplicate=np.array([r[2] for r in results], dtype=bool),
+                 flags=np.array([r[3] for r in results], dtype=np.int8),
+                 ncol=np.array([0 if r[0] is None else r[0].shape[1] for r in results], dtype=np.int16),
+                 label_offsets=label_offsets, labels=table)
+    print('Packed %g images, %g labels into %g shards (%.1fGB) at %s' % (n, len(table), k + 1, gb, out))
+    return out
+
+
+class ShardIndex:
+    """
+    Read side of pack_shards(). Shards are memory-mapped read-only and shared by DataLoader workers; images are
+    decoded from the mapped bytes (or viewed zero-copy if packed raw). Indexed by dataset image index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        x = np.load(path, allow_pickle=False)
+        assert int(x['version']) == SHARD_VERSION, 'Shard index %s version %g, expected %g. Repack with ' \
+                                                   'utils/shards.py' % (path, int(x['version']), SHARD_VERSION)
+        self.raw, self.nshards = bool(x['raw']), int(x['nshards'])
+        self.img_files, self.label_files = x['files'].tolist(), x['label_files'].tolist()
+        self.shard, self.offsets, self.nbytes, self.shapes = x['shard'], x['offsets'], x['nbytes'], x['shapes']
+        self.status, self.duplicate, self.flags, self.ncol = x['status'], x['duplicate'], x['flags'], x['ncol']
+        lo = x['label_offsets']
+        self.label_span, self.table = np.stack((lo[:-1], lo[1:]), 1), x['labels']  # label table rows of each image
+        self.mm = None
+
+    def __len__(self):
+        return len(self.img_files)
+
+    def select(self, i):
+        # Reorders/subsets images in place, i.e. after sorting by aspect ratio for rectangular training
+        self.img_files, self.label_files = [self.img_files[j] for j in i], [self.label_files[j] for j in i]
+        self.shard, self.offsets, self.nbytes = self.shard[i], self.offsets[i], self.nbytes[i]
+        self.shapes = self.shapes[i]
+        self.status, self.duplicate, self.flags = self.status[i], self.duplicate[i], self.flags[i]
+        self.label_span, self.ncol = self.label_span[i], self.ncol[i]
+
+    def wh(self):
+        # Original image shapes (wh), same as the *.shapes file of an image list
+        return self.shapes[:, 1::-1].astype(np.float64)
+
+    def label_cache(self):
+        # Labels in load_label_cache() format (see utils/label_cache.py)
+        labels = [None if s == MISSING else self.table[o0:o1, :k]
+                  for (o0, o1), k, s in zip(self.label_span, self.ncol, self.status)]
+        counts = tuple(int(x) for x in ((self.status == FOUND).sum(), (self.status == MISSING).sum(),
+                                        (self.status == EMPTY).sum(), self.duplicate.sum()))
+        return {'labels': labels, 'status': self.status, 'duplicate': self.duplicate, 'flags': self.flags,
+                'counts': counts}
+
+    def imread(self, i):
+        # Returns image i as uint8 BGR, like cv2.imread()
+        if self.mm is None:  # map lazily, once per worker process
+            self.mm = [np.memmap(shard_file(self.path, k), dtype=np.uint8, mode='r') for k in range(self.nshards)]
+        b = self.mm[self.shard[i]][self.offsets[i]:self.offsets[i] + self.nbytes[i]]
+        if self.raw:
+            return b.reshape(self.shapes[i])  # zero-copy read-only view
+        img = cv2.imdecode(b, cv2.IMREAD_COLOR)
+        assert img is not None, 'Corrupt shard image %s in %s' % (self.img_files[i], self.path)
+        return img
+
+    def __getstate__(self):  # pickled to spawned DataLoader workers without the mappings
+        d = self.__dict__.copy()
+        d['mm'] = None
+        return d
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--img', type=str, required=True, help='image list *.txt')
+    parser.add_argument('--lbl', type=str, required=True, help='label list *.txt')
+    parser.add_argument('--out', type=str, default='', help='shard index path, default <img list stem>.shards')
+    parser.add_argument('--shard-gb', type=float, default=4.0, help='max shard size (GB)')
+    parser.add_argument('--raw', action='store_true', help='store decoded uint8 images (no decode when training)')
+    parser.add_argument('--workers', type=int, default=8, help='image reader threads')
+    opt = parser.parse_args()
+    print(opt)
+
+    pack_shards(opt.img, opt.lbl, opt.out or str(Path(opt.img).with_suffix('.shards')), opt.shard_gb, opt.raw,
+                opt.workers)
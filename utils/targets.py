@@ -0,0 +1,35 @@
+import torch
+
+
+def match_targets(targets, anchors, ng, iou_t, nc):
+    """
+    build_targets() matching of targets (nt, 6) to anchors (nl, na, 2) on grids ng (nl, 2) nx, ny, in the (layer,
+    anchor, target) order of the per-layer loop, shared by utils.utils and utils.utils_xview. Returns flat i (5, n)
+    image, class, anchor, gj, gi, boxes (n, 6) xywh (grids) and anchor wh, and the list of n per layer, for
+    split_targets(). Also runs in the DataLoader workers (utils.datasets.TargetCollate), with no model
+    """
+    nl = anchors.shape[0]
+    t = targets[None].repeat(nl, 1, 1)  # (nl, nt, 6)
+    t[..., 2:] *= ng.repeat(1, 2)[:, None]  # to grid space
+
+    # Match anchors
+    inter = torch.min(anchors[:, :, None], t[:, None, :, 4:6]).prod(3)  # (nl, na, nt)
+    iou = inter / (anchors.prod(2)[:, :, None] + t[:, None, :, 4:6].prod(3) - inter)
+    l, a, k = (iou > iou_t).nonzero(as_tuple=True)  # iou threshold hyperparameter
+    t = t[l, k]
+    n = torch.bincount(l, minlength=nl).tolist()  # targets per layer
+
+    # Indices, boxes and classes
+    b, c = t[:, :2].long().t()  # target image, class
+    gxy = t[:, 2:4]  # grid x, y
+    gi, gj = gxy.long().t()  # grid x, y indices
+    if len(c):
+        assert c.max() < nc, 'Model accepts %g classes labeled from 0-%g, however you labelled a class %g. ' \
+                             'See https://github.com/ultralytics/yolov3/wiki/Train-Custom-Data' % (nc, nc - 1, c.max())
+    return torch.stack((b, c, a, gj, gi)), torch.cat((gxy - gxy.floor(), t[:, 4:6], anchors[l, a]), 1), n
+
+
+def split_targets(i, boxes, n):
+    # Per layer tcls, tbox, indices (b, a, gj, gi) and anchor vec of match_targets() output
+    i, boxes = i.split(n, 1), boxes.split(n)
+    return [x[1] for x in i], [x[:, :4] for x in boxes], [tuple(x[[0, 2, 3, 4]]) for x in i], [x[:, 4:] for x in boxes]
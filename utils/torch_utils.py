@@ -1,6 +1,7 @@
 import math
 import os
 import time
+from contextlib import nullcontext
 from copy import deepcopy
 
 import torch
@@ -50,6 +51,17 @@ def time_synchronized():
     return time.time()
 
 
+def cpu_autocast(enabled=True):
+    # bfloat16 autocast context for CPU forward passes (conv/matmul in bf16), losses and NMS belong outside of it
+    return torch.autocast('cpu', dtype=torch.bfloat16) if enabled else nullcontext()
+
+
+def channels_last(x):
+    # Model or NCHW tensor in channels_last (NHWC) memory format, faster oneDNN convolutions on CPU
+    return x.to(memory_format=torch.channels_last) if isinstance(x, nn.Module) else \
+        x.contiguous(memory_format=torch.channels_last)
+
+
 def initialize_weights(model):
     for m in model.modules():
         t = type(m)
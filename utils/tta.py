@@ -0,0 +1,91 @@
+import math
+
+import torch
+import torch.nn.functional as F
+import torchvision
+
+TTA = ((1, ''), (0.83, 'lr'), (0.67, ''))  # default (scale, flip), https://github.com/ultralytics/yolov3/issues/931
+
+
+def parse_tta(s):
+    # '1,0.83lr,0.67' to ((1.0, ''), (0.83, 'lr'), (0.67, '')), flips 'lr', 'ud' or 'lrud', '' for no TTA (None)
+    return tuple((float(a.rstrip('lrud')), a.lstrip('0123456789.')) for a in s.replace(' ', '').split(',')) if s \
+        else None
+
+
+def tta_name(tta):
+    # parse_tta() inverse, 'none' for no TTA
+    return ','.join('%g%s' % a for a in tta) if tta else 'none'
+
+
+def tta_batch(x, tta=TTA, gs=32):
+    # Flipped and scaled copies of x (bs, 3, h, w) as one (len(tta) * bs, 3, h', w') batch, augmentation-major, each
+    # padded bottom-right to the gs-multiple shape of the largest scale
+    h, w = x.shape[2:]
+    s = max(r for r, _ in tta)
+    H, W = [math.ceil(v * s / gs) * gs for v in (h, w)]
+    y = []
+    for r, f in tta:
+        xi = x.flip([d for d, k in ((3, 'lr'), (2, 'ud')) if k in f]) if f else x
+        if r != 1:
+            xi = F.interpolate(xi, size=(int(h * r), int(w * r)), mode='bilinear', align_corners=False)
+        y.append(F.pad(xi, [0, W - xi.shape[3], 0, H - xi.shape[2]], value=0.447))  # imagenet mean
+    return torch.cat(y, 0)
+
+
+def deaugment(y, tta, shape):
+    # Maps the xywh of tta_batch() predictions y (len(tta) * bs, n, no) to the (h, w) shape of the original batch in
+    # place, returns y viewed as (len(tta), bs, n, no)
+    h, w = shape
+    y = y.view(len(tta), -1, *y.shape[1:])
+    gain = y.new_tensor([[int(w * r) / w, int(h * r) / h] * 2 for r, _ in tta]).view(-1, 1, 1, 4)
+    y[..., :4] /= gain  # scale
+    lr = y.new_tensor(['lr' in f for _, f in tta], dtype=torch.bool).view(-1, 1, 1)
+    ud = y.new_tensor(['ud' in f for _, f in tta], dtype=torch.bool).view(-1, 1, 1)
+    y[..., 0] = torch.where(lr, w - y[..., 0], y[..., 0])  # flip lr
+    y[..., 1] = torch.where(ud, h - y[..., 1], y[..., 1])  # flip ud
+    return y
+
+
+def wbf(dets, iou_thres=0.55, n=None):
+    """
+    Weighted box fusion https://arxiv.org/abs/1910.13302 of the detections (xyxy, conf, cls) of n augmentations (or
+    models) of one image, i.e. the non_max_suppression() outputs. Clusters are the boxes of a class overlapping a
+    batched_nms() survivor by more than iou_thres, fused to the conf-weighted mean box with the mean conf scaled by
+    min(cluster size, n) / n, so boxes found by few augmentations rank lower. Returns (m, 6) sorted by conf or None
+    """
+    dets = [d for d in dets if d is not None and len(d)]
+    if not dets:
+        return None
+    n = n or len(dets)
+    d = torch.cat(dets, 0)
+    boxes, conf, cls = d[:, :4], d[:, 4], d[:, 5]
+
+    k = torchvision.ops.batched_nms(boxes, conf, cls, iou_thres)  # cluster leaders
+    iou = torchvision.ops.box_iou(boxes, boxes[k]) * (cls[:, None] == cls[k][None])  # (boxes, leaders)
+    iou[k, torch.arange(len(k), device=d.device)] = 2.0  # leaders lead their own cluster
+    v, j = iou.max(1)
+    m = v > iou_thres
+    j, w = j[m], conf[m]
+
+    fused = d.new_zeros((len(k), 6))
+    fused[:, :4].index_add_(0, j, boxes[m] * w[:, None])
+    fused[:, 4].index_add_(0, j, w)
+    size = torch.bincount(j, minlength=len(k)).to(d.dtype)
+    fused[:, :4] /= fused[:, 4:5]
+    fused[:, 4] = fused[:, 4] / size * size.clamp(max=n) / n
+    fused[:, 5] = cls[k]
+    return fused[fused[:, 4].argsort(descending=True)]
+
+
+def tta_detect(model, x, tta=TTA, nms=None, conf_thres=0.001, iou_thres=0.6, wbf_thres=0.55):
+    """
+    Test-time augmented detection of the Darknet (models.py or models_xview.py, eager, compiled or INT8) on x: one
+    forward of the tta_batch(), predictions deaugment()ed, nms (the family's non_max_suppression, i.e. a partial with
+    its options) per image and augmentation, then wbf() over the augmentations. Returns nms-like per-image detections
+    """
+    nb, k = x.shape[0], len(tta)
+    y = model(tta_batch(x, tta))[0].float()
+    y = deaugment(y, tta, x.shape[2:]).view(k * nb, *y.shape[1:])
+    out = nms(y, conf_thres=conf_thres, iou_thres=iou_thres)
+    return [wbf([out[j * nb + i] for j in range(k)], wbf_thres, k) for i in range(nb)]
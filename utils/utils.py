@@ -15,6 +15,7 @@ import torch.nn as nn
 import torchvision
 from tqdm import tqdm
 import torch_utils  # , google_utils
+from utils.targets import match_targets, split_targets
 
 # Set printoptions
 torch.set_printoptions(linewidth=320, precision=5, profile='long')
@@ -24,6 +25,8 @@ matplotlib.rc('font', **{'size': 11})
 # Prevent OpenCV from multithreading (to use PyTorch DataLoader)
 cv2.setNumThreads(0)
 
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz  # np.trapz is removed in numpy 2.4
+
 
 def init_seeds(seed=0):
     random.seed(seed)
@@ -51,7 +54,7 @@ def labels_to_class_weights(labels, nc=80):
         return torch.Tensor()
 
     labels = np.concatenate(labels, 0)  # labels.shape = (866643, 5) for COCO
-    classes = labels[:, 0].astype(np.int)  # labels = [class xywh]
+    classes = labels[:, 0].astype(int)  # labels = [class xywh]
     weights = np.bincount(classes, minlength=nc)  # occurences per class
 
     # Prepend gridpoint count (for uCE trianing)
@@ -64,11 +67,19 @@ def labels_to_class_weights(labels, nc=80):
     return torch.from_numpy(weights)
 
 
-def labels_to_image_weights(labels, nc=80, class_weights=np.ones(80)):
-    # Produces image weights based on class mAPs
-    n = len(labels)
-    class_counts = np.array([np.bincount(labels[i][:, 0].astype(np.int), minlength=nc) for i in range(n)])
-    image_weights = (class_weights.reshape(1, nc) * class_counts).sum(1)
+def labels_to_class_counts(labels, nc=80):
+    # (n, nc) int32 matrix of per-image class counts, build once and pass to labels_to_image_weights()
+    nl = np.array([0 if l is None else len(l) for l in labels])  # labels per image
+    classes = np.concatenate([l[:, 0] for l in labels if l is not None and len(l)] + [np.zeros(0)]).astype(np.int64)
+    counts = np.bincount(np.repeat(np.arange(len(labels)), nl) * nc + classes, minlength=len(labels) * nc)
+    return counts.astype(np.int32).reshape(len(labels), nc)
+
+
+def labels_to_image_weights(labels, nc=80, class_weights=np.ones(80), class_counts=None):
+    # Produces image weights based on class mAPs, class_counts: precomputed labels_to_class_counts(labels, nc)
+    if class_counts is None:
+        class_counts = labels_to_class_counts(labels, nc)
+    image_weights = class_counts @ np.asarray(class_weights, dtype=np.float64).reshape(nc)  # (n, nc) @ (nc,)
     # index = random.choices(range(n), weights=image_weights, k=1)  # weight image sample
     return image_weights
 
@@ -247,7 +258,7 @@ def compute_ap(recall, precision):
     method = 'interp'  # methods: 'continuous', 'interp'
     if method == 'interp':
         x = np.linspace(0, 1, 101)  # 101-point interp (COCO)
-        ap = np.trapz(np.interp(x, mrec, mpre), x)  # integrate
+        ap = trapezoid(np.interp(x, mrec, mpre), x)  # integrate
     else:  # 'continuous'
         i = np.where(mrec[1:] != mrec[:-1])[0]  # points where x axis (recall) changes
         ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])  # area under curve
@@ -369,25 +380,53 @@ def smooth_BCE(eps=0.1):  # https://github.com/ultralytics/yolov3/issues/238#iss
     return 1.0 - 0.5 * eps, 0.5 * eps
 
 
-def compute_loss(p, targets, model):  # predictions, targets, model
+def loss_cache(model, device, red='mean'):
+    # YOLO layer anchor vectors (nl, na, 2) and loss criteria of model, built once per device and loss hyperparameters
+    h = model.hyp  # hyperparameters
+    key = (str(device), red, h['cls_pw'], h['obj_pw'], h['fl_gamma'])
+    cache = getattr(model, 'loss_cache', None)
+    if cache is None or cache['key'] != key:
+        m = model.module if type(model) in (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel) else model
+        BCEcls = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([h['cls_pw']], device=device), reduction=red)
+        BCEobj = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([h['obj_pw']], device=device), reduction=red)
+        g = h['fl_gamma']  # focal loss gamma
+        if g > 0:
+            BCEcls, BCEobj = FocalLoss(BCEcls, g), FocalLoss(BCEobj, g)
+        cache = {'key': key, 'BCEcls': BCEcls, 'BCEobj': BCEobj,
+                 'anchors': torch.stack([m.module_list[j].anchor_vec for j in m.yolo_layers]).float().to(device)}
+        model.loss_cache = cache  # a dict, not registered as submodules or in the state_dict
+    return cache
+
+
+def compute_loss(p, targets, model, cache=True, assigned=None):  # predictions, targets, model
+    # cache=False: per-layer build_targets_loop() and new criteria per call, the reference of tools/benchmark.py
+    # assigned: match_targets() output of the batch from the DataLoader workers (utils.datasets.TargetCollate)
     ft = torch.cuda.FloatTensor if p[0].is_cuda else torch.Tensor
     lcls, lbox, lobj = ft([0]), ft([0]), ft([0])
-    tcls, tbox, indices, anchor_vec = build_targets(p, targets, model)
+    if assigned is not None:
+        i, boxes, n = assigned
+        tcls, tbox, indices, anchor_vec = split_targets(i.to(p[0].device), boxes.to(p[0].device), n)
+    else:
+        tcls, tbox, indices, anchor_vec = (build_targets if cache else build_targets_loop)(p, targets, model)
     h = model.hyp  # hyperparameters
     red = 'mean'  # Loss reduction (sum or mean)
 
     # Define criteria
-    BCEcls = nn.BCEWithLogitsLoss(pos_weight=ft([h['cls_pw']]), reduction=red)
-    BCEobj = nn.BCEWithLogitsLoss(pos_weight=ft([h['obj_pw']]), reduction=red)
+    if cache:
+        c = loss_cache(model, p[0].device, red)
+        BCEcls, BCEobj = c['BCEcls'], c['BCEobj']
+    else:
+        BCEcls = nn.BCEWithLogitsLoss(pos_weight=ft([h['cls_pw']]), reduction=red)
+        BCEobj = nn.BCEWithLogitsLoss(pos_weight=ft([h['obj_pw']]), reduction=red)
+
+        # focal loss
+        g = h['fl_gamma']  # focal loss gamma
+        if g > 0:
+            BCEcls, BCEobj = FocalLoss(BCEcls, g), FocalLoss(BCEobj, g)
 
     # class label smoothing https://arxiv.org/pdf/1902.04103.pdf eqn 3
     cp, cn = smooth_BCE(eps=0.0)
 
-    # focal loss
-    g = h['fl_gamma']  # focal loss gamma
-    if g > 0:
-        BCEcls, BCEobj = FocalLoss(BCEcls, g), FocalLoss(BCEobj, g)
-
     # Compute losses
     np, ng = 0, 0  # number grid points, targets
     for i, pi in enumerate(p):  # layer index, layer predictions
@@ -444,6 +483,18 @@ def compute_loss(p, targets, model):  # predictions, targets, model
 
 
 def build_targets(p, targets, model):
+    """
+    Target assignment of all YOLO layers and anchors in one batched op: targets (image, class, x, y, w, h) scaled to
+    each layer's grid, matched to every anchor with wh_iou > hyp['iou_t']. Returns per layer tcls, tbox (xywh grids),
+    indices (b, a, gj, gi) to gather the predictions p[i][b, a, gj, gi] and anchor vec, as build_targets_loop()
+    """
+    anchors = loss_cache(model, targets.device)['anchors']  # (nl, na, 2) grid units
+    ng = torch.tensor([pi.shape[3:1:-1] for pi in p], device=targets.device, dtype=targets.dtype)  # (nl, 2) nx, ny
+    return split_targets(*match_targets(targets, anchors, ng, model.hyp['iou_t'], model.nc))
+
+
+def build_targets_loop(p, targets, model):
+    # Per-layer build_targets(), the reference of tools/benchmark.py
     # targets = [image, class, x, y, w, h]
 
     nt = targets.shape[0]
@@ -502,7 +553,93 @@ def build_targets(p, targets, model):
 
 def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, multi_label=True, classes=None, agnostic=False):
     """
-    Performs  Non-Maximum Suppression on inference results
+    Performs  Non-Maximum Suppression on inference results of the whole batch at once: prediction (bs, n, no), or a
+    list of (n, no) per image (fused_decode()), filtered together and suppressed in one batched_nms() call grouped by
+    image (and class). Same results as non_max_suppression_loop()
+    Returns detections with shape:
+        nx6 (x1, y1, x2, y2, conf, cls)
+    """
+
+    # Box constraints
+    min_wh, max_wh = 2, 4096  # (pixels) minimum and maximum box width and height
+
+    method = 'merge'
+    if isinstance(prediction, torch.Tensor):
+        bs, nc = prediction.shape[0], prediction.shape[2] - 5  # batch size, number of classes
+        b, k = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # apply conf constraint
+        x = prediction[b, k]  # (n, no) candidates of all images
+    else:  # list of per image detections
+        bs, nc = len(prediction), prediction[0].shape[1] - 5
+        x = torch.cat(prediction)
+        b = torch.arange(bs, device=x.device).repeat_interleave(torch.tensor([len(y) for y in prediction],
+                                                                              device=x.device))
+        b, x = b[x[:, 4] > conf_thres], x[x[:, 4] > conf_thres]
+    multi_label &= nc > 1  # multiple labels per box
+    output = [None] * bs
+
+    # Apply width-height constraint
+    j = ((x[:, 2:4] > min_wh) & (x[:, 2:4] < max_wh)).all(1)
+    b, x = b[j], x[j]
+
+    # Compute conf
+    x[..., 5:] *= x[..., 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero().t()
+        x = torch.cat((box[i], x[i, j + 5].unsqueeze(1), j.float().unsqueeze(1)), 1)
+        b = b[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1)
+        x = torch.cat((box, conf.unsqueeze(1), j.float().unsqueeze(1)), 1)
+
+    # Filter by class
+    if classes:
+        j = (j.view(-1, 1) == torch.tensor(classes, device=j.device)).any(1)
+        b, x = b[j], x[j]
+
+    # Apply finite constraint
+    if not torch.isfinite(x).all():
+        j = torch.isfinite(x).all(1)
+        b, x = b[j], x[j]
+
+    # If none remain in the batch
+    if not x.shape[0]:
+        return output
+
+    # Batched NMS, boxes grouped by image (and class)
+    g = b if agnostic else b * nc + x[:, 5].long()  # groups
+    i = torchvision.ops.boxes.batched_nms(x[:, :4], x[:, 4], g, iou_thres)  # sorted by decreasing score
+    if method == 'merge':  # Merge NMS (boxes merged using weighted mean)
+        nb = torch.bincount(b, minlength=bs)  # boxes per image
+        m = i[nb[b[i]] < 1E4]  # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
+        boxes, scores = x[:, :4].clone(), x[:, 4]
+        s = torch.sort(g, stable=True)[1]  # boxes by group
+        m = m[g[m].argsort()]  # kept boxes by group
+        lo, hi = torch.searchsorted(g[s], g[m]), torch.searchsorted(g[s], g[m], right=True)  # their groups in s
+        k0 = 0
+        while k0 < len(m):  # blocks of kept boxes by the boxes of their groups, at most 2 ** 24 IoUs
+            cost = torch.arange(1, len(m) - k0 + 1, device=m.device) * (hi[k0:] - lo[k0])
+            k1 = k0 + max(int((cost <= 2 ** 24).sum()), 1)
+            k, j = m[k0:k1], s[int(lo[k0]):int(hi[k1 - 1])]
+            weights = ((box_iou(boxes[k], boxes[j]) > iou_thres) & (g[k, None] == g[j])) * scores[j]  # box weights
+            x[k, :4] = torch.mm(weights / weights.sum(1, keepdim=True), boxes[j]).float()  # merged boxes
+            k0 = k1
+
+    # Split by image, score order kept
+    i = i[torch.sort(b[i], stable=True)[1]]
+    for xi, y in enumerate(x[i].split(torch.bincount(b[i], minlength=bs).tolist())):
+        output[xi] = y if len(y) else None
+    return output
+
+
+def non_max_suppression_loop(prediction, conf_thres=0.1, iou_thres=0.6, multi_label=True, classes=None,
+                             agnostic=False):
+    """
+    Performs  Non-Maximum Suppression on inference results, image by image, the reference of tools/benchmark.py
     Returns detections with shape:
         nx6 (x1, y1, x2, y2, conf, cls)
     """
@@ -696,13 +833,19 @@ def coco_single_class_labels(path='../coco/labels/train2014/', label_class=43):
             shutil.copyfile(src=img_file, dst='new/images/' + Path(file).name.replace('txt', 'jpg'))  # copy images
 
 
-def kmean_anchors(path='../coco/train2017.txt', n=12, img_size=(320, 1024), thr=0.10, gen=1000):
+def kmean_anchors(path='../coco/train2017.txt', n=12, img_size=(320, 1024), thr=0.10, gen=1000, label_path=None):
     # Creates kmeans anchors for use in *.cfg files: from utils.utils import *; _ = kmean_anchors()
+    # path: image list *.txt (with label_path), *.shards index, or *.data file (uses its train/train_label)
     # n: number of anchors
     # img_size: (min, max) image size used for multi-scale training (can be same values)
     # thr: IoU threshold hyperparameter used for training (0.0 - 1.0)
     # gen: generations to evolve anchors using genetic algorithm
     from utils.datasets import LoadImagesAndLabels
+    from utils.parse_config import parse_data_cfg
+
+    if path.endswith('.data'):
+        data_dict = parse_data_cfg(path)
+        path, label_path = data_dict['train'], data_dict.get('train_label')
 
     def print_results(k):
         k = k[np.argsort(k.prod(1))]  # sort small to large
@@ -723,7 +866,7 @@ def kmean_anchors(path='../coco/train2017.txt', n=12, img_size=(320, 1024), thr=
 
     # Get label wh
     wh = []
-    dataset = LoadImagesAndLabels(path, augment=True, rect=True, cache_labels=True)
+    dataset = LoadImagesAndLabels(path, label_path, augment=True, rect=True, cache_labels=True)
     nr = 1 if img_size[0] == img_size[1] else 10  # number augmentation repetitions
     for s, l in zip(dataset.shapes, dataset.labels):
         wh.append(l[:, 3:5] * (s / s.max()))  # image normalized to letterbox normalized wh
@@ -879,7 +1022,7 @@ def plot_images(imgs, targets, paths=None, fname='images.png'):
     fig = plt.figure(figsize=(10, 10))
     bs, _, h, w = imgs.shape  # batch size, _, height, width
     bs = min(bs, 16)  # limit plot to 16 images
-    ns = np.ceil(bs ** 0.5)  # number of subplots
+    ns = int(np.ceil(bs ** 0.5))  # number of subplots
 
     for i in range(bs):
         boxes = xywh2xyxy(targets[targets[:, 0] == i, 2:6]).T
@@ -17,6 +17,7 @@ import pandas as pd
 
 import models_xview
 from utils import torch_utils # , google_utils
+from utils.targets import match_targets, split_targets
 import json
 
 matplotlib.rc('font', **{'size': 11})
@@ -28,6 +29,8 @@ np.set_printoptions(linewidth=320, formatter={'float_kind': '{:11.5g}'.format})
 # Prevent OpenCV from multithreading (to use PyTorch DataLoader)
 cv2.setNumThreads(0)
 
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz  # np.trapz is removed in numpy 2.4
+
 
 def floatn(x, n=3):  # format floats to n decimals
     return float(format(x, '.%gf' % n))
@@ -71,7 +74,7 @@ def labels_to_class_weights(labels, nc=60):
         return torch.Tensor()
 
     labels = np.concatenate(labels, 0)  # labels.shape = (866643, 5) for COCO
-    classes = labels[:, 0].astype(np.int)  # labels = [class xywh]
+    classes = labels[:, 0].astype(int)  # labels = [class xywh]
     print(min(classes), max(classes))
     weights = np.bincount(classes, minlength=nc)  # occurences per class
 
@@ -85,11 +88,19 @@ def labels_to_class_weights(labels, nc=60):
     return torch.from_numpy(weights)
 
 
-def labels_to_image_weights(labels, nc=60, class_weights=np.ones(60)):
-    # Produces image weights based on class mAPs
-    n = len(labels)
-    class_counts = np.array([np.bincount(labels[i][:, 0].astype(np.int), minlength=nc) for i in range(n)])
-    image_weights = (class_weights.reshape(1, nc) * class_counts).sum(1)
+def labels_to_class_counts(labels, nc=60):
+    # (n, nc) int32 matrix of per-image class counts, build once and pass to labels_to_image_weights()
+    nl = np.array([0 if l is None else len(l) for l in labels])  # labels per image
+    classes = np.concatenate([l[:, 0] for l in labels if l is not None and len(l)] + [np.zeros(0)]).astype(np.int64)
+    counts = np.bincount(np.repeat(np.arange(len(labels)), nl) * nc + classes, minlength=len(labels) * nc)
+    return counts.astype(np.int32).reshape(len(labels), nc)
+
+
+def labels_to_image_weights(labels, nc=60, class_weights=np.ones(60), class_counts=None):
+    # Produces image weights based on class mAPs, class_counts: precomputed labels_to_class_counts(labels, nc)
+    if class_counts is None:
+        class_counts = labels_to_class_counts(labels, nc)
+    image_weights = class_counts @ np.asarray(class_weights, dtype=np.float64).reshape(nc)  # (n, nc) @ (nc,)
     # index = random.choices(range(n), weights=image_weights, k=1)  # weight image sample
     return image_weights
 
@@ -355,7 +366,7 @@ def ap_per_class(tp, conf, pred_cls, target_cls, pr_path='', pr_name='', model_i
                 # ax.plot(np.concatenate(([0.], recall)), np.concatenate(([0.], precision)))
                 np.savetxt(os.path.join(pr_path, 'recall.txt'), recall)
                 np.savetxt(os.path.join(pr_path, 'precision.txt'), precision)
-                ax1.plot(recall, precision, label=pr_name + '  mAP: %.3f' % ap[ci])
+                ax1.plot(recall, precision, label=pr_name + '  mAP: %.3f' % ap[ci, 0])
                 ax1.legend()
                 ax1.set_title('YOLOv3-SPP PR-Curve')
                 ax1.set_xlabel('Recall')
@@ -546,7 +557,7 @@ def compute_ap(recall, precision):
     method = 'interp'  # methods: 'continuous', 'interp'
     if method == 'interp':
         x = np.linspace(0, 1, 101)  # 101-point interp (COCO)
-        ap = np.trapz(np.interp(x, mrec, mpre), x)  # integrate
+        ap = trapezoid(np.interp(x, mrec, mpre), x)  # integrate
     else:  # 'continuous'
         i = np.where(mrec[1:] != mrec[:-1])[0]  # points where x axis (recall) changes
         ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])  # area under curve
@@ -658,24 +669,50 @@ class FocalLoss(nn.Module):
             return loss
 
 
-def compute_loss(p, targets, model):  # predictions, targets, model
+def loss_cache(model, device, red='sum'):
+    # YOLO layer anchor vectors (nl, na, 2) and loss criteria of model, built once per device, arc and loss
+    # hyperparameters
+    h = model.hyp  # hyperparameters
+    key = (str(device), red, model.arc, h['cls_pw'], h['obj_pw'], h['fl_gamma'])
+    cache = getattr(model, 'loss_cache', None)
+    if cache is None or cache['key'] != key:
+        m = model.module if type(model) in (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel) else model
+        BCEcls = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([h['cls_pw']], device=device), reduction=red)
+        BCEobj = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([h['obj_pw']], device=device), reduction=red)
+        BCE = nn.BCEWithLogitsLoss(reduction=red)
+        CE = nn.CrossEntropyLoss(reduction=red)  # weight=model.class_weights
+        if 'F' in model.arc:  # add focal loss
+            g = h['fl_gamma']
+            BCEcls, BCEobj, BCE, CE = FocalLoss(BCEcls, g), FocalLoss(BCEobj, g), FocalLoss(BCE, g), FocalLoss(CE, g)
+        cache = {'key': key, 'BCEcls': BCEcls, 'BCEobj': BCEobj, 'BCE': BCE, 'CE': CE,
+                 'anchors': torch.stack([m.module_list[i].anchor_vec for i in m.yolo_layers]).float().to(device)}
+        model.loss_cache = cache  # a dict, not registered as submodules or in the state_dict
+    return cache
+
+
+def compute_loss(p, targets, model, cache=True):  # predictions, targets, model
+    # cache=False: per-layer build_targets_loop() and new criteria per call, the reference of tools/benchmark.py
     ft = torch.cuda.FloatTensor if p[0].is_cuda else torch.Tensor
     lcls, lbox, lobj = ft([0]), ft([0]), ft([0])
-    tcls, tbox, indices, anchor_vec = build_targets(model, targets)
+    tcls, tbox, indices, anchor_vec = (build_targets if cache else build_targets_loop)(model, targets)
 
     h = model.hyp  # hyperparameters
     arc = model.arc  # # (default, uCE, uBCE) detection architectures
     red = 'sum'  # Loss reduction (sum or mean)
 
     # Define criteria
-    BCEcls = nn.BCEWithLogitsLoss(pos_weight=ft([h['cls_pw']]), reduction=red)
-    BCEobj = nn.BCEWithLogitsLoss(pos_weight=ft([h['obj_pw']]), reduction=red)
-    BCE = nn.BCEWithLogitsLoss(reduction=red)
-    CE = nn.CrossEntropyLoss(reduction=red)  # weight=model.class_weights
+    if cache:
+        c = loss_cache(model, p[0].device, red)
+        BCEcls, BCEobj, BCE, CE = c['BCEcls'], c['BCEobj'], c['BCE'], c['CE']
+    else:
+        BCEcls = nn.BCEWithLogitsLoss(pos_weight=ft([h['cls_pw']]), reduction=red)
+        BCEobj = nn.BCEWithLogitsLoss(pos_weight=ft([h['obj_pw']]), reduction=red)
+        BCE = nn.BCEWithLogitsLoss(reduction=red)
+        CE = nn.CrossEntropyLoss(reduction=red)  # weight=model.class_weights
 
-    if 'F' in arc:  # add focal loss
-        g = h['fl_gamma']
-        BCEcls, BCEobj, BCE, CE = FocalLoss(BCEcls, g), FocalLoss(BCEobj, g), FocalLoss(BCE, g), FocalLoss(CE, g)
+        if 'F' in arc:  # add focal loss
+            g = h['fl_gamma']
+            BCEcls, BCEobj, BCE, CE = FocalLoss(BCEcls, g), FocalLoss(BCEobj, g), FocalLoss(BCE, g), FocalLoss(CE, g)
 
     # Compute losses
     np, ng = 0, 0  # number grid points, targets
@@ -772,10 +809,19 @@ def compute_loss(p, targets, model):  # predictions, targets, model
 
 def build_targets(model, targets):
     '''
+    Target assignment of all YOLO layers and anchors in one batched op, same results as build_targets_loop()
     :param model:
-    :param targets:
-    :return: tcls, tbox, indices, anchor_vec
+    :param targets: [image, class, x, y, w, h] normalized
+    :return: tcls, tbox, indices, anchor_vec, per yolo layer, indices (b, a, gj, gi) gather p[i][b, a, gj, gi]
     '''
+    anchors = loss_cache(model, targets.device)['anchors']  # (nl, na, 2) grid units
+    m = model.module if type(model) in (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel) else model
+    ng = torch.stack([m.module_list[i].ng for i in m.yolo_layers]).to(targets)  # (nl, 2) nx, ny of the last forward
+    return split_targets(*match_targets(targets, anchors, ng, model.hyp['iou_t'], model.nc))
+
+
+def build_targets_loop(model, targets):
+    # Per-layer build_targets(), the reference of tools/benchmark.py
     # targets = [image, class, x, y, w, h]
 
     nt = len(targets)
@@ -834,7 +880,160 @@ def build_targets(model, targets):
 
 def non_max_suppression(prediction, conf_thres=0.5, iou_thres=0.5, multi_cls=True, method='vision_batch', classes=None):
     """
-    Removes detections with lower object confidence score than 'conf_thres'
+    Removes detections with lower object confidence score than 'conf_thres' of the whole batch at once: prediction
+    (bs, n, no) or a list of (n, no) per image, filtered together, then suppressed grouped by image and class, in one
+    batched_nms() call for method 'vision_batch', else by nms_groups(). Same results as non_max_suppression_loop()
+    Returns detections with shape:
+        (x1, y1, x2, y2, conf, class)
+    """
+    # NMS methods https://github.com/ultralytics/yolov3/issues/679 'or', 'and', 'merge', 'soft', 'vision', 'vision_batch'
+
+    # Box constraints
+    min_wh, max_wh = 4, 608
+
+    if isinstance(prediction, torch.Tensor):
+        bs, nc = prediction.shape[0], prediction.shape[2] - 5  # batch size, number of classes
+        b, k = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # apply conf constraint
+        pred = prediction[b, k]  # (n, no) candidates of all images
+    else:  # list of per image predictions
+        bs, nc = len(prediction), prediction[0].shape[1] - 5
+        pred = torch.cat(prediction)
+        b = torch.arange(bs, device=pred.device).repeat_interleave(torch.tensor([len(x) for x in prediction],
+                                                                                device=pred.device))
+        b, pred = b[pred[:, 4] > conf_thres], pred[pred[:, 4] > conf_thres]
+    output = [None] * bs
+
+    # Apply width-height constraint
+    j = (pred[:, 2:4] > min_wh).all(1) & (pred[:, 2:4] < max_wh).all(1)
+    b, pred = b[j], pred[j]
+    found = torch.bincount(b, minlength=bs).tolist()  # images with detections get a (possibly empty) tensor, else None
+
+    # Compute conf
+    torch.sigmoid_(pred[..., 5:])
+    pred[..., 5:] *= pred[..., 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(pred[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_cls:
+        i, j = (pred[:, 5:] > conf_thres).nonzero().t()
+        pred = torch.cat((box[i], pred[i, j + 5].unsqueeze(1), j.float().unsqueeze(1)), 1)
+        b = b[i]
+    else:  # best class only
+        conf, j = pred[:, 5:].max(1)
+        pred = torch.cat((box, conf.unsqueeze(1), j.float().unsqueeze(1)), 1)
+
+    # Filter by class
+    if classes:
+        j = (j.view(-1, 1) == torch.tensor(classes, device=j.device)).any(1)
+        b, pred = b[j], pred[j]
+
+    # Apply finite constraint
+    if not torch.isfinite(pred).all():
+        j = torch.isfinite(pred).all(1)
+        b, pred = b[j], pred[j]
+
+    # Batched NMS, boxes grouped by image and class
+    g = b * nc + pred[:, 5].long()  # groups
+    if method == 'vision_batch':
+        i = torchvision.ops.boxes.batched_nms(pred[:, :4], pred[:, 4], g, iou_thres)  # sorted by decreasing score
+        pred, b = pred[i], b[i]
+    else:  # All other NMS methods
+        pred, g = nms_groups(pred, g, method, conf_thres, iou_thres)
+        i = pred[:, 4].argsort(descending=True)  # sort
+        pred, b = pred[i], g[i] // nc
+        found = torch.bincount(b, minlength=bs).tolist()  # no detections kept is None
+
+    # Split by image, score order kept
+    i = torch.sort(b, stable=True)[1]
+    for image_i, x in enumerate(pred[i].split(torch.bincount(b, minlength=bs).tolist())):
+        output[image_i] = x if found[image_i] else None
+    return output
+
+
+def group_iou(box):
+    # IoU (g, m, m) of the x1y1x2y2 boxes (g, m, 4) of each group, rows as box1 of bbox_iou()
+    b1, b2 = box[:, :, None], box[:, None]
+    inter = (torch.min(b1[..., 2], b2[..., 2]) - torch.max(b1[..., 0], b2[..., 0])).clamp(0) * \
+            (torch.min(b1[..., 3], b2[..., 3]) - torch.max(b1[..., 1], b2[..., 1])).clamp(0)
+    a1 = (b1[..., 2] - b1[..., 0]) * (b1[..., 3] - b1[..., 1])
+    a2 = (b2[..., 2] - b2[..., 0]) * (b2[..., 3] - b2[..., 1])
+    return inter / ((a1 + 1e-16) + a2 - inter)
+
+
+def nms_groups(pred, g, method='or', conf_thres=0.5, iou_thres=0.5, max_n=500, max_pairs=2 ** 22):
+    """
+    'or', 'and', 'merge', 'soft' or 'vision' NMS of the detections pred (n, 6) in groups g (image and class), the
+    first max_n of each group, as the per-class loops of non_max_suppression_loop(). Groups are padded to blocks of
+    at most max_pairs IoUs, on which the sequential keep/suppress decisions are iterated to their fixed point
+    (Cluster-NMS https://arxiv.org/abs/2005.03572, exact: box k of a group is final after k iterations)
+    :return: kept detections, merged boxes ('merge') and decayed confidences ('soft'), and their groups
+    """
+    # Order by confidence ('vision' keeps the prediction order), group by group, first max_n per group
+    if method != 'vision':
+        i = pred[:, 4].argsort(descending=True)
+        pred, g = pred[i], g[i]
+    i = torch.sort(g, stable=True)[1]
+    pred, g = pred[i], g[i]
+    u, gi, n = torch.unique_consecutive(g, return_inverse=True, return_counts=True)
+    r = torch.arange(len(g), device=g.device) - (n.cumsum(0) - n)[gi]  # rank in group
+    j = r < max_n
+    pred, gi, r, n = pred[j], gi[j], r[j], n.clamp(max=max_n)
+    if method == 'vision':
+        i = torchvision.ops.boxes.batched_nms(pred[:, :4], pred[:, 4], gi, iou_thres)
+        return pred[i], u[gi[i]]
+
+    # Padded (groups, m) blocks
+    m = int(n.max()) if len(n) else 1
+    x = pred.new_zeros((len(n), m, pred.shape[1]))
+    x[gi, r] = pred
+    valid = torch.zeros((len(n), m), dtype=torch.bool, device=pred.device)
+    valid[gi, r] = True
+    keep = torch.zeros_like(valid)
+    ar = torch.arange(m, device=pred.device)
+    upper = torch.ones((m, m), dtype=torch.bool, device=pred.device).triu(1)  # box k before box j
+    nb = max(max_pairs // m ** 2, 1)  # groups per block
+    for k in range(0, len(n), nb):
+        xb, v = x[k:k + nb], valid[k:k + nb]  # views, blocks are updated in place
+        iou = group_iou(xb[..., :4])  # (gb, m, m)
+        pairs = upper & v[:, :, None] & v[:, None]
+        kb = v.clone()
+        if method == 'soft':  # soft-NMS https://arxiv.org/abs/1704.04503
+            sigma = 0.5  # soft-nms sigma parameter
+            decay = torch.where(pairs, torch.exp(-iou ** 2 / sigma), torch.ones_like(iou))  # decay of j by box k
+            while True:
+                conf = xb[..., 4] * torch.where(kb[:, :, None], decay, torch.ones_like(decay)).prod(1)  # decayed
+                kn = v & (conf > conf_thres)  # https://github.com/ultralytics/yolov3/issues/362
+                if torch.equal(kn, kb):
+                    break
+                kb = kn
+            xb[..., 4] = conf
+        else:
+            s = pairs & (iou > iou_thres if method == 'merge' else ~(iou < iou_thres))  # box k removes box j
+            while True:
+                kn = v & ~(s & kb[:, :, None]).any(1)
+                if torch.equal(kn, kb):
+                    break
+                kb = kn
+            first = torch.where(s & kb[:, :, None], ar[:, None], torch.full_like(ar, m)[:, None]).min(1)[0]  # remover
+            if method == 'merge':  # weighted mixture box of the kept box and the boxes it removes
+                w = ((first[:, None] == ar[:, None]) | torch.eye(m, dtype=torch.bool, device=pred.device)) & v[:, None]
+                w = w * xb[:, None, :, 4]  # weights
+                xb[..., :4] = torch.where(kb[..., None], torch.bmm(w, xb[..., :4]) / w.sum(2, keepdim=True),
+                                          xb[..., :4])
+            elif method == 'and':  # requires overlap with a box not yet removed, single boxes erased
+                kb &= (pairs & (first[:, None] >= ar[:, None]) & (iou > 0.5)).any(2)
+                kb[:, 0] |= v.sum(1) == 1  # no NMS required if only 1 prediction
+        keep[k:k + nb] = kb
+    return x[keep], u[:, None].expand(-1, m)[keep]
+
+
+def non_max_suppression_loop(prediction, conf_thres=0.5, iou_thres=0.5, multi_cls=True, method='vision_batch',
+                             classes=None):
+    """
+    Removes detections with lower object confidence score than 'conf_thres', image by image, the reference of
+    tools/benchmark.py
     Non-Maximum Suppression to further filter detections.
     Returns detections with shape:
         (x1, y1, x2, y2, object_conf, conf, class)
@@ -1251,7 +1450,7 @@ def plot_images(imgs, targets, paths=None, fname='images.jpg'):
     fig = plt.figure(figsize=(10, 10))
     bs, _, h, w = imgs.shape  # batch size, _, height, width
     bs = min(bs, 16)  # limit plot to 16 images
-    ns = np.ceil(bs ** 0.5)  # number of subplots
+    ns = int(np.ceil(bs ** 0.5))  # number of subplots
     for i in range(bs):
         #fixme skip target is null
         if i >= targets.shape[0] or not targets[i].shape[0]:
@@ -0,0 +1,131 @@
+import math
+import random
+
+import cv2
+import numpy as np
+
+
+def letterbox_matrix(shape, new_shape=(416, 416), resized=None, auto=False, scaleup=True, square=False):
+    """
+    letterbox() of an hw shape image as a 3x3 matrix, without touching pixels. resized: hw load_image() resizes the
+    image to first (default shape), folded into the same matrix. square: ratio from the longest sides as the xView
+    letterbox(). Returns M (continuous image coordinates -> letterboxed), ratio, pad and letterboxed hw as letterbox()
+    """
+    if isinstance(new_shape, int):
+        new_shape = (new_shape, new_shape)
+    h, w = resized or shape
+
+    # Scale ratio (new / old)
+    r = max(new_shape) / max(h, w) if square else min(new_shape[0] / h, new_shape[1] / w)
+    if not scaleup:  # only scale down, do not scale up (for better test mAP)
+        r = min(r, 1.0)
+
+    # Compute padding
+    new_unpad = int(round(w * r)), int(round(h * r))
+    dw, dh = new_shape[1] - new_unpad[0], new_shape[0] - new_unpad[1]  # wh padding
+    if auto:  # minimum rectangle
+        dw, dh = np.mod(dw, 64 if not square else 32), np.mod(dh, 64 if not square else 32)
+    dw /= 2  # divide padding into 2 sides
+    dh /= 2
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+
+    M = np.eye(3)
+    M[0, 0], M[1, 1] = new_unpad[0] / shape[1], new_unpad[1] / shape[0]  # both resizes in one scale
+    M[0, 2], M[1, 2] = left, top
+    return M, (r, r), (dw, dh), (new_unpad[1] + top + bottom, new_unpad[0] + left + right)
+
+
+def random_affine_matrix(shape, degrees=10, translate=.1, scale=.1, shear=10, border=0):
+    # Random rotation/scale/translation/shear matrix of random_affine() for an hw shape image, same random draws
+    # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
+    # https://medium.com/uruvideo/dataset-augmentation-with-random-homographies-a8f4b44830d4
+
+    # Rotation and Scale
+    R = np.eye(3)
+    a = random.uniform(-degrees, degrees)
+    # a += random.choice([-180, -90, 0, 90])  # add 90deg rotations to small rotations
+    s = random.uniform(1 - scale, 1 + scale)
+    R[:2] = cv2.getRotationMatrix2D(angle=a, center=(shape[1] / 2, shape[0] / 2), scale=s)
+
+    # Translation
+    T = np.eye(3)
+    T[0, 2] = random.uniform(-translate, translate) * shape[0] + border  # x translation (pixels)
+    T[1, 2] = random.uniform(-translate, translate) * shape[1] + border  # y translation (pixels)
+
+    # Shear
+    S = np.eye(3)
+    S[0, 1] = math.tan(random.uniform(-shear, shear) * math.pi / 180)  # x shear (deg)
+    S[1, 0] = math.tan(random.uniform(-shear, shear) * math.pi / 180)  # y shear (deg)
+
+    return S @ T @ R  # ORDER IS IMPORTANT HERE!!
+
+
+def flip_matrix(width):
+    # Left-right flip of a width wide image
+    F = np.eye(3)
+    F[0, 0], F[0, 2] = -1, width
+    return F
+
+
+def warp_boxes(boxes, M):
+    # Boxes (n, 4) xyxy transformed by M, returns the xyxy boxes enclosing the 4 warped corners
+    n = len(boxes)
+    xy = np.ones((n * 4, 3))
+    xy[:, :2] = boxes[:, [0, 1, 2, 3, 0, 3, 2, 1]].reshape(n * 4, 2)  # x1y1, x2y2, x1y2, x2y1
+    xy = (xy @ M.T)[:, :2].reshape(n, 8)
+    x = xy[:, [0, 2, 4, 6]]
+    y = xy[:, [1, 3, 5, 7]]
+    return np.concatenate((x.min(1), y.min(1), x.max(1), y.max(1))).reshape(4, n).T
+
+
+def affine_targets(targets, M, width, height, area_thr=0.2):
+    # Transforms targets [cls, xyxy, ...] by M as random_affine(), dropping boxes mostly outside the width x height image
+    n = len(targets)
+    if n:
+        xy = warp_boxes(targets[:, 1:5], M)
+
+        # reject warped points outside of image
+        xy[:, [0, 2]] = xy[:, [0, 2]].clip(0, width)
+        xy[:, [1, 3]] = xy[:, [1, 3]].clip(0, height)
+        w = xy[:, 2] - xy[:, 0]
+        h = xy[:, 3] - xy[:, 1]
+        area = w * h
+        area0 = (targets[:, 3] - targets[:, 1]) * (targets[:, 4] - targets[:, 2])
+        ar = np.maximum(w / (h + 1e-16), h / (w + 1e-16))  # aspect ratio
+        i = (w > 4) & (h > 4) & (area / (area0 + 1e-16) > area_thr) & (ar < 10)
+
+        targets = targets[i]
+        targets[:, 1:5] = xy[i]
+    return targets
+
+
+def warp_image(img, M, shape, color=(114, 114, 114), interp=cv2.INTER_LINEAR, copy=False):
+    """
+    Applies M (continuous coordinates, i.e. flip_matrix() @ random_affine_matrix() @ letterbox_matrix()) to img, giving
+    an hw shape image. Axis-aligned M (resize, pad, flip) runs as resize() + copyMakeBorder() + flip(), skipping each
+    that is a no-op (cheaper than a scaling warpAffine() and INTER_AREA capable), any other M as one warpAffine().
+    copy: never return img itself (i.e. for in-place augment_hsv() on a cached image)
+    """
+    h, w = img.shape[:2]
+    flip = M[0, 0] < 0
+    F = flip_matrix(shape[1]) @ M if flip else M  # M without the flip
+    A, t = F[:2, :2], F[:2, 2]
+    new_unpad = int(round(w * A[0, 0])), int(round(h * A[1, 1]))
+    left, top = int(round(t[0])), int(round(t[1]))
+    right, bottom = shape[1] - new_unpad[0] - left, shape[0] - new_unpad[1] - top
+    if A[0, 1] == A[1, 0] == 0 and (new_unpad[0] / w, new_unpad[1] / h) == (A[0, 0], A[1, 1]) and \
+            (left, top) == tuple(t) and min(left, top, right, bottom) >= 0:  # whole-pixel resize and pad
+        img0 = img
+        if new_unpad != (w, h):  # resize
+            img = cv2.resize(img, new_unpad, interpolation=interp)
+        if left or top or right or bottom:
+            img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
+        if flip:
+            img = cv2.flip(img, 1)
+        return img.copy() if copy and img is img0 else img
+
+    # warpAffine() maps pixel centers, continuous x = pixel x + 0.5
+    P = M[:2].copy()
+    P[:, 2] += M[:2, :2].sum(1) * 0.5 - 0.5
+    return cv2.warpAffine(img, P, dsize=(shape[1], shape[0]), flags=interp, borderValue=color)
@@ -12,6 +12,7 @@ import cv2
 
 from utils.data_process_distribution_vis_util import process_wv_coco_for_yolo_patches_no_trnval as pwv
 from utils.xview_synthetic_util import anaylze_xview_syn_results as axs
+from utils.manifest import load_manifest
 from utils.utils_xview import coord_iou
 
 # from utils.xview_synthetic_util import preprocess_synthetic_data_distribution as pps
@@ -340,18 +341,9 @@ def statistic_model_number(type='Validation'):
         val_lbl_file = '/media/lab/Yang/code/yolov3/data_xview/1_cls/xviewtrain_lbl_with_model.txt'
         json_name = 'trn_model_num_maps.json'
         png_name = 'trn_number_3d-model.jpg'
-    df_val = pd.read_csv(val_lbl_file, header=None)
-    Num = {}
+    val_img_file = val_lbl_file.replace('_lbl_with_model', '_img')
+    Num = load_manifest(val_img_file, val_lbl_file).model_counts()  # per-image model-id histograms
     comments = '38bbox_giou0_with_model'
-    for f in df_val.loc[:, 0]:
-        if not is_non_zero_file(f):
-            continue
-        df_lbl = pd.read_csv(f, header=None, sep=' ')
-        for m in df_lbl.loc[:, 5]:
-            if m not in Num.keys():
-                Num[m] = 1
-            else:
-                Num[m] += 1
     json_file = os.path.join(args.txt_save_dir, 'val_result_iou_map', comments, json_name)
     json.dump(Num, open(json_file,
                         'w'), ensure_ascii=False, indent=2, cls=MyEncoder)
@@ -10,8 +10,10 @@ import json
 import shutil
 import cv2
 import seaborn as sn
+from functools import lru_cache
 
 from utils.data_process_distribution_vis_util import process_wv_coco_for_yolo_patches_no_trnval as pwv
+from utils.manifest import load_manifest
 from utils.utils_xview import coord_iou
 from utils.xview_synthetic_util import preprocess_xview_syn_data_distribution as pps
 
@@ -57,12 +59,14 @@ def is_non_zero_file(fpath):
     return os.path.isfile(fpath) and os.path.getsize(fpath) > 0
 
 
+@lru_cache()
+def get_val_manifest():
+    return load_manifest(os.path.join(syn_args.data_xview_dir, 'xviewval_img.txt'))
+
+
 def get_val_imgid_by_name(name):
-    val_files = pd.read_csv(os.path.join(syn_args.data_xview_dir, 'xviewval_img.txt'), header=None).to_numpy()
-    # print('val_files 0', val_files[0])
-    val_names = [os.path.basename(vf[0]) for vf in val_files]
-    img_id = val_names.index(name)
-    return img_id
+    # image id is the row in xviewval_img.txt, O(1) manifest lookup
+    return get_val_manifest().img_id(name)
 
 
 def check_prd_gt_iou_xview_syn(dt, sr, image_name, comments='', txt_path=None, score_thres=0.3, iou_thres=0.5, px_thres=6,
@@ -5,6 +5,7 @@ import os
 from skimage import io, color
 from utils.data_process_distribution_vis_util import process_wv_coco_for_yolo_patches_no_trnval as pwv
 from utils.object_score_util import get_bbox_coords_from_annos_with_object_score as gbc
+from utils.manifest import load_manifest
 import pandas as pd
 from ast import literal_eval
 from matplotlib import pyplot as plt
@@ -579,14 +580,12 @@ def statistic_model_number(comments='px23whr3_seed17', type='all'):
     png_name = '{}_number_3d-model.jpg'.format(type)
     Num = {}
 
-    if type == 'train':
-        data_path = pd.read_csv(os.path.join(args.data_save_dir, comments, 'xview{}_lbl_{}_with_model.txt'.format(type, comments)), header=None)
-        lbl_files = [f for f in data_path.loc[:, 0]]
-        title = "Model Numbers of Training Dataset"
-    elif type == 'val':
-        data_path = pd.read_csv(os.path.join(args.data_save_dir, comments, 'xview{}_lbl_{}_with_model.txt'.format(type, comments)), header=None)
-        lbl_files = [f for f in data_path.loc[:, 0]]
-        title = "Model Numbers of Validation Dataset"
+    if type in ('train', 'val'):  # per-image model-id histograms of the split manifest
+        manifest = load_manifest(os.path.join(args.data_save_dir, comments, 'xview{}_img_{}.txt'.format(type, comments)),
+                                 os.path.join(args.data_save_dir, comments, 'xview{}_lbl_{}_with_model.txt'.format(type, comments)))
+        Num = manifest.model_counts()
+        lbl_files = []
+        title = "Model Numbers of {} Dataset".format('Training' if type == 'train' else 'Validation')
     elif type == 'syn':
         syn_file = '/media/lab/Yang/code/yolov3/data_xview/syn_xview_bkg_px23whr3_xbw_xrxc_spr_sml_gauss_models_color_1_cls/syn_xview_bkg_px23whr3_xbw_xrxc_spr_sml_gauss_models_color_seed17/syn_xview_bkg_px23whr3_xbw_xrxc_spr_sml_gauss_models_color_all_lbl_seed17.txt'
         data_path = pd.read_csv(syn_file, header=None)